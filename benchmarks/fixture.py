@@ -0,0 +1,269 @@
+"""Builds a synthetic database with the schema of genologics_sql.tables, for the benchmarks.
+
+Each project has samples_per_project samples, going through the same workflow :
+
+* a submitted sample, with its original artifact
+* a QC step, producing a result file per sample
+* a library prep step, producing a library per sample, placed in a 96 well plate
+* a pooling step, pooling POOL_SIZE libraries in a pool
+* a sequencing step, producing a lane per pool, placed in a flowcell
+
+All the entities have udfs, states and modification dates spread over the last DAYS days.
+The udf views are created as tables, along with the udf storage tables used by genologics_sql.queries.
+Foreign keys are not created, as some of the mapped ones cannot be constraints (e.g. sample_udf_view.sampleid).
+
+usage: python benchmarks/fixture.py sqlite:////tmp/genosql_bench.db --artifacts 100000
+"""
+import argparse
+import datetime
+import random
+import time
+
+from sqlalchemy import create_engine, text, Column, Integer, TIMESTAMP, MetaData, Table, Index
+from sqlalchemy.schema import CreateTable
+
+from genologics_sql.tables import *
+
+DAYS=60
+POOL_SIZE=8
+SAMPLES_PER_PROJECT=96
+#original artifact, result file, library, and a share of a pool and of a lane
+ARTIFACTS_PER_SAMPLE=3+2.0/POOL_SIZE
+
+#Process types of the workflow
+SUBMISSION, QC, LIBRARY_PREP, POOLING, SEQUENCING=range(1, 6)
+PROCESS_TYPES={SUBMISSION:"Sample submission", QC:"Fragment Analyzer QC", LIBRARY_PREP:"Library prep",
+        POOLING:"Library pooling", SEQUENCING:"Illumina Sequencing (NovaSeq)"}
+
+#Container types
+TUBE, PLATE, FLOWCELL=range(1, 4)
+
+#Tables of Clarity that are not mapped by genologics_sql.tables, but used by the queries
+storage_metadata=MetaData()
+STORAGE_TABLES=[
+    Table('entityudfstorage', storage_metadata, Column('attachtoid', Integer), Column('attachtoclassid', Integer), Column('lastmodifieddate', TIMESTAMP)),
+    Table('processudfstorage', storage_metadata, Column('processid', Integer), Column('lastmodifieddate', TIMESTAMP)),
+    Table('artifactudfstorage', storage_metadata, Column('artifactid', Integer), Column('lastmodifieddate', TIMESTAMP)),
+    ]
+
+#Indexes of the join and filter columns, as found in Clarity
+INDEXES=[('sample', 'projectid'), ('sample', 'sampleid'), ('project', 'luid'), ('project', 'lastmodifieddate'),
+        ('artifact_sample_map', 'artifactid'), ('artifact_sample_map', 'processid'),
+        ('artifact_ancestor_map', 'artifactid'), ('artifact_ancestor_map', 'ancestorartifactid'),
+        ('processiotracker', 'inputartifactid'), ('processiotracker', 'processid'),
+        ('outputmapping', 'trackerid'), ('outputmapping', 'outputartifactid'),
+        ('artifactstate', 'artifactid'), ('containerplacement', 'processartifactid'), ('containerplacement', 'containerid'),
+        ('process', 'typeid'), ('process', 'lastmodifieddate'), ('artifact', 'lastmodifieddate'), ('container', 'lastmodifieddate'),
+        ('entity_udf_view', 'attachtoid'), ('sample_udf_view', 'sampleid'), ('artifact_udf_view', 'artifactid'), ('process_udf_view', 'processid'),
+        ('entityudfstorage', 'attachtoid'), ('processudfstorage', 'processid'), ('artifactudfstorage', 'artifactid')]
+
+
+class _Writer(object):
+    """Buffers the rows of each table, and inserts them by chunks"""
+
+    def __init__(self, connection, chunk_size):
+        self.connection=connection
+        self.chunk_size=chunk_size
+        self.tables=dict((table.name, table) for table in list(Base.metadata.sorted_tables)+STORAGE_TABLES)
+        self.rows={}
+        self.counts={}
+        self.ids={}
+
+    def next_id(self, table):
+        self.ids[table]=self.ids.get(table, 0)+1
+        return self.ids[table]
+
+    def add(self, _table, **row):
+        rows=self.rows.setdefault(_table, [])
+        rows.append(row)
+        if len(rows) >= self.chunk_size:
+            self.flush(_table)
+
+    def flush(self, name=None):
+        for table in ([name] if name else list(self.rows)):
+            rows=self.rows.pop(table, [])
+            if rows:
+                self.connection.execute(self.tables[table].insert(), rows)
+                self.counts[table]=self.counts.get(table, 0)+len(rows)
+
+
+class _Builder(object):
+
+    def __init__(self, writer, seed):
+        self.w=writer
+        self.random=random.Random(seed)
+        self.now=datetime.datetime.now()
+
+    def date(self):
+        return self.now-datetime.timedelta(seconds=self.random.randint(0, DAYS*24*3600))
+
+    def reference_data(self):
+        w=self.w
+        w.add('lab', labid=1, name="Genomics Platform", lastmodifieddate=self.date())
+        w.add('researcher', researcherid=1, firstname="Lab", lastname="Technician", labid=1, lastmodifieddate=self.date())
+        w.add('principals', principalid=1, username="labtech", researcherid=1, lastmodifieddate=self.date())
+        for typeid, name in PROCESS_TYPES.items():
+            w.add('processtype', typeid=typeid, displayname=name, typename=name, isenabled=True, lastmodifieddate=self.date())
+        for typeid, name, numx, numy, isyalpha in ((TUBE, "Tube", 1, 1, False), (PLATE, "96 well plate", 12, 8, True),
+                (FLOWCELL, "Illumina Flow Cell", 1, 8, False)):
+            w.add('containertype', typeid=typeid, name=name, numxpositions=numx, numypositions=numy, isxalpha=False, isyalpha=isyalpha,
+                    xindexstartsat=1, yindexstartsat=0 if isyalpha else 1, istube=typeid == TUBE, lastmodifieddate=self.date())
+
+    def process(self, typeid, udfs):
+        processid=self.w.next_id('process')
+        date=self.date()
+        self.w.add('process', processid=processid, typeid=typeid, techid=1, daterun=date, luid="24-{}".format(processid),
+                workstatus="COMPLETE", createddate=date, lastmodifieddate=date)
+        self.w.add('processudfstorage', processid=processid, lastmodifieddate=date)
+        for name, kind, value in udfs:
+            self.w.add('process_udf_view', processid=processid, typeid=typeid, udtname='', udfname=name, udftype=kind, udfvalue=str(value), udfunitlabel='')
+        return processid
+
+    def container(self, typeid, name):
+        containerid=self.w.next_id('container')
+        self.w.add('container', containerid=containerid, typeid=typeid, name=name, luid="27-{}".format(containerid), lastmodifieddate=self.date())
+        return containerid
+
+    def artifact(self, name, samples, ancestors, udfs, original=False, placement=None):
+        w=self.w
+        artifactid=w.next_id('artifact')
+        date=self.date()
+        stateid=w.next_id('artifactstate')
+        w.add('artifactstate', stateid=stateid, artifactid=artifactid, qcflag=self.random.choice((0, 1, 1, 1, 2)), lastmodifieddate=date)
+        w.add('artifact', artifactid=artifactid, name=name, luid="2-{}".format(artifactid), isoriginal=original, isworking=True,
+                currentstateid=stateid, createddate=date, lastmodifieddate=date)
+        for sampleid in samples:
+            w.add('artifact_sample_map', artifactid=artifactid, processid=sampleid)
+        for ancestorid in ancestors:
+            w.add('artifact_ancestor_map', artifactid=artifactid, ancestorartifactid=ancestorid)
+        if udfs:
+            w.add('artifactudfstorage', artifactid=artifactid, lastmodifieddate=date)
+        for name, kind, value in udfs:
+            w.add('artifact_udf_view', artifactid=artifactid, udtname='', udfname=name, udftype=kind, udfvalue=str(value), udfunitlabel='')
+        if placement:
+            containerid, x, y=placement
+            w.add('containerplacement', placementid=w.next_id('containerplacement'), containerid=containerid, processartifactid=artifactid,
+                    wellxposition=x, wellyposition=y, lastmodifieddate=date)
+        return artifactid
+
+    def io(self, processid, inputs, outputid):
+        for inputid in inputs:
+            trackerid=self.w.next_id('processiotracker')
+            self.w.add('processiotracker', trackerid=trackerid, processid=processid, inputartifactid=inputid, lastmodifieddate=self.date())
+            self.w.add('outputmapping', mappingid=self.w.next_id('outputmapping'), trackerid=trackerid, outputartifactid=outputid, lastmodifieddate=self.date())
+
+    def project(self, samples_per_project):
+        w=self.w
+        r=self.random
+        projectid=w.next_id('project')
+        date=self.date()
+        name="P{}".format(projectid)
+        w.add('project', projectid=projectid, name=name, luid="P{}".format(projectid), opendate=date, researcherid=1, createddate=date, lastmodifieddate=date)
+        w.add('entityudfstorage', attachtoid=projectid, attachtoclassid=83, lastmodifieddate=date)
+        for udfname, kind, value in (("Sequencing platform", "String", r.choice(("NovaSeq", "MiSeq", "NextSeq"))),
+                ("Reads Min", "Numeric", r.randint(10, 400)), ("Library construction method", "String", r.choice(("TruSeq PCR-free", "SMARTer")))):
+            w.add('entity_udf_view', attachtoid=projectid, attachtoclassid=83, udtname='', udfname=udfname, udftype=kind, udfvalue=str(value), udfunitlabel='')
+
+        originals={}
+        for index in range(samples_per_project):
+            processid=self.process(SUBMISSION, [])
+            sampleid=w.next_id('sample')
+            samplename="{}_{}".format(name, 101+index)
+            w.add('sample', processid=processid, sampleid=sampleid, name=samplename, projectid=projectid, datereceived=self.date())
+            for udfname, kind, value in (("Reads Req", "Numeric", r.randint(10, 100)), ("Sample Type", "String", r.choice(("gDNA", "RNA")))):
+                w.add('sample_udf_view', sampleid=sampleid, udtname='', udfname=udfname, udftype=kind, udfvalue=str(value), udfunitlabel='')
+            tube=self.container(TUBE, samplename)
+            #the artifacts are mapped to the samples by their processid
+            originals[processid]=self.artifact(samplename, [processid], [], [("Conc", "Numeric", round(r.uniform(1, 100), 2))],
+                    original=True, placement=(tube, 0, 0))
+
+        qc=self.process(QC, [("Instrument", "String", "FA-1")])
+        for sampleid, originalid in originals.items():
+            result=self.artifact("QC result", [sampleid], [originalid], [("Concentration", "Numeric", round(r.uniform(1, 100), 2)),
+                    ("RIN", "Numeric", round(r.uniform(1, 10), 1))])
+            self.io(qc, [originalid], result)
+
+        prep=self.process(LIBRARY_PREP, [("Kit lot", "String", r.randint(1000, 9999))])
+        plates=[]
+        libraries=[]
+        for index, (sampleid, originalid) in enumerate(originals.items()):
+            if index % 96 == 0:
+                plates.append(self.container(PLATE, "{}_LIB{}".format(name, len(plates)+1)))
+            position=index % 96
+            library=self.artifact("library", [sampleid], [originalid], [("Size (bp)", "Numeric", r.randint(300, 600)),
+                    ("Concentration", "Numeric", round(r.uniform(1, 20), 2))], placement=(plates[-1], position % 12, position // 12))
+            self.io(prep, [originalid], library)
+            libraries.append((sampleid, originalid, library))
+
+        pooling=self.process(POOLING, [])
+        sequencing=self.process(SEQUENCING, [("Run ID", "String", "{}_A{}".format(date.strftime("%y%m%d"), projectid))])
+        flowcell=None
+        for start in range(0, len(libraries), POOL_SIZE):
+            group=libraries[start:start+POOL_SIZE]
+            samples=[sampleid for sampleid, originalid, library in group]
+            inputs=[library for sampleid, originalid, library in group]
+            ancestors=[originalid for sampleid, originalid, library in group]+inputs
+            pool=self.artifact("pool", samples, ancestors, [("Pool Conc", "Numeric", round(r.uniform(1, 5), 2))])
+            self.io(pooling, inputs, pool)
+            lane_index=(start // POOL_SIZE) % 8
+            if lane_index == 0:
+                flowcell=self.container(FLOWCELL, "{}_FC{}".format(name, start // (POOL_SIZE*8)+1))
+            lane=self.artifact("lane", samples, ancestors+[pool], [("% Bases >=Q30", "Numeric", round(r.uniform(70, 95), 2)),
+                    ("Yield PF (Gb)", "Numeric", round(r.uniform(50, 400), 1))], placement=(flowcell, 0, lane_index))
+            self.io(sequencing, [pool], lane)
+        return projectid
+
+
+def create_schema(engine):
+    """creates the tables of genologics_sql.tables, and the udf storage tables, without foreign keys"""
+    with engine.begin() as connection:
+        for table in list(Base.metadata.sorted_tables)+STORAGE_TABLES:
+            connection.execute(CreateTable(table, include_foreign_key_constraints=[]))
+
+def create_indexes(engine):
+    """creates the indexes of INDEXES, and updates the planner statistics"""
+    tables=dict((table.name, table) for table in list(Base.metadata.sorted_tables)+STORAGE_TABLES)
+    with engine.begin() as connection:
+        for table, column in INDEXES:
+            Index("ix_bench_{}_{}".format(table, column), tables[table].c[column]).create(connection)
+        connection.execute(text("analyze"))
+
+def build(engine, artifacts, samples_per_project=SAMPLES_PER_PROJECT, seed=42, chunk_size=10000):
+    """fills an empty database with a synthetic Clarity dataset
+
+    :param engine: the SQLAlchemy engine of the database, Postgres or SQLite
+    :param artifacts: the approximate number of artifacts to create
+    :param samples_per_project: the number of samples of each project
+    :param seed: the seed of the random values
+    :param chunk_size: the number of rows inserted at a time
+    :returns: dictionnary of table name : number of rows
+    """
+    projects=max(1, int(round(artifacts/(ARTIFACTS_PER_SAMPLE*samples_per_project))))
+    create_schema(engine)
+    with engine.begin() as connection:
+        writer=_Writer(connection, chunk_size)
+        builder=_Builder(writer, seed)
+        builder.reference_data()
+        for index in range(projects):
+            builder.project(samples_per_project)
+        writer.flush()
+    create_indexes(engine)
+    return writer.counts
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dsn', help='database URI of an empty database')
+    parser.add_argument('--artifacts', type=int, default=10000, help='approximate number of artifacts (1000 to 1000000)')
+    parser.add_argument('--samples-per-project', type=int, default=SAMPLES_PER_PROJECT)
+    parser.add_argument('--seed', type=int, default=42)
+    args=parser.parse_args()
+    start=time.time()
+    counts=build(create_engine(args.dsn), args.artifacts, args.samples_per_project, args.seed)
+    for table in sorted(counts):
+        print("{:>24} {:>10}".format(table, counts[table]))
+    print("built in {:.1f}s".format(time.time()-start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+"""Times the functions of genologics_sql.queries and genologics_sql.lineage, the udf_dict access patterns
+and relationship traversals over a synthetic database, and stores the results as JSON.
+
+The database is built with benchmarks/fixture.py when it does not contain the tables yet.
+On SQLite, the queries written for Postgres (intervals, any(), distinct on, recursive lineage) are skipped.
+
+usage: python benchmarks/run.py --artifacts 100000 --output results.json
+       python benchmarks/run.py --dsn postgresql://bench@localhost/genosql_bench --artifacts 1000000 --compare results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import create_engine, func, inspect
+from sqlalchemy.orm import sessionmaker, selectinload
+
+from genologics_sql.tables import *
+from genologics_sql import queries, lineage, export
+
+import fixture
+
+BENCHMARKS=[]
+
+def benchmark(postgres_only=False):
+    """registers a function(session, context) as a benchmark"""
+    def register(function):
+        BENCHMARKS.append((function.__name__, function, postgres_only))
+        return function
+    return register
+
+
+def _context(session):
+    """ids used by the benchmarks, taken from the fixture"""
+    artifacts=[artifactid for artifactid, in session.query(Artifact.artifactid).order_by(Artifact.artifactid).limit(1000)]
+    return {
+        'luids':[luid for luid, in session.query(Project.luid).order_by(Project.projectid).limit(10)],
+        'projectid':session.query(func.min(Project.projectid)).scalar(),
+        'artifacts':artifacts,
+        'lanes':[artifactid for artifactid, in session.query(Artifact.artifactid).filter(Artifact.name == "lane").limit(100)],
+        'originals':[artifactid for artifactid, in session.query(Artifact.artifactid).filter(Artifact.isoriginal == True).limit(100)],
+        'plates':[containerid for containerid, in session.query(Container.containerid).filter(Container.typeid == fixture.PLATE).limit(50)],
+        'prep':session.query(func.min(Process.processid)).filter(Process.typeid == fixture.LIBRARY_PREP).scalar(),
+        'sequencing':session.query(func.min(Process.processid)).filter(Process.typeid == fixture.SEQUENCING).scalar(),
+        }
+
+#queries.py
+
+@benchmark(postgres_only=True)
+def last_modified_projects(session, ctx):
+    return queries.get_last_modified_projects(session, "30 days")
+
+@benchmark(postgres_only=True)
+def last_modified_project_udfs(session, ctx):
+    return queries.get_last_modified_project_udfs(session, "30 days")
+
+@benchmark(postgres_only=True)
+def last_modified_project_sample_udfs(session, ctx):
+    return queries.get_last_modified_project_sample_udfs(session, "30 days")
+
+@benchmark(postgres_only=True)
+def last_modified_project_artifacts(session, ctx):
+    return queries.get_last_modified_project_artifacts(session, "30 days")
+
+@benchmark(postgres_only=True)
+def last_modified_project_artifact_udfs(session, ctx):
+    return queries.get_last_modified_project_artifact_udfs(session, "30 days")
+
+@benchmark(postgres_only=True)
+def last_modified_project_containers(session, ctx):
+    return queries.get_last_modified_project_containers(session, "30 days")
+
+@benchmark(postgres_only=True)
+def last_modified_project_processes(session, ctx):
+    return queries.get_last_modified_project_processes(session, "30 days")
+
+@benchmark(postgres_only=True)
+def last_modified_project_process_udfs(session, ctx):
+    return queries.get_last_modified_project_process_udfs(session, "30 days")
+
+@benchmark(postgres_only=True)
+def last_modified_projectids(session, ctx):
+    return queries.get_last_modified_projectids(session, "30 days")
+
+@benchmark(postgres_only=True)
+def projectids_modified_since(session, ctx):
+    return queries.get_projectids_modified_since(session, datetime.datetime.now()-datetime.timedelta(days=30))[0]
+
+@benchmark(postgres_only=True)
+def last_modified_processes(session, ctx):
+    return queries.get_last_modified_processes(session, [fixture.SEQUENCING], "30 days")
+
+@benchmark(postgres_only=True)
+def processes_in_history(session, ctx):
+    return queries.get_processes_in_history(session, ctx['sequencing'], [fixture.LIBRARY_PREP])
+
+@benchmark(postgres_only=True)
+def children_processes(session, ctx):
+    return queries.get_children_processes(session, ctx['prep'], [fixture.POOLING, fixture.SEQUENCING])
+
+@benchmark(postgres_only=True)
+def qc_flags(session, ctx):
+    return queries.get_qc_flags(session, ctx['artifacts'])
+
+@benchmark()
+def load_udf_dicts(session, ctx):
+    artifacts=session.query(Artifact).filter(Artifact.artifactid.in_(ctx['artifacts'])).all()
+    return queries.load_udf_dicts(session, Artifact, artifacts)
+
+@benchmark()
+def udf_columns(session, ctx):
+    return queries.get_udf_columns(session, Artifact, ["Concentration", "Size (bp)"], ids=ctx['artifacts'])['artifactid']
+
+@benchmark()
+def container_layouts(session, ctx):
+    return queries.get_container_layouts(session, ctx['plates'])
+
+@benchmark()
+def project_tree_plate_layout(session, ctx):
+    return queries.get_project_tree(session, ctx['luids'][0], "plate_layout").samples
+
+@benchmark()
+def project_tree_sample_sheet(session, ctx):
+    return queries.get_project_tree(session, ctx['luids'][0], "sample_sheet").samples
+
+@benchmark()
+def project_tree_qc_summary(session, ctx):
+    return queries.get_project_tree(session, ctx['luids'][0], "qc_summary").samples
+
+#lineage.py
+
+@benchmark(postgres_only=True)
+def ancestors(session, ctx):
+    return lineage.get_ancestors(session, ctx['lanes'])
+
+@benchmark(postgres_only=True)
+def descendants(session, ctx):
+    return lineage.get_descendants(session, ctx['originals'])
+
+@benchmark(postgres_only=True)
+def lineage_graph(session, ctx):
+    graph=lineage.LineageGraph.build(session, ctx['luids'])
+    return [graph.ancestors(lane) for lane in ctx['lanes']]
+
+#udf_dict
+
+@benchmark()
+def udf_dict_lazy(session, ctx):
+    return [artifact.udf_dict for artifact in session.query(Artifact).filter(Artifact.artifactid.in_(ctx['artifacts']))]
+
+@benchmark()
+def udf_dict_bulk(session, ctx):
+    artifacts=session.query(Artifact).filter(Artifact.artifactid.in_(ctx['artifacts'])).all()
+    queries.load_udf_dicts(session, Artifact, artifacts)
+    return [artifact.udf_dict for artifact in artifacts]
+
+@benchmark()
+def udf_dict_cached(session, ctx):
+    artifacts=session.query(Artifact).filter(Artifact.artifactid.in_(ctx['artifacts'])).all()
+    queries.load_udf_dicts(session, Artifact, artifacts)
+    for artifact in artifacts:
+        artifact.udf_dict
+    start=time.time()
+    udf_dicts=[artifact.udf_dict for artifact in artifacts]
+    #only the second access is timed
+    session.info['benchmark_seconds']=time.time()-start
+    return udf_dicts
+
+@benchmark()
+def udf_filter(session, ctx):
+    return session.query(Artifact.artifactid).filter(Artifact.udf("Concentration") > 10).all()
+
+@benchmark()
+def qc_flag_expression(session, ctx):
+    return session.query(Artifact.qc_flag, func.count(Artifact.artifactid)).group_by(Artifact.qc_flag).all()
+
+#relationships
+
+@benchmark()
+def traversal_lazy(session, ctx):
+    project=session.query(Project).get(ctx['projectid'])
+    return [(artifact.containerplacement, artifact.states) for sample in project.samples for artifact in sample.artifacts]
+
+@benchmark()
+def traversal_selectinload(session, ctx):
+    project=session.query(Project).options(selectinload(Project.samples).selectinload(Sample.artifacts)
+            .selectinload(Artifact.containerplacement), selectinload(Project.samples).selectinload(Sample.artifacts)
+            .selectinload(Artifact.states)).get(ctx['projectid'])
+    return [(artifact.containerplacement, artifact.states) for sample in project.samples for artifact in sample.artifacts]
+
+#rows mode
+
+@benchmark()
+def artifacts_orm(session, ctx):
+    return session.query(Artifact).filter(Artifact.artifactid.in_(ctx['artifacts'])).all()
+
+@benchmark()
+def artifacts_rows(session, ctx):
+    return queries.get_rows(session, Artifact, ctx['artifacts'], ['luid', 'name', 'lastmodifieddate'])
+
+@benchmark()
+def project_artifacts_orm(session, ctx):
+    samples=session.query(Sample).options(selectinload(Sample.artifacts)).filter(Sample.projectid == ctx['projectid']).all()
+    return [(sample.name, artifact.luid) for sample in samples for artifact in sample.artifacts]
+
+@benchmark()
+def project_artifacts_rows(session, ctx):
+    samples=queries.get_related_rows(session, Project.samples, [ctx['projectid']], ['processid', 'name'])[ctx['projectid']]
+    artifacts=queries.get_related_rows(session, Sample.artifacts, [sample.processid for sample in samples], ['luid'])
+    return [(sample.name, artifact.luid) for sample in samples for artifact in artifacts[sample.processid]]
+
+@benchmark(postgres_only=True)
+def children_processes_rows(session, ctx):
+    return queries.get_children_processes(session, ctx['prep'], [fixture.POOLING, fixture.SEQUENCING], columns=['luid', 'daterun'])
+
+#export.py
+
+@benchmark()
+def export_parquet(session, ctx):
+    written=export.export_projects(session, [ctx['projectid']], tempfile.mkdtemp())
+    #the size is the number of exported rows
+    return range(sum(rows for path, rows in written.values()))
+
+
+def _size(value):
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+def _median(values):
+    values=sorted(values)
+    middle=len(values)//2
+    return values[middle] if len(values) % 2 else (values[middle-1]+values[middle])/2.0
+
+def run(engine, repeat, names=None):
+    """runs the benchmarks, each in a new session for each repetition
+
+    :param engine: the SQLAlchemy engine of the fixture database
+    :param repeat: the number of runs of each benchmark
+    :param names: if defined, the LIST of benchmarks to run
+    :returns: dictionnary of benchmark name : results
+    """
+    factory=sessionmaker(bind=engine)
+    session=factory()
+    ctx=_context(session)
+    session.close()
+    postgres=engine.dialect.name == 'postgresql'
+    results={}
+    for name, function, postgres_only in BENCHMARKS:
+        if names and name not in names:
+            continue
+        if postgres_only and not postgres:
+            results[name]={'skipped':'postgres only'}
+            continue
+        seconds=[]
+        size=None
+        try:
+            for index in range(repeat):
+                session=factory()
+                start=time.time()
+                value=function(session, ctx)
+                seconds.append(session.info.pop('benchmark_seconds', time.time()-start))
+                size=_size(value)
+                session.close()
+        except Exception as e:
+            session.close()
+            results[name]={'error':"{}: {}".format(type(e).__name__, e)}
+            continue
+        results[name]={'seconds':seconds, 'min':min(seconds), 'median':_median(seconds), 'size':size}
+        if size and results[name]['median']:
+            results[name]['per_second']=size/results[name]['median']
+        print("{:>36} {:>10.4f}s {:>8} {:>10}".format(name, results[name]['median'], size if size is not None else '',
+                "{:.0f}/s".format(results[name]['per_second']) if 'per_second' in results[name] else ''))
+    return results
+
+def _version():
+    try:
+        return subprocess.check_output(["git", "describe", "--tags", "--always", "--dirty"],
+                cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def compare(previous, current):
+    """prints the median time of the benchmarks of both runs, and their ratio"""
+    print("{:>36} {:>11} {:>11} {:>7}".format('', previous['meta'].get('version'), current['meta'].get('version'), 'ratio'))
+    for name, result in current['results'].items():
+        before=previous['results'].get(name, {})
+        if 'median' in result and 'median' in before:
+            print("{:>36} {:>10.4f}s {:>10.4f}s {:>6.2f}x".format(name, before['median'], result['median'], result['median']/before['median']))
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dsn', help='database URI of the fixture. Defaults to a SQLite file in the temporary directory')
+    parser.add_argument('--artifacts', type=int, default=10000, help='approximate number of artifacts of the fixture, when it is built')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of each benchmark')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare to')
+    parser.add_argument('benchmarks', nargs='*', help='names of the benchmarks to run, all of them by default')
+    args=parser.parse_args()
+
+    dsn=args.dsn or "sqlite:///{}".format(os.path.join(tempfile.gettempdir(), "genologics_sql_bench_{}.db".format(args.artifacts)))
+    engine=create_engine(dsn)
+    if not inspect(engine).has_table('project'):
+        start=time.time()
+        fixture.build(engine, args.artifacts)
+        print("fixture of {} artifacts built in {:.1f}s".format(args.artifacts, time.time()-start))
+    with engine.connect() as connection:
+        artifacts=connection.execute(sqlalchemy.text("select count(*) from artifact")).scalar()
+
+    output={'meta':{'version':_version(), 'date':datetime.datetime.now().isoformat(), 'dialect':engine.dialect.name,
+            'artifacts':artifacts, 'repeat':args.repeat, 'python':platform.python_version(), 'sqlalchemy':sqlalchemy.__version__},
+            'results':run(engine, args.repeat, args.benchmarks)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == '__main__':
+    main()
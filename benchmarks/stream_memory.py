@@ -0,0 +1,55 @@
+"""Compares the peak memory of the list-returning and the streaming versions of get_last_modified_processes.
+
+Each version runs in its own process, as the peak resident set size of a process never decreases.
+Requires genologics_sql to be installed, and a configured database (see the README.md).
+
+usage: python benchmarks/stream_memory.py --ptypes 38 714 --interval "30 days"
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+
+def run(mode, ptypes, interval, batch_size):
+    import genologics_sql.utils
+    from genologics_sql import queries
+    session=genologics_sql.utils.get_session()
+    start=time.time()
+    count=0
+    if mode == "list":
+        for process in queries.get_last_modified_processes(session, ptypes, interval):
+            count+=1
+    else:
+        for process in queries.iter_last_modified_processes(session, ptypes, interval, batch_size=batch_size):
+            count+=1
+    elapsed=time.time()-start
+    session.close()
+    #ru_maxrss is in kilobytes on Linux
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'mode':mode, 'rows':count, 'seconds':elapsed, 'peak_rss_kb':peak}))
+
+
+def main():
+    parser=argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ptypes', type=int, nargs='+', required=True, help='process type ids')
+    parser.add_argument('--interval', default='30 days', help='Postgres interval')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows fetched at a time when streaming')
+    parser.add_argument('--mode', choices=['list', 'stream'], help=argparse.SUPPRESS)
+    args=parser.parse_args()
+
+    if args.mode:
+        run(args.mode, args.ptypes, args.interval, args.batch_size)
+        return
+
+    for mode in ('list', 'stream'):
+        command=[sys.executable, __file__, '--mode', mode, '--interval', args.interval,
+                '--batch-size', str(args.batch_size), '--ptypes']+[str(ptype) for ptype in args.ptypes]
+        result=json.loads(subprocess.check_output(command).decode().strip().splitlines()[-1])
+        print("{mode:>8}: {rows} rows in {seconds:.2f}s, peak RSS {peak_rss_kb} kB".format(**result))
+
+
+if __name__ == '__main__':
+    main()
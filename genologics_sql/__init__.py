@@ -1,3 +1,2 @@
-
-import tables
-import queries
+from genologics_sql import tables
+from genologics_sql import queries
@@ -0,0 +1,69 @@
+"""Awaitable versions of the functions of genologics_sql.queries and genologics_sql.lineage.
+
+They take an AsyncSession, as returned by genologics_sql.utils.get_async_session,
+and run the synchronous function in it through AsyncSession.run_sync,
+so that their lazy loads happen while the function runs.
+Each concurrent task should use its own session::
+
+    import asyncio
+    from genologics_sql import aio, queries, utils
+
+    async def project_changes(source):
+        async with utils.get_async_session() as session:
+            return await aio.get_last_modified_projectids(session, "1 day", sources=[source])
+
+    async def main():
+        return await asyncio.gather(*[project_changes(source) for source in queries.PROJECT_CHANGE_SOURCES])
+
+The attributes that were not loaded by the query cannot be lazy loaded from async code afterwards:
+use get_project_tree and its loading profiles, or run_sync with a function doing all the work.
+The iter_* streaming functions have no awaitable version.
+"""
+from genologics_sql import queries
+from genologics_sql import lineage
+
+
+def run_sync(session, function, *args, **kwargs):
+    """runs function(sync_session, *args, **kwargs) in the async session
+
+    :param session: the AsyncSession
+    :param function: the function taking a SQLAlchemy session as first argument
+    :returns: the awaitable result of the function
+    """
+    return session.run_sync(function, *args, **kwargs)
+
+def _awaitable(function):
+    """returns the awaitable version of <function>, which takes a session as first argument"""
+    def wrapper(session, *args, **kwargs):
+        return session.run_sync(function, *args, **kwargs)
+    wrapper.__name__=function.__name__
+    wrapper.__doc__="awaitable version of {}.{}, taking an AsyncSession\n{}".format(function.__module__, function.__name__, function.__doc__ or '')
+    return wrapper
+
+
+get_last_modified_projects=_awaitable(queries.get_last_modified_projects)
+get_last_modified_project_udfs=_awaitable(queries.get_last_modified_project_udfs)
+get_last_modified_project_sample_udfs=_awaitable(queries.get_last_modified_project_sample_udfs)
+get_last_modified_project_artifacts=_awaitable(queries.get_last_modified_project_artifacts)
+get_last_modified_project_artifact_udfs=_awaitable(queries.get_last_modified_project_artifact_udfs)
+get_last_modified_project_containers=_awaitable(queries.get_last_modified_project_containers)
+get_last_modified_project_processes=_awaitable(queries.get_last_modified_project_processes)
+get_last_modified_project_process_udfs=_awaitable(queries.get_last_modified_project_process_udfs)
+get_last_modified_projectids=_awaitable(queries.get_last_modified_projectids)
+get_last_modified_projectids_by_source=_awaitable(queries.get_last_modified_projectids_by_source)
+get_projectids_modified_since=_awaitable(queries.get_projectids_modified_since)
+get_last_modified_processes=_awaitable(queries.get_last_modified_processes)
+get_processes_in_history=_awaitable(queries.get_processes_in_history)
+get_children_processes=_awaitable(queries.get_children_processes)
+load_udf_dicts=_awaitable(queries.load_udf_dicts)
+get_udf_columns=_awaitable(queries.get_udf_columns)
+get_project_tree=_awaitable(queries.get_project_tree)
+get_container_layouts=_awaitable(queries.get_container_layouts)
+get_qc_flags=_awaitable(queries.get_qc_flags)
+get_rows=_awaitable(queries.get_rows)
+get_related_rows=_awaitable(queries.get_related_rows)
+
+get_ancestors=_awaitable(lineage.get_ancestors)
+get_descendants=_awaitable(lineage.get_descendants)
+get_lineage_artifacts=_awaitable(lineage.get_lineage_artifacts)
+get_lineage_processes=_awaitable(lineage.get_lineage_processes)
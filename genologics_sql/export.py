@@ -0,0 +1,220 @@
+"""Columnar export of whole projects to Apache Arrow or Parquet files, which needs pyarrow (pip install pyarrow)::
+
+    from genologics_sql import export, utils
+
+    with utils.readonly_session_scope() as session:
+        export.export_projects(session, [projectid], "/data/exports/P1234", output="parquet")
+
+Each entity kind is written to its own table, in <directory>/<kind>.parquet (or .arrow) :
+
+* projects: the projects
+* samples: the samples of the projects
+* artifacts: the artifacts of the samples, with their container, well ("A:1") and qc flag
+* artifact_samples: the artifactid, processid (sample id) pairs linking the artifacts to their samples
+
+The udfs of projects, samples and artifacts are pivoted into one column per udf name, named "udf.<name>" and typed
+according to the udf type : Numeric as float64, Boolean as bool, others as strings.
+Udfs stored with several types are exported as strings.
+
+The rows are read with a server-side cursor and converted to record batches of batch_size rows,
+so that the memory used does not depend on the size of the projects.
+"""
+import os
+
+from collections import OrderedDict
+from sqlalchemy import select, Boolean, Integer, Float, TIMESTAMP
+
+from genologics_sql.tables import *
+from genologics_sql.queries import get_container_layouts, _udf_pivot, _udf_value
+
+UDF_PREFIX="udf."
+
+OUTPUTS={'parquet':'.parquet', 'arrow':'.arrow'}
+"""Supported output formats, and the extension of their files"""
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise Exception("The export requires pyarrow to be installed.")
+    return pyarrow
+
+def _arrow_type(pyarrow, sqltype):
+    """returns the arrow type of a SQLAlchemy column type"""
+    if isinstance(sqltype, Boolean):
+        return pyarrow.bool_()
+    elif isinstance(sqltype, Integer):
+        return pyarrow.int64()
+    elif isinstance(sqltype, Float):
+        return pyarrow.float64()
+    elif isinstance(sqltype, TIMESTAMP):
+        return pyarrow.timestamp('us')
+    return pyarrow.string()
+
+def _udf_type(pyarrow, udftypes):
+    """returns the udf type a udf column is converted to (None for the raw strings) and its arrow type, from the set of its udf types"""
+    if len(udftypes) == 1:
+        udftype=next(iter(udftypes))
+        if udftype == "Numeric":
+            return udftype, pyarrow.float64()
+        elif udftype == "Boolean":
+            return udftype, pyarrow.bool_()
+    return None, pyarrow.string()
+
+
+def _artifactids(projectids):
+    """select of the ids of the artifacts of the samples of the projects"""
+    return select([artifact_sample_map.c.artifactid])\
+            .select_from(artifact_sample_map.join(Sample.__table__, artifact_sample_map.c.processid==Sample.processid))\
+            .where(Sample.projectid.in_(projectids))
+
+def _projects(projectids):
+    statement=select([Project.projectid, Project.luid, Project.name, Project.opendate, Project.closedate, Project.invoicedate,
+                Project.researcherid, Project.priority, Project.createddate, Project.lastmodifieddate])\
+            .where(Project.projectid.in_(projectids)).order_by(Project.projectid)
+    return statement, list(projectids)
+
+def _samples(projectids):
+    statement=select([Sample.processid, Sample.sampleid, Sample.name, Sample.projectid, Sample.datereceived, Sample.datecompleted,
+                Sample.controltypeid])\
+            .where(Sample.projectid.in_(projectids)).order_by(Sample.processid)
+    return statement, select([Sample.sampleid]).where(Sample.projectid.in_(projectids))
+
+def _artifacts(projectids):
+    statement=select([Artifact.artifactid, Artifact.luid, Artifact.name, Artifact.volume, Artifact.concentration,
+                Artifact.isworking, Artifact.isoriginal, Artifact.artifacttypeid, Artifact.processoutputtypeid,
+                Artifact.createddate, Artifact.lastmodifieddate, Artifact.qc_flag.label('qc_flag'),
+                ContainerPlacement.containerid, Container.name.label('container_name')])\
+            .select_from(Artifact.__table__.outerjoin(ContainerPlacement.__table__, ContainerPlacement.processartifactid==Artifact.artifactid)
+                .outerjoin(Container.__table__, Container.containerid==ContainerPlacement.containerid))\
+            .where(Artifact.artifactid.in_(_artifactids(projectids))).order_by(Artifact.artifactid)
+    return statement, _artifactids(projectids)
+
+def _artifact_samples(projectids):
+    statement=select([artifact_sample_map.c.artifactid, artifact_sample_map.c.processid])\
+            .select_from(artifact_sample_map.join(Sample.__table__, artifact_sample_map.c.processid==Sample.processid))\
+            .where(Sample.projectid.in_(projectids)).order_by(artifact_sample_map.c.artifactid)
+    return statement, None
+
+#kind : (function returning the select of the rows and the ids of their udfs, entity class of the udfs or None)
+KINDS=OrderedDict([
+    ('projects',            (_projects, Project)),
+    ('samples',             (_samples, Sample)),
+    ('artifacts',           (_artifacts, Artifact)),
+    ('artifact_samples',    (_artifact_samples, None)),
+    ])
+"""Exported entity kinds"""
+
+
+def _udf_types(session, entity_class, ids):
+    """returns an OrderedDict of udfname : set of udf types, of the udfs of the entities, in a single query"""
+    view, view_key, entity_key, classid=UDF_VIEWS[entity_class]
+    query=session.query(view.udfname, view.udftype).filter(getattr(view, view_key).in_(ids))
+    if classid is not None:
+        query=query.filter(view.attachtoclassid==classid)
+    udftypes=OrderedDict()
+    for udfname, udftype in query.distinct().order_by(view.udfname):
+        udftypes.setdefault(udfname, set()).add(udftype)
+    return udftypes
+
+def _udf_arrays(pyarrow, session, entity_class, udfnames, udftypes, udffields, ids):
+    """returns the arrays of the udfs of the entities <ids>, in the same order.
+    The columns exported as strings keep the raw udf values."""
+    rows=dict((row[0], row) for row in _udf_pivot(session, entity_class, udfnames, ids=list(set(ids))))
+    arrays=[]
+    for idx, (udftype, field) in enumerate(zip(udftypes, udffields)):
+        values=[rows[entityid][1+2*idx] if entityid in rows else None for entityid in ids]
+        arrays.append(pyarrow.array([_udf_value(value, udftype) for value in values], type=field.type))
+    return arrays
+
+def _wells(session, containerids):
+    """returns dictionnary of artifactid : well position string of the artifacts placed in the containers"""
+    wells={}
+    for layout in get_container_layouts(session, containerids).values():
+        for position, artifactid in layout.wells.items():
+            wells[artifactid]=position
+    return wells
+
+def record_batches(session, kind, projectids, batch_size=10000):
+    """gets the schema of a table of the export, and the record batches of its rows
+
+    :param session: the current SQLAlchemy session to the db
+    :param kind: the entity kind, one of KINDS
+    :param projectids: the LIST of (short) project ids
+    :param batch_size: the number of rows fetched from the server, and converted, at a time
+    :returns: a tuple (pyarrow Schema, generator of pyarrow RecordBatch)
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown kind {}, valid kinds are {}".format(kind, ", ".join(KINDS)))
+    pyarrow=_pyarrow()
+    build, entity_class=KINDS[kind]
+    statement, udfids=build(list(projectids))
+    fields=[pyarrow.field(column.name, _arrow_type(pyarrow, column.type)) for column in statement.selected_columns]
+    if kind == 'artifacts':
+        fields.append(pyarrow.field('well', pyarrow.string()))
+    udfnames=[]
+    udftypes=[]
+    udffields=[]
+    if entity_class is not None:
+        for udfname, types in _udf_types(session, entity_class, udfids).items():
+            udftype, arrow_type=_udf_type(pyarrow, types)
+            udfnames.append(udfname)
+            udftypes.append(udftype)
+            udffields.append(pyarrow.field(UDF_PREFIX+udfname, arrow_type))
+    schema=pyarrow.schema(fields+udffields)
+    return schema, _batches(pyarrow, session, kind, statement, entity_class, udfnames, udftypes, udffields, schema, batch_size)
+
+def _batches(pyarrow, session, kind, statement, entity_class, udfnames, udftypes, udffields, schema, batch_size):
+    result=session.execute(statement.execution_options(stream_results=True))
+    keys=list(result.keys())
+    for rows in result.partitions(batch_size):
+        columns=list(zip(*rows))
+        arrays=[pyarrow.array(list(values), type=field.type) for values, field in zip(columns, schema)]
+        if kind == 'artifacts':
+            containerids=set(containerid for containerid in columns[keys.index('containerid')] if containerid is not None)
+            wells=_wells(session, containerids)
+            arrays.append(pyarrow.array([wells.get(artifactid) for artifactid in columns[0]], type=pyarrow.string()))
+        if udfnames:
+            ids=columns[keys.index(UDF_VIEWS[entity_class][2])]
+            arrays.extend(_udf_arrays(pyarrow, session, entity_class, udfnames, udftypes, udffields, ids))
+        yield pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+def export_projects(session, projectids, directory, output="parquet", kinds=None, batch_size=10000):
+    """writes the tables of the export of projects to a directory, in bounded memory
+
+    :param session: the current SQLAlchemy session to the db. A read only session (see utils.get_readonly_session)
+        makes all the tables consistent.
+    :param projectids: the LIST of (short) project ids
+    :param directory: the directory the files are written to. It is created if needed.
+    :param output: "parquet" or "arrow" (Arrow IPC file format)
+    :param kinds: the LIST of entity kinds to export, all of KINDS by default
+    :param batch_size: the number of rows fetched from the server, and written, at a time
+    :returns: dictionnary of kind : (path of the file, number of rows)
+    """
+    if output not in OUTPUTS:
+        raise ValueError("Unknown output {}, valid outputs are {}".format(output, ", ".join(sorted(OUTPUTS))))
+    pyarrow=_pyarrow()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    written={}
+    for kind in kinds or KINDS:
+        schema, batches=record_batches(session, kind, projectids, batch_size)
+        path=os.path.join(directory, kind+OUTPUTS[output])
+        if output == "parquet":
+            import pyarrow.parquet
+            writer=pyarrow.parquet.ParquetWriter(path, schema)
+            write=lambda batch:writer.write_table(pyarrow.Table.from_batches([batch], schema=schema))
+        else:
+            import pyarrow.ipc
+            writer=pyarrow.ipc.new_file(path, schema)
+            write=writer.write_batch
+        rows=0
+        try:
+            for batch in batches:
+                write(batch)
+                rows+=batch.num_rows
+        finally:
+            writer.close()
+        written[kind]=(path, rows)
+    return written
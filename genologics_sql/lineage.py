@@ -0,0 +1,403 @@
+from genologics_sql.tables import *
+
+from sqlalchemy import text
+
+from genologics_sql.queries import get_rows
+
+from array import array
+from collections import namedtuple, deque
+
+#Module used to trace artifacts through the processes, following processiotracker and outputmapping
+
+LineageStep=namedtuple('LineageStep', ['artifactid', 'processid', 'depth'])
+"""One artifact found in the lineage of another.
+
+For ancestors, processid is the process that used the artifact as an input.
+For descendants, processid is the process that produced the artifact.
+depth is the number of processes between the artifact and the starting artifacts.
+"""
+
+MAX_DEPTH=100
+"""Depth at which traversals stop when no max_depth is given"""
+
+#{start} selects the first hop from the starting artifacts, {step} the next hops from the lineage rows
+LINEAGE_QUERY="with recursive lineage(artifactid, processid, depth) as ( \
+            {start} \
+        union \
+            {step} \
+            where lin.depth < :max_depth \
+        ) \
+        select lin.artifactid, lin.processid, min(lin.depth) from lineage lin {joins} \
+        where true {filters} \
+        group by lin.artifactid, lin.processid \
+        order by 3, 1;"
+
+ANCESTORS_START="select pio.inputartifactid, pio.processid, 1 from outputmapping om \
+            inner join processiotracker pio on pio.trackerid=om.trackerid \
+            where om.outputartifactid = any(:artifactids)"
+
+ANCESTORS_STEP="select pio.inputartifactid, pio.processid, lin.depth+1 from lineage lin \
+            inner join outputmapping om on om.outputartifactid=lin.artifactid \
+            inner join processiotracker pio on pio.trackerid=om.trackerid"
+
+DESCENDANTS_START="select om.outputartifactid, pio.processid, 1 from processiotracker pio \
+            inner join outputmapping om on om.trackerid=pio.trackerid \
+            where pio.inputartifactid = any(:artifactids)"
+
+DESCENDANTS_STEP="select om.outputartifactid, pio.processid, lin.depth+1 from lineage lin \
+            inner join processiotracker pio on pio.inputartifactid=lin.artifactid \
+            inner join outputmapping om on om.trackerid=pio.trackerid"
+
+_STATEMENTS={}
+
+def _max_depth(max_depth):
+    """returns the depth a traversal stops at, MAX_DEPTH if max_depth is None"""
+    if max_depth is None:
+        return MAX_DEPTH
+    if max_depth < 0:
+        raise ValueError("max_depth should be positive, not {}".format(max_depth))
+    return max_depth
+
+def _lineage_statement(ancestors, ptypes, sample):
+    """builds (once) the recursive statement for the given direction and filters
+
+    :param ancestors: True to go up the lineage, False to go down
+    :param ptypes: True if the statement filters on process types
+    :param sample: True if the statement filters on a sample
+    :returns: the textual SQLAlchemy statement
+    """
+    key=(ancestors, ptypes, sample)
+    if key not in _STATEMENTS:
+        joins=[]
+        filters=[]
+        if ptypes:
+            joins.append("inner join process pro on pro.processid=lin.processid")
+            filters.append("and pro.typeid = any(:ptypes)")
+        if sample:
+            joins.append("inner join artifact_sample_map asm on asm.artifactid=lin.artifactid")
+            filters.append("and asm.processid = :sample")
+        query=LINEAGE_QUERY.format(start=ANCESTORS_START if ancestors else DESCENDANTS_START,
+                step=ANCESTORS_STEP if ancestors else DESCENDANTS_STEP,
+                joins=" ".join(joins), filters=" ".join(filters))
+        _STATEMENTS[key]=text(query)
+    return _STATEMENTS[key]
+
+def _traverse(session, ancestors, artifactids, max_depth, ptypes, sample):
+    if isinstance(artifactids, int):
+        artifactids=[artifactids]
+    max_depth=_max_depth(max_depth)
+    if max_depth == 0:
+        #the first hop of the recursive query is not limited by max_depth
+        return []
+    statement=_lineage_statement(ancestors, ptypes is not None, sample is not None)
+    params={'artifactids':list(artifactids), 'max_depth':max_depth,
+            'ptypes':list(ptypes or []), 'sample':sample}
+    return [LineageStep(*row) for row in session.execute(statement, params)]
+
+def get_ancestors(session, artifactids, max_depth=None, ptypes=None, sample=None):
+    """gets all the artifacts upstream of the given artifacts, in a single recursive query
+
+    :param session: the current SQLAlchemy session to the db
+    :param artifactids: the (short) id, or LIST of ids, of the starting artifacts
+    :param max_depth: the maximum number of processes to go through. Defaults to MAX_DEPTH.
+    :param ptypes: if defined, the LIST of process type ids to be returned. The traversal still goes through the other processes.
+    :param sample: if defined, the processid of the sample the returned artifacts must contain
+    :returns: List of LineageStep(artifactid, processid, depth), ordered by depth
+
+    """
+    return _traverse(session, True, artifactids, max_depth, ptypes, sample)
+
+def get_descendants(session, artifactids, max_depth=None, ptypes=None, sample=None):
+    """gets all the artifacts downstream of the given artifacts, in a single recursive query
+
+    :param session: the current SQLAlchemy session to the db
+    :param artifactids: the (short) id, or LIST of ids, of the starting artifacts
+    :param max_depth: the maximum number of processes to go through. Defaults to MAX_DEPTH.
+    :param ptypes: if defined, the LIST of process type ids to be returned. The traversal still goes through the other processes.
+    :param sample: if defined, the processid of the sample the returned artifacts must contain
+    :returns: List of LineageStep(artifactid, processid, depth), ordered by depth
+
+    """
+    return _traverse(session, False, artifactids, max_depth, ptypes, sample)
+
+def get_lineage_artifacts(session, steps, columns=None):
+    """loads the Artifact rows of lineage steps
+
+    :param session: the current SQLAlchemy session to the db
+    :param steps: the LIST of LineageStep, as returned by get_ancestors or get_descendants
+    :param columns: if defined, the LIST of Artifact columns to return as records instead of Artifact objects, see queries.row_record
+    :returns: dictionnary of artifactid : Artifact
+    """
+    artifactids=list(set(step.artifactid for step in steps))
+    if not artifactids:
+        return {}
+    if columns is not None:
+        return get_rows(session, Artifact, artifactids, columns)
+    return dict((art.artifactid, art) for art in session.query(Artifact).filter(Artifact.artifactid.in_(artifactids)))
+
+def get_lineage_processes(session, steps, columns=None):
+    """loads the Process rows of lineage steps
+
+    :param session: the current SQLAlchemy session to the db
+    :param steps: the LIST of LineageStep, as returned by get_ancestors or get_descendants
+    :param columns: if defined, the LIST of Process columns to return as records instead of Process objects, see queries.row_record
+    :returns: dictionnary of processid : Process
+    """
+    processids=list(set(step.processid for step in steps))
+    if not processids:
+        return {}
+    if columns is not None:
+        return get_rows(session, Process, processids, columns)
+    return dict((pro.processid, pro) for pro in session.query(Process).filter(Process.processid.in_(processids)))
+
+
+GRAPH_EDGES_QUERY="select pio.inputartifactid, om.outputartifactid, pio.processid, pro.typeid, \
+            greatest(pio.lastmodifieddate, om.lastmodifieddate) from processiotracker pio \
+            inner join outputmapping om on om.trackerid=pio.trackerid \
+            inner join process pro on pro.processid=pio.processid \
+            where pio.inputartifactid in (select asm.artifactid from artifact_sample_map asm \
+                inner join sample sa on sa.processid=asm.processid \
+                inner join project pj on pj.projectid=sa.projectid \
+                where pj.luid = any(:projectids)) {since};"
+
+GRAPH_SAMPLES_QUERY="select asm.artifactid, asm.processid from artifact_sample_map asm \
+            where asm.artifactid = any(:artifactids);"
+
+#artifact_sample_map has no modification date, the links of the artifacts modified since the watermark are read again
+GRAPH_CHANGED_SAMPLES_QUERY="select asm.artifactid, asm.processid from artifact_sample_map asm \
+            inner join artifact art on art.artifactid=asm.artifactid \
+            where art.lastmodifieddate > :since and asm.artifactid in (select asm2.artifactid from artifact_sample_map asm2 \
+                inner join sample sa on sa.processid=asm2.processid \
+                inner join project pj on pj.projectid=sa.projectid \
+                where pj.luid = any(:projectids));"
+
+REINDEX_FRACTION=0.1
+"""Share of the edges added since the last index build above which the index is built again"""
+
+
+def _csr(keys, size):
+    """builds a compressed sparse row index of the edges
+
+    :param keys: array of the node index each edge is attached to
+    :param size: the number of nodes
+    :returns: a tuple (pointers, edges). The edges of node i are edges[pointers[i]:pointers[i+1]]
+    """
+    counts=[0]*(size+1)
+    for key in keys:
+        counts[key+1]+=1
+    for idx in range(size):
+        counts[idx+1]+=counts[idx]
+    pointers=array('l', counts)
+    edges=array('l', [0])*len(keys)
+    fill=counts[:-1]
+    for edge, key in enumerate(keys):
+        edges[fill[key]]=edge
+        fill[key]+=1
+    return pointers, edges
+
+
+class LineageGraph(object):
+    """In-memory index of the lineage of the artifacts of some projects, for repeated lookups without round-trips.
+
+    The edges (input artifact, output artifact, process) are stored in integer arrays,
+    with compressed sparse row indexes in both directions.
+    Build it with LineageGraph.build(session, projectids), and keep it up to date with refresh(session),
+    which only reads the rows modified since the last build or refresh.
+    The new edges are kept in per-artifact lists next to the indexes, which are only built again
+    once these lists hold REINDEX_FRACTION of the edges, so that a refresh costs O(new edges).
+    The sample links of the artifacts modified since the last refresh are read again.
+    Deleted rows are not detected by refresh, build a new graph to take them into account.
+
+    :arg LIST projectids: the project luids indexed by the graph
+    :arg DATETIME watermark: the latest modification date of the rows read
+    :arg DICT process_types: processid : process type id
+    :arg DICT artifact_samples: artifactid : tuple of the sample processids contained in that artifact
+    """
+
+    def __init__(self, projectids=None):
+        self.projectids=list(projectids or [])
+        self.watermark=None
+        self.process_types={}
+        self.artifact_samples={}
+        self._nodes={}
+        self._artifactids=array('l')
+        self._inputs=array('l')
+        self._outputs=array('l')
+        self._processes=array('l')
+        self._known=set()
+        self._index()
+
+    @classmethod
+    def build(cls, session, projectids):
+        """reads the lineage of the given projects from the database
+
+        :param session: the current SQLAlchemy session to the db
+        :param projectids: the LIST of project luids, as returned by get_last_modified_projectids
+        :returns: the LineageGraph
+        """
+        graph=cls(projectids)
+        graph.refresh(session)
+        return graph
+
+    @classmethod
+    def from_edges(cls, edges, samples=None):
+        """builds a graph from already fetched rows
+
+        :param edges: iterable of (inputartifactid, outputartifactid, processid, process typeid) tuples
+        :param samples: iterable of (artifactid, sample processid) tuples
+        :returns: the LineageGraph
+        """
+        graph=cls()
+        graph._add(edges, samples or [])
+        return graph
+
+    def refresh(self, session):
+        """reads the edges modified since the last refresh, the samples of the new artifacts,
+        and the samples of the artifacts modified since the last refresh
+
+        :param session: the current SQLAlchemy session to the db
+        :returns: the number of edges read
+        """
+        since=""
+        if self.watermark is not None:
+            since="and (pio.lastmodifieddate > :since or om.lastmodifieddate > :since)"
+        rows=session.execute(text(GRAPH_EDGES_QUERY.format(since=since)),
+                {'projectids':self.projectids, 'since':self.watermark}).fetchall()
+        samples=[]
+        if self.watermark is not None:
+            samples=session.execute(text(GRAPH_CHANGED_SAMPLES_QUERY),
+                    {'projectids':self.projectids, 'since':self.watermark}).fetchall()
+        read=set(artifactid for artifactid, sampleid in samples)
+        new_artifacts=set()
+        for row in rows:
+            for artifactid in row[0:2]:
+                if artifactid not in self.artifact_samples and artifactid not in read:
+                    new_artifacts.add(artifactid)
+            if row[4] is not None and (self.watermark is None or row[4] > self.watermark):
+                self.watermark=row[4]
+        if new_artifacts:
+            samples+=session.execute(text(GRAPH_SAMPLES_QUERY), {'artifactids':list(new_artifacts)}).fetchall()
+        #the links read replace the known ones
+        for artifactid in read:
+            self.artifact_samples.pop(artifactid, None)
+        self._add([row[0:4] for row in rows], samples)
+        return len(rows)
+
+    def _node(self, artifactid):
+        node=self._nodes.get(artifactid)
+        if node is None:
+            node=len(self._artifactids)
+            self._nodes[artifactid]=node
+            self._artifactids.append(artifactid)
+        return node
+
+    def _add(self, edges, samples):
+        known=self._known
+        for inputid, outputid, processid, typeid in edges:
+            self.process_types[processid]=typeid
+            edge=(self._node(inputid), self._node(outputid), processid)
+            if edge not in known:
+                known.add(edge)
+                self._recent_down.setdefault(edge[0], []).append(len(self._inputs))
+                self._recent_up.setdefault(edge[1], []).append(len(self._inputs))
+                self._inputs.append(edge[0])
+                self._outputs.append(edge[1])
+                self._processes.append(processid)
+        for artifactid, sampleid in samples:
+            current=self.artifact_samples.get(artifactid, ())
+            if sampleid not in current:
+                self.artifact_samples[artifactid]=current+(sampleid,)
+        if len(self._inputs)-self._indexed > REINDEX_FRACTION*self._indexed:
+            self._index()
+
+    def _index(self):
+        """builds the indexes of all the edges"""
+        size=len(self._artifactids)
+        self._down_pointers, self._down_edges=_csr(self._inputs, size)
+        self._up_pointers, self._up_edges=_csr(self._outputs, size)
+        self._indexed=len(self._inputs)
+        #node : edges added since the indexes were built
+        self._recent_down={}
+        self._recent_up={}
+
+    def _edges(self, node, ancestors):
+        """returns the edges of a node, from the indexes and the recent edges"""
+        if ancestors:
+            pointers, edges, recent=self._up_pointers, self._up_edges, self._recent_up
+        else:
+            pointers, edges, recent=self._down_pointers, self._down_edges, self._recent_down
+        indexed=edges[pointers[node]:pointers[node+1]] if node+1 < len(pointers) else ()
+        return list(indexed)+recent.get(node, [])
+
+    def _traverse(self, artifactids, ancestors, max_depth):
+        if isinstance(artifactids, int):
+            artifactids=[artifactids]
+        neighbours=self._inputs if ancestors else self._outputs
+        max_depth=_max_depth(max_depth)
+        queue=deque((self._nodes[artifactid], 0) for artifactid in artifactids if artifactid in self._nodes)
+        expanded=set(node for node, depth in queue)
+        steps={}
+        while queue:
+            node, depth=queue.popleft()
+            if depth >= max_depth:
+                continue
+            for edge in self._edges(node, ancestors):
+                neighbour=neighbours[edge]
+                key=(self._artifactids[neighbour], self._processes[edge])
+                if key not in steps:
+                    steps[key]=LineageStep(key[0], key[1], depth+1)
+                if neighbour not in expanded:
+                    expanded.add(neighbour)
+                    queue.append((neighbour, depth+1))
+        return sorted(steps.values(), key=lambda step: (step.depth, step.artifactid))
+
+    def _filter(self, steps, ptypes, sample):
+        if ptypes is not None:
+            ptypes=set(ptypes)
+            steps=[step for step in steps if self.process_types.get(step.processid) in ptypes]
+        if sample is not None:
+            steps=[step for step in steps if sample in self.artifact_samples.get(step.artifactid, ())]
+        return steps
+
+    def ancestors(self, artifactids, max_depth=None, ptypes=None, sample=None):
+        """same as get_ancestors, answered from memory
+
+        :param artifactids: the (short) id, or LIST of ids, of the starting artifacts
+        :param max_depth: the maximum number of processes to go through. Defaults to MAX_DEPTH.
+        :param ptypes: if defined, the LIST of process type ids to be returned.
+        :param sample: if defined, the processid of the sample the returned artifacts must contain
+        :returns: List of LineageStep(artifactid, processid, depth), ordered by depth
+        """
+        return self._filter(self._traverse(artifactids, True, max_depth), ptypes, sample)
+
+    def descendants(self, artifactids, max_depth=None, ptypes=None, sample=None):
+        """same as get_descendants, answered from memory
+
+        :param artifactids: the (short) id, or LIST of ids, of the starting artifacts
+        :param max_depth: the maximum number of processes to go through. Defaults to MAX_DEPTH.
+        :param ptypes: if defined, the LIST of process type ids to be returned.
+        :param sample: if defined, the processid of the sample the returned artifacts must contain
+        :returns: List of LineageStep(artifactid, processid, depth), ordered by depth
+        """
+        return self._filter(self._traverse(artifactids, False, max_depth), ptypes, sample)
+
+    def processes(self, artifactids, ptypes, ancestors=True, sample=None):
+        """gets the processes of the given types found in the lineage of the given artifacts
+
+        :param artifactids: the (short) id, or LIST of ids, of the starting artifacts
+        :param ptypes: the LIST of process type ids to be returned
+        :param ancestors: True to look upstream, False to look downstream
+        :param sample: if defined, only consider the artifacts containing that sample
+        :returns: List of processids, the closest first
+        """
+        processids=[]
+        for step in self._filter(self._traverse(artifactids, ancestors, None), ptypes, sample):
+            if step.processid not in processids:
+                processids.append(step.processid)
+        return processids
+
+    def __len__(self):
+        return len(self._processes)
+
+    def __repr__(self):
+        return "<LineageGraph(projects={}, artifacts={}, edges={})>".format(len(self.projectids), len(self._artifactids), len(self._processes))
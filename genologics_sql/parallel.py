@@ -0,0 +1,255 @@
+"""Runs a function over many projects in parallel, each worker thread using its own session::
+
+    from genologics_sql import parallel, queries, utils
+
+    def report(session, projectid):
+        project=session.query(Project).filter(Project.projectid == projectid).one()
+        return len(project.samples)
+
+    with utils.session_scope() as session:
+        projectids=queries.get_last_modified_projectids(session, "1 day")
+    result=parallel.run_per_project(projectids, report, workers=8, task_timeout=300)
+    print(result)
+
+The projectids can be of any type, as they are only given back to the function.
+The number of workers should not exceed the pool_size + max_overflow of the configuration.
+
+task_timeout limits the wall-clock duration of each task : when it is reached, the running statement of the task
+is cancelled, and the task cannot run new ones on the connection it started with (a task which commits may be given another one). statement_timeout limits each statement of a task on the Postgres side,
+so that a task running many short statements is not stopped by it.
+"""
+import threading
+import time
+
+from collections import deque
+from sqlalchemy import event, text
+
+#SQLSTATE of the queries cancelled by statement_timeout
+QUERY_CANCELED='57014'
+
+#key of the deadline of the task in the info of the DBAPI connection record
+DEADLINE_KEY='genologics_sql_task_deadline'
+
+#engine : number of workers watching its connections
+_WATCHED={}
+_WATCHED_LOCK=threading.Lock()
+
+
+class TaskTimeout(Exception):
+    """Raised when a task which exceeded its task_timeout runs a new statement"""
+    pass
+
+
+class FanOutResult(object):
+    """Outcome of run_per_project
+
+    :arg dict results: projectid : value returned by the function
+    :arg dict errors: projectid : exception raised by the function
+    :arg list timeouts: projectids whose task exceeded task_timeout, or had a statement cancelled by statement_timeout
+    :arg list skipped: projectids whose task was not started before the overall timeout
+    :arg FLOAT elapsed: duration of the run, in seconds
+    """
+
+    def __init__(self):
+        self.results={}
+        self.errors={}
+        self.timeouts=[]
+        self.skipped=[]
+        self.elapsed=0.0
+
+    @property
+    def completed(self):
+        """number of tasks that ran, successfully or not"""
+        return len(self.results)+len(self.errors)+len(self.timeouts)
+
+    @property
+    def throughput(self):
+        """completed tasks per second"""
+        if not self.elapsed:
+            return 0.0
+        return self.completed/self.elapsed
+
+    def __repr__(self):
+        return "<FanOutResult(ok={}, errors={}, timeouts={}, skipped={}, elapsed={:.2f}s, throughput={:.2f}/s)>".format(
+                len(self.results), len(self.errors), len(self.timeouts), len(self.skipped), self.elapsed, self.throughput)
+
+
+def _is_timeout(error):
+    """returns True if the exception comes from a query cancelled by Postgres"""
+    return getattr(getattr(error, 'orig', None), 'pgcode', None) == QUERY_CANCELED
+
+def _set_statement_timeout(session, statement_timeout):
+    """sets the statement_timeout of the current transaction of the session"""
+    session.execute(text("select set_config('statement_timeout', :timeout, true)"),
+            {'timeout':str(int(statement_timeout*1000))})
+
+def _refuse_after_deadline(conn, cursor, statement, parameters, context, executemany):
+    deadline=conn.info.get(DEADLINE_KEY)
+    if deadline is not None and time.time() > deadline:
+        raise TaskTimeout("The task exceeded its task_timeout, it cannot run new statements.")
+
+def _watch(engine):
+    """refuses the statements of the expired tasks on the engine, until _unwatch is called as many times"""
+    with _WATCHED_LOCK:
+        if not _WATCHED.get(engine):
+            event.listen(engine, 'before_cursor_execute', _refuse_after_deadline)
+        _WATCHED[engine]=_WATCHED.get(engine, 0)+1
+
+def _unwatch(engine):
+    with _WATCHED_LOCK:
+        _WATCHED[engine]-=1
+        if not _WATCHED[engine]:
+            del _WATCHED[engine]
+            event.remove(engine, 'before_cursor_execute', _refuse_after_deadline)
+
+
+class _Watchdog(object):
+    """cancels the running statement of a connection once the task using it exceeds its task_timeout,
+    and makes the connection refuse new statements.
+    The DBAPI connection and its record are kept, as the task can commit or close the SQLAlchemy connection.
+
+    :param connection: the SQLAlchemy connection of the task
+    :param task_timeout: the number of seconds the task can run for
+    """
+
+    def __init__(self, connection, task_timeout):
+        self.dbapi_connection=connection.connection.dbapi_connection
+        self.info=connection.connection.info
+        self.deadline=time.time()+task_timeout
+        self.expired=False
+        self.done=False
+        self.lock=threading.Lock()
+        self.info[DEADLINE_KEY]=self.deadline
+        self.timer=threading.Timer(task_timeout, self._expire)
+        self.timer.daemon=True
+        self.timer.start()
+
+    def _expire(self):
+        with self.lock:
+            if self.done:
+                return
+            self.expired=True
+            #the connection went back to the pool and was taken by another task
+            if self.info.get(DEADLINE_KEY) != self.deadline:
+                return
+            #psycopg2 connections cancel their running query, sqlite3 ones interrupt it
+            cancel=getattr(self.dbapi_connection, 'cancel', None) or getattr(self.dbapi_connection, 'interrupt', None)
+            if cancel is not None:
+                try:
+                    cancel()
+                except Exception:
+                    pass
+
+    def stop(self):
+        """stops watching the task, and returns True if it exceeded its task_timeout"""
+        with self.lock:
+            self.done=True
+            if self.info.get(DEADLINE_KEY) == self.deadline:
+                del self.info[DEADLINE_KEY]
+        self.timer.cancel()
+        return self.expired
+
+def _worker(tasks, function, session_factory, task_timeout, statement_timeout, deadline, result, lock):
+    session=session_factory()
+    engine=None
+    if task_timeout:
+        engine=session.get_bind()
+        _watch(engine)
+    try:
+        while True:
+            with lock:
+                if not tasks:
+                    return
+                projectid=tasks.popleft()
+                if deadline is not None and time.time() > deadline:
+                    result.skipped.append(projectid)
+                    continue
+            watchdog=None
+            error=None
+            try:
+                if task_timeout:
+                    watchdog=_Watchdog(session.connection(), task_timeout)
+                if statement_timeout:
+                    _set_statement_timeout(session, statement_timeout)
+                value=function(session, projectid)
+            except Exception as e:
+                error=e
+            finally:
+                expired=watchdog is not None and watchdog.stop()
+                try:
+                    #ends the read transaction, resetting the statement_timeout, and frees the memory of the identity map
+                    session.rollback()
+                    session.expunge_all()
+                except Exception as e:
+                    if error is None:
+                        error=e
+                    #the next tasks get a new session
+                    try:
+                        session.close()
+                    except Exception:
+                        pass
+                    session=session_factory()
+            with lock:
+                if expired or (error is not None and _is_timeout(error)):
+                    result.timeouts.append(projectid)
+                elif error is not None:
+                    result.errors[projectid]=error
+                else:
+                    result.results[projectid]=value
+    finally:
+        session.close()
+        if engine is not None:
+            _unwatch(engine)
+
+def run_per_project(projectids, function, workers=4, task_timeout=None, timeout=None, session_factory=None, consistent=False,
+        statement_timeout=None):
+    """calls function(session, projectid) for each project, over a bounded pool of threads.
+    Each thread uses one session, rolled back and emptied between tasks.
+    With consistent, the sessions are read only, and all the tasks read the same snapshot of the database.
+
+    :param projectids: the iterable of project ids, e.g. as returned by queries.get_last_modified_projectids
+    :param function: the callable taking a session and a project id
+    :param workers: the number of threads, and of database connections
+    :param task_timeout: if defined, the number of seconds after which a task is stopped : its running statement is cancelled,
+                         and it cannot run new ones. The task is then recorded in the timeouts of the result.
+    :param timeout: if defined, the number of seconds after which no new task is started.
+                    The running tasks are waited for.
+    :param session_factory: the callable creating the sessions. Defaults to utils.get_session_factory(), 
+                            or to utils.get_readonly_session_factory() with consistent.
+    :param consistent: if True, a snapshot is exported, and imported by the sessions of all the workers. 
+                       session_factory must then create read only sessions (see utils.readonly_sessionmaker).
+    :param statement_timeout: if defined, the number of seconds after which Postgres cancels each statement of a task
+    :returns: FanOutResult
+    """
+    if workers < 1:
+        raise ValueError("workers should be at least 1, not {}".format(workers))
+    if session_factory is None:
+        from genologics_sql import utils
+        session_factory=utils.get_readonly_session_factory() if consistent else utils.get_session_factory()
+    if consistent:
+        from genologics_sql.utils import export_snapshot
+        #the snapshot can be imported as long as the exporting transaction is open
+        exporter=session_factory()
+        try:
+            snapshot=export_snapshot(exporter)
+            return _run(projectids, function, workers, task_timeout, statement_timeout, timeout,
+                    lambda:session_factory(info={'snapshot':snapshot}))
+        finally:
+            exporter.close()
+    return _run(projectids, function, workers, task_timeout, statement_timeout, timeout, session_factory)
+
+def _run(projectids, function, workers, task_timeout, statement_timeout, timeout, session_factory):
+    tasks=deque(projectids)
+    result=FanOutResult()
+    lock=threading.Lock()
+    start=time.time()
+    deadline=start+timeout if timeout is not None else None
+    threads=[threading.Thread(target=_worker, args=(tasks, function, session_factory, task_timeout, statement_timeout, deadline, result, lock))
+            for i in range(min(workers, len(tasks)))]
+    for thread in threads:
+        thread.daemon=True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.elapsed=time.time()-start
+    return result
@@ -0,0 +1,227 @@
+"""Records the statements run by an engine, and where they come from::
+
+    from genologics_sql import profiling, queries, utils
+
+    profiler=profiling.QueryProfiler()
+    profiler.attach(utils.get_engine())
+    ...
+    print(profiler.report())
+
+Setting the profile configuration key to true attaches default_profiler() to the engine of utils.get_engine.
+
+Each statement is attributed to its origin : the function of genologics_sql.queries or genologics_sql.lineage running it,
+the relationship being lazy loaded (e.g. "Project.samples"), or else the first calling function outside of SQLAlchemy.
+Statements are grouped by shape, their text with whitespace collapsed and literal numbers and IN lists replaced.
+The same shape running more than n_plus_one times on a single connection checkout is reported as a N+1 pattern.
+"""
+import math
+import os
+import re
+import sys
+import threading
+import time
+
+import sqlalchemy
+
+from collections import namedtuple
+from sqlalchemy import event
+
+StatementStats=namedtuple('StatementStats', ['shape', 'origin', 'count', 'total', 'p50', 'p95', 'p99', 'rows'])
+"""Aggregates of a statement shape, times in seconds"""
+
+_PACKAGE=os.path.dirname(os.path.abspath(__file__))
+_SQLALCHEMY=os.path.dirname(os.path.abspath(sqlalchemy.__file__))
+_ORIGIN_MODULES=dict((os.path.join(_PACKAGE, name), module) for name, module in (('queries.py', 'queries'), ('lineage.py', 'lineage')))
+
+_SPACES=re.compile(r"\s+")
+_NUMBERS=re.compile(r"\b\d+\b")
+_IN_LISTS=re.compile(r"\bIN \((?:[^()]*?,)+[^()]*?\)", re.IGNORECASE)
+
+
+def statement_shape(statement):
+    """returns the shape of a sql statement, used to group the statements together
+
+    :param statement: the sql string
+    :returns: the sql string with whitespace collapsed, and literal numbers and IN lists replaced
+    """
+    shape=_SPACES.sub(" ", statement).strip()
+    shape=_IN_LISTS.sub("IN (...)", shape)
+    return _NUMBERS.sub("N", shape)
+
+def _origin():
+    """returns the origin of the statement being run, from the call stack"""
+    frame=sys._getframe(2)
+    caller=None
+    while frame is not None:
+        filename=frame.f_code.co_filename
+        if filename in _ORIGIN_MODULES and not frame.f_code.co_name.startswith('_'):
+            return "{}.{}".format(_ORIGIN_MODULES[filename], frame.f_code.co_name)
+        if frame.f_code.co_name == '_load_for_state' and 'self' in frame.f_locals:
+            prop=getattr(frame.f_locals['self'], 'parent_property', None)
+            if prop is not None:
+                return "lazy:{}".format(prop)
+        if caller is None and not filename.startswith(_SQLALCHEMY) and filename != __file__.rstrip('c'):
+            caller="{}:{}".format(os.path.basename(filename), frame.f_code.co_name)
+        frame=frame.f_back
+    return caller or "unknown"
+
+def _percentile(durations, percent):
+    """nearest-rank percentile of a sorted list"""
+    if not durations:
+        return 0.0
+    #the smallest value such that at least percent % of the values are lower or equal
+    index=int(math.ceil(percent/100.0*len(durations)))-1
+    return durations[max(0, min(index, len(durations)-1))]
+
+
+class QueryProfiler(object):
+    """Records the latency, row count and origin of the statements run by the engines it is attached to.
+
+    :arg INTEGER n_plus_one: number of runs of a statement shape on a single connection checkout above which a N+1 pattern is reported
+    :arg dict n_plus_one_patterns: shape : (origin, highest number of runs on a single checkout)
+    """
+
+    def __init__(self, n_plus_one=10):
+        self.n_plus_one=n_plus_one
+        self._lock=threading.Lock()
+        self._engines=[]
+        self.reset()
+
+    def reset(self):
+        """forgets all the recorded statements"""
+        with self._lock:
+            #(shape, origin) : list of durations, and (shape, origin) : number of rows
+            self._durations={}
+            self._rows={}
+            self.n_plus_one_patterns={}
+
+    def attach(self, engine):
+        """starts recording the statements run by <engine>"""
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        event.listen(engine, 'handle_error', self._handle_error)
+        event.listen(engine, 'checkout', self._checkout)
+        self._engines.append(engine)
+
+    def detach(self):
+        """stops recording the statements of all the engines"""
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute', self._before_execute)
+            event.remove(engine, 'after_cursor_execute', self._after_execute)
+            event.remove(engine, 'handle_error', self._handle_error)
+            event.remove(engine, 'checkout', self._checkout)
+        self._engines=[]
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info.pop('genologics_sql_shapes', None)
+
+    def _handle_error(self, context):
+        #the failed statement is not recorded
+        starts=context.connection.info.get('genologics_sql_starts') if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('genologics_sql_starts', []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed=time.time()-conn.info['genologics_sql_starts'].pop()
+        shape=statement_shape(statement)
+        #the streaming queries record their origin, as they run after it has returned
+        origin=context.execution_options.get('genologics_sql_origin') if context is not None else None
+        origin=origin or _origin()
+        rows=max(getattr(cursor, 'rowcount', -1) or 0, 0)
+        shapes=conn.info.setdefault('genologics_sql_shapes', {})
+        shapes[shape]=shapes.get(shape, 0)+1
+        with self._lock:
+            self._durations.setdefault((shape, origin), []).append(elapsed)
+            self._rows[(shape, origin)]=self._rows.get((shape, origin), 0)+rows
+            if shapes[shape] > self.n_plus_one:
+                self.n_plus_one_patterns[shape]=(origin, max(shapes[shape], self.n_plus_one_patterns.get(shape, (None, 0))[1]))
+
+    def _aggregate(self, by_shape):
+        """returns the StatementStats grouped by shape or by origin, by decreasing total time"""
+        with self._lock:
+            groups={}
+            for (shape, origin), durations in self._durations.items():
+                group=groups.setdefault(shape if by_shape else origin, {'durations':[], 'rows':0, 'origins':{}})
+                group['durations'].extend(durations)
+                group['rows']+=self._rows[(shape, origin)]
+                group['origins'][origin]=len(durations)
+        stats=[]
+        for key, group in groups.items():
+            durations=sorted(group['durations'])
+            stats.append(StatementStats(key if by_shape else None, max(group['origins'], key=group['origins'].get), len(durations), 
+                    sum(durations), _percentile(durations, 50), _percentile(durations, 95), _percentile(durations, 99), group['rows']))
+        return sorted(stats, key=lambda x:x.total, reverse=True)
+
+    def stats(self):
+        """returns the aggregates of each statement shape, by decreasing total time
+
+        :returns: List of StatementStats. The origin is the one running the shape most often.
+        """
+        return self._aggregate(True)
+
+    def origin_stats(self):
+        """returns the aggregates of each origin, by decreasing total time
+
+        :returns: List of StatementStats, whose shape is None
+        """
+        return self._aggregate(False)
+
+    def report(self, limit=20):
+        """returns a text report of the most expensive statement shapes, and of the N+1 patterns
+
+        :param limit: the number of statement shapes to show
+        :returns: the report string
+        """
+        lines=["{:>8} {:>10} {:>9} {:>9} {:>9} {:>9}  {}".format('count', 'total(s)', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'rows', 'origin / statement')]
+        for stat in self.stats()[:limit]:
+            lines.append("{:>8} {:>10.3f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9}  {}".format(stat.count, stat.total,
+                    stat.p50*1000, stat.p95*1000, stat.p99*1000, stat.rows, stat.origin))
+            lines.append("{:>60}{}".format('', stat.shape[:200]))
+        if self.n_plus_one_patterns:
+            lines.append("")
+            lines.append("N+1 patterns (more than {} runs on one connection checkout):".format(self.n_plus_one))
+            for shape, (origin, count) in sorted(self.n_plus_one_patterns.items(), key=lambda x:x[1][1], reverse=True):
+                lines.append("{:>8} runs  {}  {}".format(count, origin, shape[:200]))
+        return "\n".join(lines)
+
+    def prometheus(self, prefix="genologics_sql"):
+        """returns the aggregates of each origin in the Prometheus text exposition format
+
+        :param prefix: the prefix of the metric names
+        :returns: the metrics string
+        """
+        lines=["# HELP {}_query_seconds Duration of the database statements, by origin".format(prefix),
+                "# TYPE {}_query_seconds summary".format(prefix)]
+        origin_stats=self.origin_stats()
+        for stat in origin_stats:
+            label=stat.origin.replace('\\', '\\\\').replace('"', '\\"')
+            for quantile, value in (('0.5', stat.p50), ('0.95', stat.p95), ('0.99', stat.p99)):
+                lines.append('{}_query_seconds{{origin="{}",quantile="{}"}} {}'.format(prefix, label, quantile, value))
+            lines.append('{}_query_seconds_sum{{origin="{}"}} {}'.format(prefix, label, stat.total))
+            lines.append('{}_query_seconds_count{{origin="{}"}} {}'.format(prefix, label, stat.count))
+        lines.append("# HELP {}_query_rows_total Rows returned by the database statements, by origin".format(prefix))
+        lines.append("# TYPE {}_query_rows_total counter".format(prefix))
+        for stat in origin_stats:
+            lines.append('{}_query_rows_total{{origin="{}"}} {}'.format(prefix, stat.origin.replace('\\', '\\\\').replace('"', '\\"'), stat.rows))
+        lines.append("# HELP {}_n_plus_one_patterns Statement shapes run more than {} times on one connection checkout".format(prefix, self.n_plus_one))
+        lines.append("# TYPE {}_n_plus_one_patterns gauge".format(prefix))
+        lines.append("{}_n_plus_one_patterns {}".format(prefix, len(self.n_plus_one_patterns)))
+        return "\n".join(lines)+"\n"
+
+    def __repr__(self):
+        with self._lock:
+            return "<QueryProfiler(shapes={}, statements={}, n_plus_one={})>".format(len(set(shape for shape, origin in self._durations)),
+                    sum(len(durations) for durations in self._durations.values()), len(self.n_plus_one_patterns))
+
+
+_DEFAULT_PROFILER=None
+
+def default_profiler():
+    """returns the process-wide profiler, attached to the engine of utils.get_engine when the profile configuration key is true"""
+    global _DEFAULT_PROFILER
+    if _DEFAULT_PROFILER is None:
+        _DEFAULT_PROFILER=QueryProfiler()
+    return _DEFAULT_PROFILER
@@ -1,223 +1,895 @@
 from genologics_sql.tables import *
 
-from sqlalchemy import text
+from sqlalchemy import text, func, case
+from sqlalchemy.orm import selectinload, joinedload, configure_mappers, aliased, undefer_group
+from sqlalchemy.orm.attributes import set_committed_value
 
-def get_last_modified_projects(session, interval="2 hours"):
+from collections import OrderedDict, namedtuple
+import hashlib
+import re
+import sys
+
+#All the queries use bound parameters, and their statements are built once and cached in _STATEMENTS,
+#so that Postgres always receives the same statement text for a given query.
+#If the session has session.info['prepared_statements'] set, the statements are also
+#prepared server-side once per connection, and executed through EXECUTE.
+
+_STATEMENTS={}
+_PARAMETER=re.compile(r"(?<![:\w]):(\w+)")
+
+def _statement(session, query):
+    """returns the cached statement for the sql string <query>
+
+    :param session: the current SQLAlchemy session to the database
+    :param query: the sql string, with :named parameters
+    :returns: the SQLAlchemy textual statement to execute with the same parameters as query
+    """
+    statement=_STATEMENTS.get(query)
+    if statement is None:
+        statement=_STATEMENTS.setdefault(query, text(query))
+    if session.info.get('prepared_statements'):
+        return _prepared_statement(session, query)
+    return statement
+
+def _prepared_statement(session, query):
+    """prepares <query> on the connection of the session if it was not yet, 
+    and returns the statement executing it
+
+    :param session: the current SQLAlchemy session to the database
+    :param query: the sql string, with :named parameters
+    :returns: the SQLAlchemy textual EXECUTE statement
+    """
+    name="genosql_{}".format(hashlib.md5(query.encode('utf-8')).hexdigest())
+    parameters=[]
+    for parameter in _PARAMETER.findall(query):
+        if parameter not in parameters:
+            parameters.append(parameter)
+    connection=session.connection()
+    prepared=connection.info.setdefault('genologics_sql_prepared', set())
+    if name not in prepared:
+        positional=_PARAMETER.sub(lambda m:"${}".format(parameters.index(m.group(1))+1), query).rstrip().rstrip(';')
+        connection.execute(text("prepare {} as {}".format(name, positional)))
+        prepared.add(name)
+    execute="execute {}({});".format(name, ", ".join(":{}".format(p) for p in parameters))
+    statement=_STATEMENTS.get(execute)
+    if statement is None:
+        statement=_STATEMENTS.setdefault(execute, text(execute))
+    return statement
+
+def _query(session, entity, query, **params):
+    """returns the ORM query of <entity> over the cached statement of <query>
+
+    :param session: the current SQLAlchemy session to the database
+    :param entity: the mapped class of the rows returned by the query
+    :param query: the sql string, with :named parameters
+    :param params: the values of the parameters
+    """
+    return session.query(entity).from_statement(_statement(session, query)).params(**params)
+
+def _stream(session, entity, query, batch_size, columns=None, **params):
+    """iterates over the <entity> rows of <query> with a server-side cursor, 
+    so that only batch_size rows are held in memory at a time.
+    Server-side cursors cannot run prepared statements, so the plain statement is always used.
+
+    :param session: the current SQLAlchemy session to the database
+    :param entity: the mapped class of the rows returned by the query
+    :param query: the sql string, with :named parameters
+    :param batch_size: the number of rows fetched from the server at a time
+    :param columns: if defined, the records of these columns are yielded instead of entity objects
+    :param params: the values of the parameters
+    """
+    #the statement runs once the iter_ function has returned, so its origin is recorded for genologics_sql.profiling now
+    origin="queries.{}".format(sys._getframe(1).f_code.co_name)
+    return _stream_rows(session, entity, query, batch_size, columns, origin, params)
+
+def _stream_rows(session, entity, query, batch_size, columns, origin, params):
+    statement=_STATEMENTS.get(query)
+    if statement is None:
+        statement=_STATEMENTS.setdefault(query, text(query))
+    options={'stream_results':True, 'genologics_sql_origin':origin}
+    if columns is not None:
+        make=row_record(entity, columns)._make
+        result=session.execute(statement.execution_options(**options), params)
+        for rows in result.partitions(batch_size):
+            for row in rows:
+                yield make(row)
+        return
+    orm_query=session.query(entity).from_statement(statement).params(**params)
+    for row in orm_query.execution_options(**options).yield_per(batch_size):
+        yield row
+
+#records of the rows mode, by (entity, attribute names)
+_RECORDS={}
+
+def _columns(entity, columns):
+    """validates the columns of the rows mode, as they cannot be passed as parameters
+
+    :param entity: the mapped class the columns belong to
+    :param columns: LIST of attribute names or mapped attributes, like ['luid', Process.daterun]
+    :returns: List of (attribute name, sql column name)
+    """
+    attributes=dict((prop.key, prop.columns[0].name) for prop in entity.__mapper__.column_attrs)
+    pairs=[]
+    for column in columns:
+        key=getattr(column, 'key', column)
+        if key not in attributes:
+            raise ValueError("{} has no column {}".format(entity.__name__, key))
+        pairs.append((key, attributes[key]))
+    return pairs
+
+def _select_list(alias, entity, columns):
+    """returns the select list of <columns> of the <entity> table aliased as <alias>, or all of its columns"""
+    if columns is None:
+        return "{}.*".format(alias)
+    return ", ".join("{}.{}".format(alias, name) for key, name in _columns(entity, columns))
+
+def row_record(entity, columns):
+    """returns the named tuple class of the records of <columns> of <entity>, 
+    as returned by the query functions in rows mode.
+    The records are plain tuples : they are not tracked by the session, and have no relationships.
+
+    :param entity: the mapped class the columns belong to
+    :param columns: LIST of attribute names or mapped attributes
+    :returns: the namedtuple class, named <entity>Row, with one field per attribute
+    """
+    keys=tuple(key for key, name in _columns(entity, columns))
+    record=_RECORDS.get((entity, keys))
+    if record is None:
+        record=_RECORDS.setdefault((entity, keys), namedtuple("{}Row".format(entity.__name__), keys))
+    return record
+
+def _fetch(session, entity, query, columns, **params):
+    """returns the <entity> objects of <query>, or the records of <columns> if defined, 
+    without building any mapped object
+
+    :param session: the current SQLAlchemy session to the database
+    :param entity: the mapped class of the rows returned by the query
+    :param query: the sql string, with :named parameters, selecting the columns of _select_list
+    :param columns: LIST of attribute names or mapped attributes, or None
+    :param params: the values of the parameters
+    """
+    if columns is None:
+        return _query(session, entity, query, **params).all()
+    make=row_record(entity, columns)._make
+    return [make(row) for row in session.execute(_statement(session, query), params)]
+
+def get_rows(session, entity, ids, columns, chunk_size=1000):
+    """gets the records of a few columns of many entities, without building any mapped object
+
+    :param session: the current SQLAlchemy session to the db
+    :param entity: the mapped class, with a single column primary key
+    :param ids: the LIST of primary keys of the entities
+    :param columns: LIST of attribute names or mapped attributes, like ['name', 'luid']
+    :param chunk_size: the maximum number of ids sent in a single query
+    :returns: dictionnary of primary key : record, see row_record
+    """
+    record=row_record(entity, columns)
+    make=record._make
+    key=entity.__mapper__.primary_key[0]
+    attributes=[getattr(entity, name) for name in record._fields]
+    ids=list(set(ids))
+    records={}
+    for start in range(0, len(ids), chunk_size):
+        for row in session.query(key, *attributes).filter(key.in_(ids[start:start+chunk_size])):
+            records[row[0]]=make(row[1:])
+    return records
+
+def get_related_rows(session, relationship, ids, columns, chunk_size=1000):
+    """gets the records of a few columns of the targets of a relationship, for many parents at once,
+    without building any mapped object::
+
+        get_related_rows(session, Project.samples, [1, 2], ['name', 'processid'])
+
+    :param session: the current SQLAlchemy session to the db
+    :param relationship: the relationship attribute, like Project.samples or Sample.artifacts
+    :param ids: the LIST of primary keys of the parents
+    :param columns: LIST of attribute names of the target class
+    :param chunk_size: the maximum number of ids sent in a single query
+    :returns: dictionnary of parent primary key : List of records of the target class, see row_record
+    """
+    configure_mappers()
+    target=relationship.property.mapper.class_
+    record=row_record(target, columns)
+    make=record._make
+    alias=aliased(target)
+    key=relationship.property.parent.primary_key[0]
+    attributes=[getattr(alias, name) for name in record._fields]
+    ids=list(set(ids))
+    records=dict((parentid, []) for parentid in ids)
+    for start in range(0, len(ids), chunk_size):
+        query=session.query(key, *attributes).join(relationship.of_type(alias)).filter(key.in_(ids[start:start+chunk_size]))
+        for row in query:
+            records[row[0]].append(make(row[1:]))
+    return records
+
+def _modified_after(column, since=None):
+    """builds the condition selecting the rows of <column> modified after a point in time.
+
+    The condition is kept sargable (no function applied to the column) so that Postgres can use an index on it.
+
+    :param column: str the sql name of the lastmodifieddate column to filter on
+    :param since: if defined, the condition expects a :since timestamp parameter (the watermark),
+        otherwise an :interval parameter.
+    :returns: a sql string condition
+    """
+    if since is not None:
+        return "{col} > :since".format(col=column)
+    #asyncpg would type the parameter of cast(:interval as interval) as an interval, and refuse a string
+    return "{col} > now() - cast(cast(:interval as text) as interval)".format(col=column)
+
+def get_last_modified_projects(session, interval="2 hours", since=None, columns=None):
     """gets the project objects last modified in the last <interval>
 
-    :query: select * from project where age(lastmodifieddate)< '1 hour'::interval;
+    :query: select * from project where lastmodifieddate > now() - cast('2 hours' as interval);
 
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
+    :param since: datetime watermark. If defined, overrides interval and gets the projects modified after it.
+    :param columns: if defined, the LIST of Project columns to return as records instead of Project objects, see row_record
     :returns: List of Project records
 
     """
-    txt="age(now(),lastmodifieddate)< '{int}'::interval".format(int=interval)
-    return session.query(Project).filter(text(txt)).all()
+    query="select {cols} from project pj where {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("pj.lastmodifieddate", since))
+    return _fetch(session, Project, query, columns, interval=interval, since=since)
+
+def iter_last_modified_projects(session, interval="2 hours", since=None, batch_size=1000, columns=None):
+    """same as get_last_modified_projects, but streams the results with a server-side cursor
+
+    :param batch_size: the number of rows fetched from the server at a time
+    :param columns: if defined, the LIST of Project columns to yield as records instead of Project objects
+    :returns: Generator of Project records
+    """
+    query="select {cols} from project pj where {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("pj.lastmodifieddate", since))
+    return _stream(session, Project, query, batch_size, columns, interval=interval, since=since)
 
-def get_last_modified_project_udfs(session, interval="2 hours"):
+def get_last_modified_project_udfs(session, interval="2 hours", since=None, columns=None):
     """gets the project objects that have a udf last modified in the last <interval>
 
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
+    :param since: datetime watermark. If defined, overrides interval.
+    :param columns: if defined, the LIST of Project columns to return as records instead of Project objects, see row_record
     :returns: List of Project records
 
     """
-    query="select pj.* from project pj \
+    query="select {cols} from project pj \
            inner join entityudfstorage eus on pj.projectid = eus.attachtoid \
-           where eus.attachtoclassid = 83 and age(now(), eus.lastmodifieddate) < '{int}'::interval;".format(int=interval)
-    return session.query(Project).from_statement(text(query)).all()
+           where eus.attachtoclassid = 83 and {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("eus.lastmodifieddate", since))
+    return _fetch(session, Project, query, columns, interval=interval, since=since)
 
 
-def get_last_modified_project_sample_udfs(session, interval="2 hours"):
+def get_last_modified_project_sample_udfs(session, interval="2 hours", since=None, columns=None):
     """gets the project objects that have sample udfs last modified in the last <interval>
 
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
+    :param since: datetime watermark. If defined, overrides interval.
+    :param columns: if defined, the LIST of Project columns to return as records instead of Project objects, see row_record
     :returns: List of Project records
     """
-    query= "select distinct pj.* from project pj \
+    query= "select distinct {cols} from project pj \
             inner join sample sa on sa.projectid=pj.projectid \
             inner  join processudfstorage pus on sa.processid=pus.processid \
-            where age(now(), pus.lastmodifieddate) < '{int}'::interval;".format(int=interval)
-    return session.query(Project).from_statement(text(query)).all()
+            where {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("pus.lastmodifieddate", since))
+    return _fetch(session, Project, query, columns, interval=interval, since=since)
 
-def get_last_modified_project_artifacts(session, interval="2 hours"):
+def get_last_modified_project_artifacts(session, interval="2 hours", since=None, columns=None):
     """gets the project objects that have artifacts last modified in the last <interval>
 
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
+    :param since: datetime watermark. If defined, overrides interval.
+    :param columns: if defined, the LIST of Project columns to return as records instead of Project objects, see row_record
     :returns: List of Project records
     """
-    query= "select distinct pj.* from project pj \
+    query= "select distinct {cols} from project pj \
             inner join sample sa on sa.projectid=pj.projectid \
             inner join artifact_sample_map asm on sa.processid=asm.processid \
             inner join artifact art on asm.artifactid=art.artifactid \
-            where age(now(), art.lastmodifieddate) < '{int}'::interval;".format(int=interval)
-    return session.query(Project).from_statement(text(query)).all()
+            where {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("art.lastmodifieddate", since))
+    return _fetch(session, Project, query, columns, interval=interval, since=since)
 
-def get_last_modified_project_artifact_udfs(session, interval="2 hours"):
+def get_last_modified_project_artifact_udfs(session, interval="2 hours", since=None, columns=None):
     """gets the project objects that have artifact udfs last modified in the last <interval>
 
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
+    :param since: datetime watermark. If defined, overrides interval.
+    :param columns: if defined, the LIST of Project columns to return as records instead of Project objects, see row_record
     :returns: List of Project records
     """
-    query= "select distinct pj.* from project pj \
+    query= "select distinct {cols} from project pj \
             inner join sample sa on sa.projectid=pj.projectid \
             inner join artifact_sample_map asm on sa.processid=asm.processid \
             inner join artifactudfstorage aus on asm.artifactid=aus.artifactid \
-            where age(now(), aus.lastmodifieddate) < '{int}'::interval;".format(int=interval)
-    return session.query(Project).from_statement(text(query)).all()
+            where {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("aus.lastmodifieddate", since))
+    return _fetch(session, Project, query, columns, interval=interval, since=since)
 
-def get_last_modified_project_containers(session, interval="2 hours"):
+def get_last_modified_project_containers(session, interval="2 hours", since=None, columns=None):
     """gets the project objects that have containers last modified in the last <interval>
 
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
+    :param since: datetime watermark. If defined, overrides interval.
+    :param columns: if defined, the LIST of Project columns to return as records instead of Project objects, see row_record
     :returns: List of Project records
     """
-    query= "select distinct pj.* from project pj \
+    query= "select distinct {cols} from project pj \
             inner join sample sa on sa.projectid=pj.projectid \
             inner join artifact_sample_map asm on sa.processid=asm.processid \
             inner join containerplacement cpl on asm.artifactid=cpl.processartifactid \
             inner join container ct on cpl.containerid=ct.containerid \
-            where age(ct.lastmodifieddate) < '{int}'::interval;".format(int=interval)
-    return session.query(Project).from_statement(text(query)).all()
+            where {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("ct.lastmodifieddate", since))
+    return _fetch(session, Project, query, columns, interval=interval, since=since)
 
-def get_last_modified_project_processes(session, interval="2 hours"):
-    """gets the project objects that have containers last modified in the last <interval>
+def get_last_modified_project_processes(session, interval="2 hours", since=None, columns=None):
+    """gets the project objects that have processes last modified in the last <interval>
 
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
+    :param since: datetime watermark. If defined, overrides interval.
+    :param columns: if defined, the LIST of Project columns to return as records instead of Project objects, see row_record
     :returns: List of Project records
     """
-    query= "select distinct pj.* from project pj \
+    query= "select distinct {cols} from project pj \
             inner join sample sa on sa.projectid=pj.projectid \
             inner join artifact_sample_map asm on sa.processid=asm.processid \
             inner join processiotracker pit on asm.artifactid=pit.inputartifactid \
             inner join process pro on pit.processid=pro.processid \
-            where age(now(), pro.lastmodifieddate) < '{int}'::interval;".format(int=interval)
-    return session.query(Project).from_statement(text(query)).all()
+            where {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("pro.lastmodifieddate", since))
+    return _fetch(session, Project, query, columns, interval=interval, since=since)
 
-def get_last_modified_project_process_udfs(session, interval="2 hours"):
-    """gets the project objects that have containers last modified in the last <interval>
+def get_last_modified_project_process_udfs(session, interval="2 hours", since=None, columns=None):
+    """gets the project objects that have process udfs last modified in the last <interval>
 
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
+    :param since: datetime watermark. If defined, overrides interval.
+    :param columns: if defined, the LIST of Project columns to return as records instead of Project objects, see row_record
     :returns: List of Project records
     """
-    query= "select distinct pj.* from project pj \
+    query= "select distinct {cols} from project pj \
             inner join sample sa on sa.projectid=pj.projectid \
             inner join artifact_sample_map asm on sa.processid=asm.processid \
             inner join processiotracker pit on asm.artifactid=pit.inputartifactid \
             inner join process pro on pit.processid=pro.processid \
             inner join processudfstorage pus on pro.processid=pus.processid \
-            where age(now(), pus.lastmodifieddate) < '{int}'::interval;".format(int=interval)
-    return session.query(Project).from_statement(text(query)).all()
+            where {cond};".format(cols=_select_list("pj", Project, columns), cond=_modified_after("pus.lastmodifieddate", since))
+    return _fetch(session, Project, query, columns, interval=interval, since=since)
+
+
+#Each source is (projectid column, lastmodifieddate column, from clause, extra condition)
+PROJECT_CHANGE_SOURCES=OrderedDict([
+    ('project', ("pj.projectid", "pj.lastmodifieddate", "project pj", None)),
+    ('project_udfs', ("eus.attachtoid", "eus.lastmodifieddate", "entityudfstorage eus", "eus.attachtoclassid = 83")),
+    ('sample_udfs', ("sa.projectid", "pus.lastmodifieddate", "sample sa \
+            inner join processudfstorage pus on sa.processid=pus.processid", None)),
+    ('artifacts', ("sa.projectid", "art.lastmodifieddate", "sample sa \
+            inner join artifact_sample_map asm on sa.processid=asm.processid \
+            inner join artifact art on asm.artifactid=art.artifactid", None)),
+    ('artifact_udfs', ("sa.projectid", "aus.lastmodifieddate", "sample sa \
+            inner join artifact_sample_map asm on sa.processid=asm.processid \
+            inner join artifactudfstorage aus on asm.artifactid=aus.artifactid", None)),
+    ('containers', ("sa.projectid", "ct.lastmodifieddate", "sample sa \
+            inner join artifact_sample_map asm on sa.processid=asm.processid \
+            inner join containerplacement cpl on asm.artifactid=cpl.processartifactid \
+            inner join container ct on cpl.containerid=ct.containerid", None)),
+    ('processes', ("sa.projectid", "pro.lastmodifieddate", "sample sa \
+            inner join artifact_sample_map asm on sa.processid=asm.processid \
+            inner join processiotracker pit on asm.artifactid=pit.inputartifactid \
+            inner join process pro on pit.processid=pro.processid", None)),
+    ('process_udfs', ("sa.projectid", "pus.lastmodifieddate", "sample sa \
+            inner join artifact_sample_map asm on sa.processid=asm.processid \
+            inner join processiotracker pit on asm.artifactid=pit.inputartifactid \
+            inner join processudfstorage pus on pit.processid=pus.processid", None)),
+    ])
+"""Sources of the project change feed, keyed by entity kind"""
+
 
+def _project_change_feed(sources=None, since=None):
+    """builds the union of the change feed sources, tagged with the source name
 
-def get_last_modified_projectids(session, interval="2 hours"):
+    :param sources: the LIST of source names to include. Defaults to all of them.
+    :param since: if defined, the feed expects a :since parameter instead of an :interval one.
+    :returns: a sql string selecting (source, projectid, lastmodifieddate) rows, 
+        lastmodifieddate being the latest modification seen for that project in that source.
+    """
+    parts=[]
+    for source in (sources or PROJECT_CHANGE_SOURCES.keys()):
+        projectid, date, from_clause, extra=PROJECT_CHANGE_SOURCES[source]
+        cond=_modified_after(date, since)
+        if extra:
+            cond="{} and {}".format(extra, cond)
+        parts.append("select '{source}' as source, {pid} as projectid, max({date}) as lastmodifieddate \
+                from {from_clause} where {cond} group by {pid}".format(
+            source=source, pid=projectid, date=date, from_clause=from_clause, cond=cond))
+    return " union all ".join(parts)
+
+
+def get_last_modified_projectids(session, interval="2 hours", sources=None, since=None):
     """gets all the projectids for which any part has been modified in the last interval
 
+    The whole change feed is computed server-side in a single query returning only the project luids.
+
     :param session: the current SQLAlchemy session to the database
     :param interval: str Postgres-compliant time string
-    :returns: List of Project records
+    :param sources: the LIST of change sources to look at (see PROJECT_CHANGE_SOURCES). Defaults to all of them.
+    :param since: datetime watermark. If defined, overrides interval.
+    :returns: Set of project luids
     """
-    projectids=set()
-    for project in get_last_modified_projects(session, interval):
-        projectids.add(project.luid)
+    query="select distinct pj.luid from project pj \
+           inner join ({feed}) feed on feed.projectid=pj.projectid;".format(feed=_project_change_feed(sources, since))
+    return set(row[0] for row in session.execute(_statement(session, query), {'interval':interval, 'since':since}))
 
-    for project in get_last_modified_project_udfs(session, interval):
-        projectids.add(project.luid)
+def get_last_modified_projectids_by_source(session, interval="2 hours", sources=None, since=None):
+    """gets the projectids for which any part has been modified in the last interval,
+    grouped by the kind of entity that was modified. Mostly useful for diagnostics.
 
-    for project in get_last_modified_project_sample_udfs(session, interval):
-        projectids.add(project.luid)
+    :param session: the current SQLAlchemy session to the database
+    :param interval: str Postgres-compliant time string
+    :param sources: the LIST of change sources to look at (see PROJECT_CHANGE_SOURCES). Defaults to all of them.
+    :param since: datetime watermark. If defined, overrides interval.
+    :returns: dictionnary of source name : set of project luids
+    """
+    query="select feed.source, pj.luid from project pj \
+           inner join ({feed}) feed on feed.projectid=pj.projectid;".format(feed=_project_change_feed(sources, since))
+    by_source=OrderedDict((source, set()) for source in (sources or PROJECT_CHANGE_SOURCES.keys()))
+    for source, luid in session.execute(_statement(session, query), {'interval':interval, 'since':since}):
+        by_source[source].add(luid)
+    return by_source
+
+def get_projectids_modified_since(session, since=None, interval="2 hours", sources=None, overlap=None):
+    """incremental version of get_last_modified_projectids.
+
+    Gets the projectids for which any part has been modified after the <since> watermark,
+    and the new watermark to use for the next call, which is the latest modification date seen.
+    When no watermark is known yet (first run), falls back to the last <interval>.
+
+    The lastmodifieddate of a row is set before its transaction commits : a row committed after the previous call
+    with a date older than the watermark is missed, unless overlap makes the query read again the rows modified
+    shortly before the watermark. The projects modified within the overlap are then returned by several calls.
 
-    for project in get_last_modified_project_containers(session, interval):
-        projectids.add(project.luid)
+    Typical use, with a local checkpoint file::
 
-    for project in get_last_modified_project_processes(session, interval):
-        projectids.add(project.luid)
+        checkpoint=genologics_sql.utils.Checkpoint("~/.genosql_sync")
+        projectids, watermark=get_projectids_modified_since(session, checkpoint.load())
+        # ... process the projects ...
+        checkpoint.save(watermark)
 
-    for project in get_last_modified_project_process_udfs(session, interval):
-        projectids.add(project.luid)
+    :param session: the current SQLAlchemy session to the database
+    :param since: datetime watermark, as returned by the previous call
+    :param interval: str Postgres-compliant time string, used only if since is None
+    :param sources: the LIST of change sources to look at (see PROJECT_CHANGE_SOURCES). Defaults to all of them.
+    :param overlap: datetime.timedelta, if defined, the rows modified up to overlap before the watermark are read again.
+                    It should exceed the duration of the longest transactions writing to the database.
+    :returns: a tuple (Set of project luids, datetime watermark)
+    """
+    query="select pj.luid, max(feed.lastmodifieddate) from project pj \
+           inner join ({feed}) feed on feed.projectid=pj.projectid \
+           group by pj.luid;".format(feed=_project_change_feed(sources, since))
+    projectids=set()
+    watermark=since
+    read_since=since-overlap if since is not None and overlap else since
+    for luid, lastmodified in session.execute(_statement(session, query), {'interval':interval, 'since':read_since}):
+        projectids.add(luid)
+        if watermark is None or lastmodified > watermark:
+            watermark=lastmodified
+    return projectids, watermark
 
-    return projectids
 
+def _last_modified_processes_sql(since, columns):
+    return "select distinct {cols} from process pro \
+            inner join processudfstorage pus on pro.processid=pus.processid \
+            where (pro.typeid = any(:ptypes) \
+            and {udfcond}) \
+            or \
+            ({procond} \
+            and pro.typeid = any(:ptypes));".format(cols=_select_list("pro", Process, columns), udfcond=_modified_after("pus.lastmodifieddate", since), procond=_modified_after("pro.lastmodifieddate", since))
 
-def get_last_modified_processes(session, ptypes, interval="24 hours"):
+def get_last_modified_processes(session, ptypes, interval="24 hours", since=None, columns=None):
     """gets all the processes of the given <type> that have been modified
     or have a udf modified in the last <interval>
 
     :param session: the current SQLAlchemy session to the db
     :param ptypes: the LIST of process type ids to be returned
     :param interval: the postgres compliant interval of time to search processes in.
+    :param since: datetime watermark. If defined, overrides interval.
+    :param columns: if defined, the LIST of Process columns to return as records instead of Process objects, see row_record
 
     """
-    query= "select distinct pro.* from process pro \
-            inner join processudfstorage pus on pro.processid=pus.processid \
-            where (pro.typeid in ({typelist}) \
-            and age(now(), pus.lastmodifieddate) < '{int}'::interval) \
-            or \
-            (age(now(), pro.lastmodifieddate) < '{int}'::interval \
-            and pro.typeid in ({typelist}));".format(int=interval, typelist=",".join([str(x) for x in ptypes]))
-    return session.query(Process).from_statement(text(query)).all()
+    query=_last_modified_processes_sql(since, columns)
+    return _fetch(session, Process, query, columns, ptypes=list(ptypes), interval=interval, since=since)
 
-def get_processes_in_history(session, parent_process, ptypes, sample=None):
-    """returns wll the processes that are found in the history of parent_process 
-    AND are of type ptypes
-
-    :param session: the current SQLAlchemy session to the db
-    :param parent_process: the id of the parent_process
-    :param ptypes: the LIST of process type ids to be returned
-    :param sample: if defined, filter artifacts that match the correct sample
+def iter_last_modified_processes(session, ptypes, interval="24 hours", since=None, batch_size=1000, columns=None):
+    """same as get_last_modified_processes, but streams the results with a server-side cursor
 
+    :param batch_size: the number of rows fetched from the server at a time
+    :param columns: if defined, the LIST of Process columns to yield as records instead of Process objects
+    :returns: Generator of Process records
     """
-    qar=["select distinct pro.* from process pro \
+    query=_last_modified_processes_sql(since, columns)
+    return _stream(session, Process, query, batch_size, columns, ptypes=list(ptypes), interval=interval, since=since)
+
+def _processes_in_history_sql(sample, columns):
+    qar=["select distinct {} from process pro \
             inner join processiotracker pio on pio.processid=pro.processid \
             inner join outputmapping om on om.trackerid=pio.trackerid \
             inner join artifact_ancestor_map aam on pio.inputartifactid=aam.ancestorartifactid\
             inner join processiotracker pio2 on pio2.inputartifactid=aam.artifactid \
-            inner join process pro2 on pro2.processid=pio2.processid "]
+            inner join process pro2 on pro2.processid=pio2.processid ".format(_select_list("pro", Process, columns))]
     if sample:
         qar.append("inner join artifact_sample_map asm on asm.artifactid=pio.inputartifactid ")
-    qar.append("where pro2.processid={parent} and pro.typeid in ({typelist}) ")
+    qar.append("where pro2.processid=:parent and pro.typeid = any(:ptypes) ")
     if sample:
-        qar.append("and asm.processid = {sampleid}".format(sampleid=sample))
+        qar.append("and asm.processid = :sampleid")
     qar.append(";") 
-    query=''.join(qar).format(parent=parent_process, typelist=",".join([str(x) for x in ptypes]))
-    return session.query(Process).from_statement(text(query)).all()
+    return ''.join(qar)
 
-def get_children_processes(session, parent_process, ptypes, sample=None, orderby=None):
-    """returns wll the processes that are found in the children of parent_process 
+def get_processes_in_history(session, parent_process, ptypes, sample=None, columns=None):
+    """returns wll the processes that are found in the history of parent_process 
     AND are of type ptypes
 
     :param session: the current SQLAlchemy session to the db
     :param parent_process: the id of the parent_process
     :param ptypes: the LIST of process type ids to be returned
+    :param sample: if defined, filter artifacts that match the correct sample
+    :param columns: if defined, the LIST of Process columns to return as records instead of Process objects, see row_record
 
     """
+    query=_processes_in_history_sql(sample, columns)
+    return _fetch(session, Process, query, columns, parent=parent_process, ptypes=list(ptypes), sampleid=sample)
+
+def iter_processes_in_history(session, parent_process, ptypes, sample=None, batch_size=1000, columns=None):
+    """same as get_processes_in_history, but streams the results with a server-side cursor
 
-    qar1=[   """select pro.* from process pro 
+    :param batch_size: the number of rows fetched from the server at a time
+    :param columns: if defined, the LIST of Process columns to yield as records instead of Process objects
+    :returns: Generator of Process records
+    """
+    query=_processes_in_history_sql(sample, columns)
+    return _stream(session, Process, query, batch_size, columns, parent=parent_process, ptypes=list(ptypes), sampleid=sample)
+
+_ORDERBY=re.compile(r"^(?:pro\.)?(\w+)(?:\s+(asc|desc))?$", re.IGNORECASE)
+
+def _process_orderby(orderby):
+    """validates an order by clause on process columns, as it cannot be passed as a parameter
+
+    :param orderby: str comma-separated process columns, each optionally followed by asc or desc
+    :returns: the normalized order by clause
+    """
+    clauses=[]
+    for clause in orderby.split(','):
+        match=_ORDERBY.match(clause.strip())
+        if not match or match.group(1) not in Process.__table__.c:
+            raise ValueError("Cannot order processes by {}".format(clause.strip()))
+        clauses.append("{} {}".format(match.group(1), (match.group(2) or "asc").lower()))
+    return ", ".join(clauses)
+
+def _children_processes_sql(sample, orderby, columns):
+    cols=_select_list("pro", Process, columns)
+    qar1=[   """select {} from process pro 
             inner join processiotracker piot on piot.processid=pro.processid 
             inner join artifact_ancestor_map aam on aam.artifactid=piot.inputartifactid 
             inner join outputmapping om on aam.ancestorartifactid=om.outputartifactid
-            inner join processiotracker piot2 on piot2.trackerid=om.trackerid """]
-    qar2=[  """select pro.* from process pro 
+            inner join processiotracker piot2 on piot2.trackerid=om.trackerid """.format(cols)]
+    qar2=[  """select {} from process pro 
             inner join processiotracker piot on piot.processid=pro.processid 
             inner join outputmapping om on piot.inputartifactid=om.outputartifactid
-            inner join processiotracker piot2 on piot2.trackerid=om.trackerid """]
+            inner join processiotracker piot2 on piot2.trackerid=om.trackerid """.format(cols)]
     if sample:
         qar1.append("inner join artifact_sample_map asm on asm.artifactid=piot.inputartifactid ")
         qar2.append("inner join artifact_sample_map asm on asm.artifactid=piot.inputartifactid ")
-    qar1.append("where piot2.processid={parent} and pro.typeid in ({typelist}) ")
-    qar2.append("where piot2.processid={parent} and pro.typeid in ({typelist}) ")
+    qar1.append("where piot2.processid=:parent and pro.typeid = any(:ptypes) ")
+    qar2.append("where piot2.processid=:parent and pro.typeid = any(:ptypes) ")
     if sample:
-        qar1.append("and asm.processid = {sampleid}".format(sampleid=sample))
-        qar2.append("and asm.processid = {sampleid}".format(sampleid=sample))
+        qar1.append("and asm.processid = :sampleid ")
+        qar2.append("and asm.processid = :sampleid ")
     if orderby:
-        qar2.append("order by {}".format(orderby))
+        clauses=_process_orderby(orderby)
+        #the order by of a union can only use the selected columns
+        selected=[name for key, name in _columns(Process, columns)] if columns is not None else None
+        for clause in clauses.split(", "):
+            if selected is not None and clause.split()[0] not in selected:
+                raise ValueError("Cannot order processes by {} without selecting it".format(clause.split()[0]))
+        qar2.append("order by {}".format(clauses))
+
+    return "{} union {};".format(''.join(qar1), ''.join(qar2))
 
-    query="{} union {};".format(''.join(qar1), ''.join(qar2)).format(parent=parent_process, typelist=",".join([str(x) for x in ptypes]))
-    return session.query(Process).from_statement(text(query)).all()
+def get_children_processes(session, parent_process, ptypes, sample=None, orderby=None, columns=None):
+    """returns wll the processes that are found in the children of parent_process 
+    AND are of type ptypes
+
+    :param session: the current SQLAlchemy session to the db
+    :param parent_process: the id of the parent_process
+    :param ptypes: the LIST of process type ids to be returned
+    :param sample: if defined, filter artifacts that match the correct sample
+    :param orderby: if defined, comma-separated process columns to order the results by, like "daterun desc"
+    :param columns: if defined, the LIST of Process columns to return as records instead of Process objects, see row_record.
+        The columns of orderby must be part of them.
+
+    """
+    query=_children_processes_sql(sample, orderby, columns)
+    return _fetch(session, Process, query, columns, parent=parent_process, ptypes=list(ptypes), sampleid=sample)
+
+def iter_children_processes(session, parent_process, ptypes, sample=None, orderby=None, batch_size=1000, columns=None):
+    """same as get_children_processes, but streams the results with a server-side cursor
+
+    :param batch_size: the number of rows fetched from the server at a time
+    :param columns: if defined, the LIST of Process columns to yield as records instead of Process objects
+    :returns: Generator of Process records
+    """
+    query=_children_processes_sql(sample, orderby, columns)
+    return _stream(session, Process, query, batch_size, columns, parent=parent_process, ptypes=list(ptypes), sampleid=sample)
+
+
+def load_udf_dicts(session, entity_class, entities, chunk_size=1000):
+    """loads the udfs of a batch of entities of the same class in as few queries as possible,
+    instead of one lazy load per entity.
+
+    If entity objects are given, their udfs relationship is populated with the fetched rows,
+    so that accessing udfs or udf_dict afterwards does not hit the database.
+
+    :param session: the current SQLAlchemy session to the db
+    :param entity_class: one of the classes of UDF_VIEWS (Project, Sample, Artifact, Process, Container, Lab)
+    :param entities: the LIST of entity objects or entity ids (projectid, sampleid, artifactid...)
+    :param chunk_size: the maximum number of ids sent in a single query
+    :returns: dictionnary of entity id : udf dictionnary with correct types
+
+    """
+    view, view_key, entity_key, classid=UDF_VIEWS[entity_class]
+    instances={}
+    ids=[]
+    for entity in entities:
+        if isinstance(entity, entity_class):
+            instances[getattr(entity, entity_key)]=entity
+            ids.append(getattr(entity, entity_key))
+        else:
+            ids.append(entity)
+    rows_by_id=dict((entityid, []) for entityid in ids)
+    unique_ids=list(rows_by_id.keys())
+    for start in range(0, len(unique_ids), chunk_size):
+        query=session.query(view).filter(getattr(view, view_key).in_(unique_ids[start:start+chunk_size]))
+        if classid is not None:
+            query=query.filter(view.attachtoclassid==classid)
+        for udfrow in query:
+            rows_by_id[getattr(udfrow, view_key)].append(udfrow)
+
+    udf_dicts=dict((entityid, udf_rows_to_dict(udfrows)) for entityid, udfrows in rows_by_id.items())
+    for entityid, entity in instances.items():
+        set_committed_value(entity, 'udfs', rows_by_id[entityid])
+        #the cached dictionnary is a copy, so that changing the returned one does not change udf_dict
+        entity._set_udf_dict(dict(udf_dicts[entityid]))
+
+    return udf_dicts
+
+
+def _udf_value(value, udftype):
+    """converts a raw udf value according to its udf type, None when the udf is not set"""
+    if not value:
+        return None
+    elif udftype == "Numeric":
+        return float(value)
+    elif udftype == "Boolean":
+        return value == "True"
+    return value
+
+def _udf_column(values, types):
+    """converts a column of raw udf values according to their udf type.
+    If the column holds several udf types, the raw strings are returned.
+
+    :param values: LIST of udfvalue strings (or None)
+    :param types: LIST of the matching udftype strings (or None)
+    :returns: a tuple (udftype or None if there are several, LIST of typed values, None where the udf is not set)
+    """
+    udftypes=set(t for t in types if t)
+    if len(udftypes) > 1:
+        return None, [v if v else None for v in values]
+    udftype=next(iter(udftypes), None)
+    return udftype, [_udf_value(v, udftype) for v in values]
+
+def _udf_pivot(session, entity_class, udfnames, ids=None):
+    """returns the rows (entity id, value_0, type_0, value_1, type_1...) of the named udfs, pivoted server-side
+    and ordered by entity id"""
+    view, view_key, entity_key, classid=UDF_VIEWS[entity_class]
+    key=getattr(view, view_key)
+    columns=[key]
+    for idx, udfname in enumerate(udfnames):
+        columns.append(func.max(case([(view.udfname==udfname, view.udfvalue)])).label("value_{}".format(idx)))
+        columns.append(func.max(case([(view.udfname==udfname, view.udftype)])).label("type_{}".format(idx)))
+    query=session.query(*columns).filter(view.udfname.in_(udfnames))
+    if classid is not None:
+        query=query.filter(view.attachtoclassid==classid)
+    if ids is not None:
+        query=query.filter(key.in_(ids))
+    return query.group_by(key).order_by(key).all()
+
+def get_udf_columns(session, entity_class, udfnames, ids=None, output="lists"):
+    """gets the values of a few named udfs for many entities, pivoted server-side in a single query.
+
+    The result is column-oriented : one column of entity ids, and one column per udf,
+    typed according to the udf type : Numeric as float, Boolean as bool, others as strings.
+    The udfs stored with several types are returned as strings.
+
+    :param session: the current SQLAlchemy session to the db
+    :param entity_class: one of the classes of UDF_VIEWS (Project, Sample, Artifact, Process, Container, Lab)
+    :param udfnames: the LIST of udf names to fetch
+    :param ids: the LIST of entity ids to restrict the query to. By default, all the entities having one of the udfs.
+    :param output: "lists" returns an OrderedDict of lists (None for unset values),
+        "numpy" an OrderedDict of NumPy arrays (float64 with NaN, bool, or object when a boolean is unset),
+        "pandas" a DataFrame indexed by entity id.
+    :returns: the columns, the first one being named after the id column of the entity (projectid, sampleid...)
+
+    """
+    entity_key=UDF_VIEWS[entity_class][2]
+    rows=_udf_pivot(session, entity_class, udfnames, ids)
+
+    result=OrderedDict()
+    result[entity_key]=[row[0] for row in rows]
+    udftypes={}
+    for idx, udfname in enumerate(udfnames):
+        udftypes[udfname], result[udfname]=_udf_column([row[1+2*idx] for row in rows], [row[2+2*idx] for row in rows])
+
+    if output == "lists":
+        return result
+    elif output in ("numpy", "pandas"):
+        try:
+            import numpy
+        except ImportError:
+            raise Exception("The {} output requires numpy to be installed.".format(output))
+        arrays=OrderedDict()
+        arrays[entity_key]=numpy.array(result[entity_key], dtype=numpy.int64)
+        for udfname in udfnames:
+            values=result[udfname]
+            if udftypes[udfname] == "Numeric":
+                arrays[udfname]=numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+            elif udftypes[udfname] == "Boolean" and None not in values:
+                arrays[udfname]=numpy.array(values, dtype=bool)
+            else:
+                arrays[udfname]=numpy.array(values, dtype=object)
+        if output == "numpy":
+            return arrays
+        try:
+            import pandas
+        except ImportError:
+            raise Exception("The pandas output requires pandas to be installed.")
+        return pandas.DataFrame(arrays).set_index(entity_key)
+    raise Exception("Unknown output {}, valid outputs are lists, numpy and pandas".format(output))
+
+
+def _placement_options(samples):
+    artifacts=samples.selectinload(Sample.artifacts)
+    return [artifacts.joinedload(Artifact.containerplacement).joinedload(ContainerPlacement.container).joinedload(Container.type)]
+
+def _plate_layout_options():
+    return _placement_options(selectinload(Project.samples))
+
+def _sample_sheet_options():
+    samples=selectinload(Project.samples)
+    return [joinedload(Project.researcher), selectinload(Project.udfs),
+            samples.selectinload(Sample.udfs),
+            samples.selectinload(Sample.artifacts).selectinload(Artifact.reagentlabels)]+_placement_options(samples)
+
+def _qc_summary_options():
+    samples=selectinload(Project.samples)
+    artifacts=samples.selectinload(Sample.artifacts)
+    return [samples.selectinload(Sample.udfs), artifacts.selectinload(Artifact.udfs), artifacts.selectinload(Artifact.states)]
+
+LOADING_PROFILES={
+    'plate_layout': _plate_layout_options,
+    'sample_sheet': _sample_sheet_options,
+    'qc_summary':   _qc_summary_options,
+    }
+"""Eager loading profiles of a Project tree
+
+* plate_layout: samples, their artifacts, and the placement, container and container type of each artifact
+* sample_sheet: researcher and udfs of the project, udfs of the samples, reagent labels and placements of the artifacts
+* qc_summary: udfs of the samples, udfs and states (qc flags) of the artifacts
+"""
+
+def loading_options(profile):
+    """gets the loader options of a profile, to be applied to a query on Project::
+
+        session.query(Project).options(*loading_options('plate_layout'))
+
+    :param profile: the name of the profile, one of LOADING_PROFILES
+    :returns: List of SQLAlchemy loader options
+    """
+    if profile not in LOADING_PROFILES:
+        raise ValueError("Unknown loading profile {}, valid profiles are {}".format(profile, ", ".join(sorted(LOADING_PROFILES))))
+    #backrefs like Project.samples only exist once the mappers are configured
+    configure_mappers()
+    return LOADING_PROFILES[profile]()
+
+def undefer_options(groups, path=None):
+    """gets the loader options loading groups of deferred columns with their rows, 
+    instead of on first access, to be applied to a query::
+
+        session.query(Researcher).options(*undefer_options(['avatar']))
+        session.query(Project).options(*undefer_options(['avatar'], joinedload(Project.researcher)))
+
+    :param groups: the LIST of group names, of DEFERRED_GROUPS
+    :param path: if defined, the loader option of the relationship loading the rows with deferred columns
+    :returns: List of SQLAlchemy loader options
+    """
+    for group in groups:
+        if group not in DEFERRED_GROUPS:
+            raise ValueError("Unknown column group {}, valid groups are {}".format(group, ", ".join(sorted(DEFERRED_GROUPS))))
+    if path is None:
+        return [undefer_group(group) for group in groups]
+    return [path.undefer_group(group) for group in groups]
+
+def get_project_tree(session, luid, profile="plate_layout"):
+    """gets a project with the relationships of the given profile already loaded, 
+    in a number of queries that does not depend on the number of samples
+
+    :param session: the current SQLAlchemy session to the db
+    :param luid: the luid of the project
+    :param profile: the name of the loading profile, one of LOADING_PROFILES
+    :returns: the Project, or None
+    """
+    return session.query(Project).options(*loading_options(profile)).filter(Project.luid==luid).first()
+
+
+#rows and columns are the labels of the y and x axes of the container type,
+#grid is a list of rows, each a list of the artifactids placed in that row (or None),
+#wells is a dictionnary of API position string ("A:1") : artifactid,
+#unplaced is the list of the artifactids placed in the container without a well position
+ContainerLayout=namedtuple('ContainerLayout', ['containerid', 'name', 'typename', 'rows', 'columns', 'grid', 'wells', 'unplaced'])
+
+def get_container_layouts(session, containerids):
+    """gets the placements of many containers in a single query, and decodes their positions
+    once per container type instead of once per placement.
+
+    :param session: the current SQLAlchemy session to the db
+    :param containerids: the LIST of (short) container ids
+    :returns: dictionnary of containerid : ContainerLayout
+    """
+    rows=session.query(Container.containerid, Container.name, ContainerType.typeid, ContainerType.name,
+                ContainerType.numxpositions, ContainerType.numypositions, ContainerType.isxalpha, ContainerType.isyalpha,
+                ContainerType.xindexstartsat, ContainerType.yindexstartsat,
+                ContainerPlacement.wellxposition, ContainerPlacement.wellyposition, ContainerPlacement.processartifactid)\
+            .join(ContainerType, Container.typeid==ContainerType.typeid)\
+            .outerjoin(ContainerPlacement, ContainerPlacement.containerid==Container.containerid)\
+            .filter(Container.containerid.in_(list(containerids))).all()
+    labels={}
+    layouts={}
+    for containerid, name, typeid, typename, numx, numy, isxalpha, isyalpha, xstart, ystart, xpos, ypos, artifactid in rows:
+        if typeid not in labels:
+            labels[typeid]=([well_label(isyalpha, ystart or 0, y) for y in range(numy or 0)],
+                            [well_label(isxalpha, xstart or 0, x) for x in range(numx or 0)])
+        ylabels, xlabels=labels[typeid]
+        layout=layouts.get(containerid)
+        if layout is None:
+            layout=ContainerLayout(containerid, name, typename, ylabels, xlabels, [[None]*len(xlabels) for y in ylabels], {}, [])
+            layouts[containerid]=layout
+        if artifactid is None:
+            continue
+        if xpos is None or ypos is None:
+            layout.unplaced.append(artifactid)
+            continue
+        if 0 <= ypos < len(ylabels) and 0 <= xpos < len(xlabels):
+            layout.grid[ypos][xpos]=artifactid
+            position="{0}:{1}".format(ylabels[ypos], xlabels[xpos])
+        else:
+            position="{0}:{1}".format(well_label(isyalpha, ystart or 0, ypos), well_label(isxalpha, xstart or 0, xpos))
+        layout.wells[position]=artifactid
+    return layouts
+
+
+def get_qc_flags(session, artifactids):
+    """gets the qc flag of the latest state of many artifacts in a single query,
+    the states with the same date being ordered by stateid, like Artifact.qc_flag
+
+    :param session: the current SQLAlchemy session to the db
+    :param artifactids: the LIST of (short) artifact ids
+    :returns: dictionnary of artifactid : API qc flag string. Artifacts without states are UNKNOWN.
+    """
+    query="select distinct on (ast.artifactid) ast.artifactid, ast.qcflag \
+            from artifactstate ast \
+            where ast.artifactid = any(:artifactids) \
+            order by ast.artifactid, ast.lastmodifieddate desc nulls last, ast.stateid desc;"
+    artifactids=list(artifactids)
+    flags=dict((artifactid, 'UNKNOWN') for artifactid in artifactids)
+    for artifactid, qcflag in session.execute(_statement(session, query), {'artifactids':artifactids}):
+        flags[artifactid]=QC_FLAGS.get(qcflag, 'ERROR')
+    return flags
@@ -0,0 +1,177 @@
+"""Process-wide cache of the small, near-static reference tables.
+
+The rows of the reference tables are loaded once. The loads of a single row by primary key are then served from memory,
+by merging the cached row into the session without any query, when it is first needed : the many-to-one relationships
+pointing to the reference tables (Process.type, Process.technician, Container.type, Researcher.lab, Project.researcher,
+Principals.researcher...), Session.get, and the refresh of the rows expired by a commit or a rollback::
+
+    from genologics_sql import refcache, utils
+
+    cache=refcache.ReferenceCache(utils.get_engine(), ttl=600)
+    cache.install(utils.get_session_factory())
+
+Setting the reference_cache configuration key to a number of seconds installs a cache with that ttl
+on the session factories of genologics_sql.utils (see utils.get_reference_cache).
+Every ttl seconds, the cache compares max(lastmodifieddate) and the number of rows of each table to the cached ones,
+and reloads the tables that changed, for the sessions created afterwards.
+Once merged, the rows belong to the session, and their pending changes are kept until they are flushed.
+The rows a session wrote are read from the database by that session.
+The other queries, like many-to-many relationships (Artifact.reagentlabels) or filters on the reference tables,
+still read the database.
+"""
+import threading
+import time
+
+from sqlalchemy import event, func, literal, union_all, select
+from sqlalchemy.engine.result import IteratorResult, SimpleResultMetaData
+from sqlalchemy.orm import Session, class_mapper
+from sqlalchemy.orm.attributes import set_committed_value
+
+from genologics_sql.tables import ProcessType, ContainerType, ReagentType, ReagentLabel, Researcher, Principals, Lab
+
+REFERENCE_CLASSES=(ProcessType, ContainerType, ReagentType, ReagentLabel, Researcher, Principals, Lab)
+"""Classes cached by default"""
+
+
+class ReferenceCache(object):
+    """Read-through cache of reference tables, shared by all the sessions of a process.
+
+    :arg engine: the SQLAlchemy engine the tables are read from. Defaults to utils.get_engine()
+    :arg FLOAT ttl: number of seconds between two checks of the tables for changes
+    :arg tuple classes: the mapped classes to cache
+    """
+
+    def __init__(self, engine=None, ttl=300, classes=REFERENCE_CLASSES):
+        self.engine=engine
+        self.ttl=ttl
+        self.classes=tuple(classes)
+        self.version=0
+        self.reloads=0
+        self._rows={}
+        #class : {primary key : row}
+        self._index={}
+        self._signatures={}
+        self._checked=None
+        self._lock=threading.Lock()
+
+    def _session(self):
+        if self.engine is None:
+            from genologics_sql.utils import get_engine
+            self.engine=get_engine()
+        return Session(bind=self.engine, autoflush=False, expire_on_commit=False)
+
+    def _read_signatures(self, session):
+        """returns dictionnary of class : (max(lastmodifieddate), count(*)), in a single query"""
+        parts=[select([literal(index).label('position'), func.max(cls.lastmodifieddate), func.count()]).select_from(cls)
+                for index, cls in enumerate(self.classes)]
+        return dict((self.classes[position], (lastmodified, count)) for position, lastmodified, count in session.execute(union_all(*parts)))
+
+    def revalidate(self, force=False):
+        """reloads the tables that changed, if the ttl is over since the last check
+
+        :param force: if True, checks the tables whatever the ttl
+        :returns: True if some tables were reloaded
+        """
+        if not force and self._checked is not None and time.time()-self._checked < self.ttl:
+            return False
+        with self._lock:
+            if not force and self._checked is not None and time.time()-self._checked < self.ttl:
+                return False
+            session=self._session()
+            try:
+                signatures=self._read_signatures(session)
+                changed=[cls for cls in self.classes if cls not in self._rows or signatures[cls] != self._signatures.get(cls)]
+                rows=dict(self._rows)
+                index=dict(self._index)
+                for cls in changed:
+                    rows[cls]=session.query(cls).all()
+                    index[cls]=dict((class_mapper(cls).identity_key_from_instance(row)[1], row) for row in rows[cls])
+                session.expunge_all()
+            finally:
+                session.close()
+            self._signatures=signatures
+            self._checked=time.time()
+            if changed:
+                self._rows=rows
+                self._index=index
+                self.version+=1
+                self.reloads+=len(changed)
+            return bool(changed)
+
+    def rows(self, cls):
+        """returns the cached, detached, rows of <cls>. Their relationships and deferred columns cannot be loaded."""
+        self.revalidate()
+        return list(self._rows[cls])
+
+    def get(self, cls, primary_key_identity):
+        """returns the cached, detached, row of <cls> with the given primary key, or None
+
+        :param cls: the mapped class
+        :param primary_key_identity: the tuple of the primary key values
+        """
+        self.revalidate()
+        return self._index[cls].get(tuple(primary_key_identity))
+
+    def _primary_key_identity(self, orm_execute_state):
+        """returns the class and primary key of a load by primary key of a cached class, or (None, None)"""
+        if not orm_execute_state.is_select or not orm_execute_state.parameters:
+            return None, None
+        mapper=orm_execute_state.bind_mapper
+        if mapper is None or mapper.class_ not in self.classes:
+            return None, None
+        #the loads by primary key (lazy many-to-one loads, Session.get, refresh of expired rows)
+        #use the bound parameters of the mapper's get clause, and nothing else
+        get_params=mapper._get_clause[1]
+        parameters=orm_execute_state.parameters
+        if len(parameters) != len(get_params) or any(param.key not in parameters for param in get_params.values()):
+            return None, None
+        return mapper.class_, tuple(parameters[get_params[column].key] for column in mapper.primary_key)
+
+    def _do_orm_execute(self, orm_execute_state):
+        cls, primary_key_identity=self._primary_key_identity(orm_execute_state)
+        if cls is None:
+            return None
+        session=orm_execute_state.session
+        if (cls, primary_key_identity) in session.info.get('genologics_sql_refcache_written', ()):
+            return None
+        row=self.get(cls, primary_key_identity)
+        if row is None:
+            return None
+        refresh_state=orm_execute_state.load_options._refresh_state
+        if refresh_state is not None:
+            #the unloaded attributes are set from the cached row, the others are left as they are
+            instance=refresh_state.obj()
+            with session.no_autoflush:
+                for key in refresh_state.unloaded:
+                    if key in row.__dict__:
+                        set_committed_value(instance, key, row.__dict__[key])
+        else:
+            with session.no_autoflush:
+                instance=session.merge(row, load=False)
+        return IteratorResult(SimpleResultMetaData([cls.__name__]), iter([(instance,)]))
+
+    def _after_flush(self, session, flush_context):
+        #the rows written by the session are read from the database, as the cache only sees them after its next reload
+        written=session.info.setdefault('genologics_sql_refcache_written', set())
+        for instance in list(session.new)+list(session.dirty)+list(session.deleted):
+            if isinstance(instance, self.classes):
+                mapper=class_mapper(type(instance))
+                written.add((mapper.class_, tuple(mapper.primary_key_from_instance(instance))))
+
+    def install(self, factory):
+        """serves the loads by primary key of the sessions of <factory> from the cache
+
+        :param factory: the sessionmaker, or Session class
+        """
+        event.listen(factory, 'do_orm_execute', self._do_orm_execute)
+        event.listen(factory, 'after_flush', self._after_flush)
+
+    def uninstall(self, factory):
+        """stops serving the sessions of <factory> from the cache"""
+        event.remove(factory, 'do_orm_execute', self._do_orm_execute)
+        event.remove(factory, 'after_flush', self._after_flush)
+
+    def __repr__(self):
+        return "<ReferenceCache(tables={}, rows={}, ttl={}, version={})>".format(len(self.classes),
+                sum(len(rows) for rows in self._rows.values()), self.ttl, self.version)
+
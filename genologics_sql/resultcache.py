@@ -0,0 +1,352 @@
+"""Persistent cache of the results of expensive queries, stored in a local SQLite file.
+
+Each entry is keyed by the query function and its normalized parameters, and stores the watermark of the data it depends on.
+A cached result is used only if it did not expire, and if the current watermark is equal to the stored one::
+
+    from genologics_sql import resultcache, utils
+
+    cache=resultcache.ResultCache("~/.genologics_sql_cache.sqlite", ttl=3600, max_size=512*1024*1024)
+    with utils.session_scope() as session:
+        processes=cache.get_children_processes(session, parent_process, [38, 714])
+
+The watermark of a query is computed from the projects it covers : for closed projects (with a closedate), it is only their closedates,
+and their entries do not expire by default. For open projects, it is the latest lastmodifieddate of the sources of the project change feed
+(see queries.PROJECT_CHANGE_SOURCES), read from the rows of these projects only, so that any change in the projects
+invalidates the entries.
+The values are stored as JSON : the mapped objects are stored as their loaded columns and relationships,
+and built again, detached, when they are read, before being merged in the session.
+The keys include a digest of the mapped tables, so that the entries written by another version of the package are not read.
+Setting the result_cache configuration key to a file path creates a cache used through utils.get_result_cache.
+"""
+import base64
+import datetime
+import decimal
+import hashlib
+import json
+import os
+import sqlite3
+import sqlalchemy
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from sqlalchemy.orm import class_mapper, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from genologics_sql import queries
+from genologics_sql.tables import Base, Project
+
+SCHEMA="create table if not exists entries (key text primary key, function text, watermark blob, value blob, \
+        size integer, created real, accessed real, expires real)"
+
+PROJECTS_STATE_QUERY="select count(*), count(pj.closedate), max(pj.closedate) from project pj where pj.projectid = any(:projectids);"
+
+PROCESS_PROJECTS_QUERY="select distinct sa.projectid from processiotracker pio \
+        inner join artifact_sample_map asm on asm.artifactid=pio.inputartifactid \
+        inner join sample sa on sa.processid=asm.processid \
+        where pio.processid = :processid;"
+
+
+def _watermark_query():
+    """builds the query of the latest modification date of the projects, over the sources of the project change feed.
+    Each source only reads the rows of the projects, instead of the whole feed being computed then filtered."""
+    parts=[]
+    for projectid, date, from_clause, extra in queries.PROJECT_CHANGE_SOURCES.values():
+        cond="{} = any(:projectids)".format(projectid)
+        if extra:
+            cond="{} and {}".format(extra, cond)
+        parts.append("select max({date}) as lastmodifieddate from {from_clause} where {cond}".format(
+            date=date, from_clause=from_clause, cond=cond))
+    return "select max(feed.lastmodifieddate) from ({}) feed;".format(" union all ".join(parts))
+
+PROJECTS_WATERMARK_QUERY=_watermark_query()
+
+
+def projects_watermark(session, projectids):
+    """returns the watermark of the data of the given projects
+
+    :param session: the current SQLAlchemy session to the db
+    :param projectids: the LIST of (short) project ids
+    :returns: a tuple ('closed', number of projects, latest closedate) if all the projects are closed,
+              ('open', latest modification date of the projects) otherwise
+    """
+    projectids=sorted(set(projectids))
+    count, closed, closedate=session.execute(queries._statement(session, PROJECTS_STATE_QUERY), {'projectids':projectids}).first()
+    if projectids and count == closed:
+        return ('closed', count, closedate)
+    return ('open', session.execute(queries._statement(session, PROJECTS_WATERMARK_QUERY), {'projectids':projectids}).scalar())
+
+def process_watermark(session, processid):
+    """returns the watermark of the projects of the inputs of a process, see projects_watermark"""
+    projectids=[projectid for projectid, in session.execute(queries._statement(session, PROCESS_PROJECTS_QUERY), {'processid':processid})]
+    return projects_watermark(session, projectids)
+
+def project_watermark(session, luid):
+    """returns the watermark of a project given by luid, see projects_watermark"""
+    projectids=[projectid for projectid, in session.query(Project.projectid).filter(Project.luid == luid)]
+    return projects_watermark(session, projectids)
+
+
+FORMAT_VERSION=1
+"""Version of the format of the stored values"""
+
+def _schema_version():
+    """returns a digest of the format of the values, and of the mapped tables and their columns"""
+    tables=sorted((table.name, sorted(column.name for column in table.columns)) for table in Base.metadata.tables.values())
+    return hashlib.sha1(repr((FORMAT_VERSION, sqlalchemy.__version__, tables)).encode('utf-8')).hexdigest()[:12]
+
+SCHEMA_VERSION=_schema_version()
+
+#name : mapped class, to build the stored objects again
+_CLASSES=dict((mapper.class_.__name__, mapper.class_) for mapper in Base.registry.mappers)
+
+
+def _dump(value, memo, pending):
+    """returns the JSON-compatible representation of a value. The mapped objects are replaced by their index in the entities,
+    and queued in pending to be dumped in turn, so that the object graphs are not walked recursively."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, '_sa_instance_state'):
+        index=memo.get(id(value))
+        if index is None:
+            index=memo[id(value)]=len(memo)
+            pending.append(value)
+        return {'entity':index}
+    if isinstance(value, datetime.datetime):
+        return {'datetime':value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'date':value.isoformat()}
+    if isinstance(value, decimal.Decimal):
+        return {'decimal':str(value)}
+    if isinstance(value, bytes):
+        return {'bytes':base64.b64encode(value).decode('ascii')}
+    if isinstance(value, list):
+        return {'list':[_dump(item, memo, pending) for item in value]}
+    if type(value) is tuple:
+        return {'tuple':[_dump(item, memo, pending) for item in value]}
+    if isinstance(value, dict):
+        return {'dict':[[_dump(key, memo, pending), _dump(item, memo, pending)] for key, item in value.items()]}
+    raise TypeError("Values of type {} cannot be stored in the result cache".format(type(value).__name__))
+
+def _dumps(value):
+    """returns the JSON string of a value, see _dump"""
+    memo={}
+    pending=deque()
+    root=_dump(value, memo, pending)
+    entities=[]
+    while pending:
+        state=pending.popleft()._sa_instance_state
+        mapper=state.mapper
+        columns=dict((prop.key, _dump(state.dict[prop.key], memo, pending)) for prop in mapper.column_attrs if prop.key in state.dict)
+        relationships=dict((prop.key, _dump(state.dict[prop.key], memo, pending)) for prop in mapper.relationships if prop.key in state.dict)
+        entities.append({'class':mapper.class_.__name__, 'columns':columns, 'relationships':relationships})
+    return json.dumps({'value':root, 'entities':entities}, separators=(',', ':'))
+
+def _load(value, instances):
+    """returns the value of a representation built by _dump"""
+    if not isinstance(value, dict):
+        return value
+    kind, data=next(iter(value.items()))
+    if kind == 'entity':
+        return instances[data]
+    if kind == 'datetime':
+        return datetime.datetime.fromisoformat(data)
+    if kind == 'date':
+        return datetime.date.fromisoformat(data)
+    if kind == 'decimal':
+        return decimal.Decimal(data)
+    if kind == 'bytes':
+        return base64.b64decode(data)
+    if kind == 'list':
+        return [_load(item, instances) for item in data]
+    if kind == 'tuple':
+        return tuple(_load(item, instances) for item in data)
+    return dict((_load(key, instances), _load(item, instances)) for key, item in data)
+
+def _loads(data):
+    """returns the value of a JSON string built by _dumps, with detached mapped objects"""
+    data=json.loads(data)
+    instances=[]
+    for entity in data['entities']:
+        instance=class_mapper(_CLASSES[entity['class']]).class_manager.new_instance()
+        for key, value in entity['columns'].items():
+            set_committed_value(instance, key, _load(value, instances))
+        make_transient_to_detached(instance)
+        instances.append(instance)
+    #the relationships are set once all the objects exist
+    for instance, entity in zip(instances, data['entities']):
+        for key, value in entity['relationships'].items():
+            set_committed_value(instance, key, _load(value, instances))
+    return _load(data['value'], instances)
+
+
+def _normalize(value):
+    """returns a representation of a parameter that does not depend on the order of sets and dictionnaries.
+    The order of lists is kept, as it can change the result : the wrappers sort the lists that are used as sets."""
+    if isinstance(value, (set, frozenset)):
+        return sorted((_normalize(item) for item in value), key=repr)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return sorted((repr(key), _normalize(item)) for key, item in value.items())
+    return value
+
+def cache_key(function, *args, **kwargs):
+    """returns the key of the call function(*args, **kwargs), the session being left out
+
+    :param function: the query function, or its name
+    :returns: the key string
+    """
+    name=function if isinstance(function, str) else "{}.{}".format(function.__module__, function.__name__)
+    params=repr((SCHEMA_VERSION, name, [_normalize(arg) for arg in args], _normalize(kwargs)))
+    return "{}:{}".format(name, hashlib.sha1(params.encode('utf-8')).hexdigest())
+
+
+class ResultCache(object):
+    """Persistent, size-bounded cache of query results.
+
+    :arg STRING path: path of the SQLite file. It is shared by the processes using the same path.
+    :arg FLOAT ttl: number of seconds after which the entries of open projects expire. None for no expiry.
+    :arg FLOAT closed_ttl: number of seconds after which the entries of closed projects expire. None for no expiry.
+    :arg INTEGER max_size: size of the stored results, in bytes, above which the least recently used entries are evicted
+    :arg INTEGER hits: number of results served from the cache
+    :arg INTEGER misses: number of results computed by the database
+    """
+
+    def __init__(self, path, ttl=24*3600, closed_ttl=None, max_size=256*1024*1024):
+        self.path=os.path.expanduser(path)
+        self.ttl=ttl
+        self.closed_ttl=closed_ttl
+        self.max_size=max_size
+        self.hits=0
+        self.misses=0
+        self._lock=threading.Lock()
+        with self._connection() as connection:
+            connection.execute("pragma journal_mode=wal")
+            connection.execute(SCHEMA)
+            connection.execute("create index if not exists entries_accessed on entries (accessed)")
+
+    @contextmanager
+    def _connection(self):
+        connection=sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key, watermark=None):
+        """returns the cached value of <key>
+
+        :param key: the key of the entry
+        :param watermark: the current watermark of the data. The entry is only valid if it was stored with the same watermark.
+        :returns: a tuple (found, value)
+        """
+        now=time.time()
+        with self._connection() as connection:
+            row=connection.execute("select watermark, value, expires from entries where key = ?", (key,)).fetchone()
+            if row is None:
+                return False, None
+            stored, value, expires=row
+            if (expires is not None and expires < now) or stored != _dumps(watermark):
+                connection.execute("delete from entries where key = ?", (key,))
+                return False, None
+            connection.execute("update entries set accessed = ? where key = ?", (now, key))
+        return True, _loads(value)
+
+    def put(self, key, value, watermark=None, ttl=None):
+        """stores the value of <key>, and evicts the least recently used entries if the cache is too large
+
+        :param key: the key of the entry
+        :param value: the value, made of mapped objects, lists, tuples, dictionnaries, numbers, strings, bytes and dates
+        :param watermark: the watermark of the data the value was computed from
+        :param ttl: number of seconds after which the entry expires. None for no expiry.
+        """
+        now=time.time()
+        data=_dumps(value)
+        with self._connection() as connection:
+            connection.execute("insert or replace into entries values (?, ?, ?, ?, ?, ?, ?, ?)", (key, key.split(':')[0],
+                    _dumps(watermark), data, len(data.encode('utf-8')), now, now, now+ttl if ttl is not None else None))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        total=connection.execute("select coalesce(sum(size), 0) from entries").fetchone()[0]
+        if total <= self.max_size:
+            return
+        connection.execute("delete from entries where expires is not null and expires < ?", (time.time(),))
+        for key, size in connection.execute("select key, size from entries order by accessed").fetchall():
+            if total <= self.max_size:
+                break
+            connection.execute("delete from entries where key = ?", (key,))
+            total-=size
+
+    def invalidate(self, function=None):
+        """removes the entries of a function, or all of them
+
+        :param function: the query function, or its name. All the entries are removed if not defined.
+        """
+        with self._connection() as connection:
+            if function is None:
+                connection.execute("delete from entries")
+            else:
+                name=function if isinstance(function, str) else "{}.{}".format(function.__module__, function.__name__)
+                connection.execute("delete from entries where function = ?", (name,))
+
+    def call(self, session, function, watermark, *args, **kwargs):
+        """returns the result of function(session, *args, **kwargs), from the cache if it is valid.
+        The mapped objects of the results are merged in the session without querying the database.
+
+        :param session: the current SQLAlchemy session to the db
+        :param function: the query function
+        :param watermark: the watermark of the data the function reads, see projects_watermark
+        :returns: the result of the function
+        """
+        key=cache_key(function, *args, **kwargs)
+        found, value=self.get(key, watermark)
+        if found:
+            with self._lock:
+                self.hits+=1
+            return _merge(session, value)
+        with self._lock:
+            self.misses+=1
+        value=function(session, *args, **kwargs)
+        closed=isinstance(watermark, tuple) and watermark[0] == 'closed'
+        self.put(key, value, watermark, self.closed_ttl if closed else self.ttl)
+        return value
+
+    def get_children_processes(self, session, parent_process, ptypes, sample=None, orderby=None):
+        """cached version of queries.get_children_processes"""
+        return self.call(session, queries.get_children_processes, process_watermark(session, parent_process),
+                parent_process, sorted(ptypes), sample=sample, orderby=orderby)
+
+    def get_processes_in_history(self, session, parent_process, ptypes, sample=None):
+        """cached version of queries.get_processes_in_history"""
+        return self.call(session, queries.get_processes_in_history, process_watermark(session, parent_process),
+                parent_process, sorted(ptypes), sample=sample)
+
+    def get_project_tree(self, session, luid, profile="plate_layout"):
+        """cached version of queries.get_project_tree"""
+        return self.call(session, queries.get_project_tree, project_watermark(session, luid), luid, profile=profile)
+
+    def get_project_udf_columns(self, session, udfnames, projectids, output="lists"):
+        """cached version of queries.get_udf_columns for Project udfs
+
+        :param projectids: the LIST of (short) project ids
+        """
+        return self.call(session, _project_udf_columns, projects_watermark(session, projectids), list(udfnames), sorted(projectids), output=output)
+
+    def __repr__(self):
+        return "<ResultCache(path={}, hits={}, misses={})>".format(self.path, self.hits, self.misses)
+
+
+def _project_udf_columns(session, udfnames, projectids, output="lists"):
+    return queries.get_udf_columns(session, Project, udfnames, ids=projectids, output=output)
+
+def _merge(session, value):
+    """merges the mapped objects of a cached value in the session"""
+    if isinstance(value, list):
+        return [_merge(session, item) for item in value]
+    if hasattr(value, '_sa_instance_state'):
+        return session.merge(value, load=False)
+    return value
@@ -1,12 +1,191 @@
 from sqlalchemy import Table, ForeignKey, Column, Boolean, Integer, Float, String, TIMESTAMP, LargeBinary, sql
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy import event, case, func, select, exists, cast, and_
 
 #Module used to map the tables from Genologics's Postgres instance
 
 Base = declarative_base()
 
+#API strings of the artifactstate.qcflag values
+QC_FLAGS={0:'UNKNOWN', 1:'PASSED', 2:'FAILED'}
+
+
+def udf_rows_to_dict(udfrows):
+    """Converts udf view rows to a dictionnary of udfs with correct types (Strings, Floats and Booleans).
+
+    :param udfrows: iterable of udf view rows (EntityUdfView, SampleUdfView, ArtifactUdfView, ProcessUdfView)
+    :returns: dictionnary of udfname : typed udfvalue. Empty values are skipped.
+    """
+    udf_dict={}
+    for udfrow in udfrows:
+        if udfrow.udfvalue:
+            if udfrow.udftype == "Numeric":
+                udf_dict[udfrow.udfname]=float(udfrow.udfvalue)
+            elif udfrow.udftype == "Boolean":
+                udf_dict[udfrow.udfname]=(udfrow.udfvalue=="True")
+            else:
+                udf_dict[udfrow.udfname]=udfrow.udfvalue
+
+    return udf_dict
+
+
+def well_label(isalpha, indexstartsat, position):
+    """Converts a position on one axis of a container to the label the API uses
+
+    :param isalpha: True if the axis is coded by letter
+    :param indexstartsat: first value of the axis
+    :param position: the 0-based position (wellxposition or wellyposition)
+    :returns: the letter, or the number, of the position
+    """
+    value=indexstartsat+position
+    if isalpha:
+        return chr(65+value)
+    return value
+
+
+class UdfCacheStats(object):
+    """Counts the hits and misses of the udf_dict cache of all the entities"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits=0
+        self.misses=0
+
+    @property
+    def hit_rate(self):
+        total=self.hits+self.misses
+        if not total:
+            return 0.0
+        return float(self.hits)/total
+
+    def __repr__(self):
+        return "<UdfCacheStats(hits={}, misses={}, hit_rate={:.2f})>".format(self.hits, self.misses, self.hit_rate)
+
+udf_cache_stats=UdfCacheStats()
+"""Global udf_dict cache counters"""
+
+
+class UdfComparator(object):
+    """SQL side of a single udf of an entity class, compiled to EXISTS subqueries over the udf view of the entity.
+
+    Numbers are compared to the udf value cast to float, for Numeric udfs only, 
+    booleans to the 'True' and 'False' strings, and anything else to the string value.
+    Entities that do not have the udf never match, not even with !=.
+
+        session.query(Project).filter(Project.udf('Sequencing platform') == 'NovaSeq')
+        session.query(Sample).filter(Sample.udf('Concentration') >= 2.5)
+
+    :param entity: the entity class, one of UDF_VIEWS
+    :param udfname: the name of the udf
+    """
+
+    def __init__(self, entity, udfname):
+        self.entity=entity
+        self.udfname=udfname
+
+    def _exists(self, condition=None):
+        view, view_id, entity_id, classid=UDF_VIEWS[self.entity]
+        conditions=[getattr(view, view_id)==getattr(self.entity, entity_id), view.udfname==self.udfname]
+        if classid is not None:
+            conditions.append(view.attachtoclassid==classid)
+        if condition is not None:
+            conditions.append(condition)
+        return exists().where(and_(*conditions))
+
+    def _compare(self, operator, other):
+        view=UDF_VIEWS[self.entity][0]
+        if isinstance(other, bool):
+            value=view.udfvalue
+            other=str(other)
+        elif isinstance(other, (int, float)):
+            #CASE makes sure that only the values of Numeric udfs are cast
+            value=case([(view.udftype=='Numeric', cast(func.nullif(view.udfvalue, ''), Float))])
+        else:
+            value=view.udfvalue
+        return self._exists(operator(value, other))
+
+    def __eq__(self, other):
+        return self._compare(lambda value, other:value == other, other)
+
+    def __ne__(self, other):
+        return self._compare(lambda value, other:value != other, other)
+
+    def __lt__(self, other):
+        return self._compare(lambda value, other:value < other, other)
+
+    def __le__(self, other):
+        return self._compare(lambda value, other:value <= other, other)
+
+    def __gt__(self, other):
+        return self._compare(lambda value, other:value > other, other)
+
+    def __ge__(self, other):
+        return self._compare(lambda value, other:value >= other, other)
+
+    def in_(self, others):
+        others=list(others)
+        if others and all(isinstance(other, (int, float)) and not isinstance(other, bool) for other in others):
+            return self._compare(lambda value, others:value.in_(others), others)
+        return self._exists(UDF_VIEWS[self.entity][0].udfvalue.in_([str(other) if isinstance(other, bool) else other for other in others]))
+
+    def like(self, pattern):
+        return self._exists(UDF_VIEWS[self.entity][0].udfvalue.like(pattern))
+
+    def has_value(self):
+        """matches the entities where the udf is set to a non-empty value"""
+        return self._exists(func.coalesce(UDF_VIEWS[self.entity][0].udfvalue, '') != '')
+
+
+class UdfExpressions(object):
+    """SQL side of udf_dict : udf_dict[udfname] is the UdfComparator of the udf"""
+
+    def __init__(self, entity):
+        self.entity=entity
+
+    def __getitem__(self, udfname):
+        return UdfComparator(self.entity, udfname)
+
+
+class UdfDictMixin(object):
+    """Provides udf_dict to the entities having a udfs relationship.
+
+    The dictionnary is built once, then cached on the instance until the instance or its udfs
+    are expired, refreshed or modified. Each access returns a copy of the cached dictionnary,
+    which can be modified without changing the next accesses.
+
+    On the class, udf(udfname) and udf_dict[udfname] build filters over the udf view (see UdfComparator).
+    """
+
+    @hybrid_property
+    def udf_dict(self):
+        udf_dict=self.__dict__.get('_udf_dict_cache')
+        if udf_dict is None:
+            udf_cache_stats.misses+=1
+            udf_dict=udf_rows_to_dict(self.udfs)
+            self.__dict__['_udf_dict_cache']=udf_dict
+        else:
+            udf_cache_stats.hits+=1
+        return dict(udf_dict)
+
+    @udf_dict.expression
+    def udf_dict(cls):
+        return UdfExpressions(cls)
+
+    @classmethod
+    def udf(cls, udfname):
+        """returns the UdfComparator of the udf <udfname>, to be used in query filters"""
+        return UdfComparator(cls, udfname)
+
+    def _set_udf_dict(self, udf_dict):
+        self.__dict__['_udf_dict_cache']=udf_dict
+
+    def _reset_udf_dict(self):
+        self.__dict__.pop('_udf_dict_cache', None)
+
 
 #Junction tables
 
@@ -56,7 +235,7 @@ class EntityUdfView(Base):
     def __repr__(self):
         return "<EntityUdf(id={}, class={}, key={}, value={})>".format(self.attachtoid, self.attachtoclassid, self.udfname, self.udfvalue)
 
-class Project(Base):
+class Project(UdfDictMixin, Base):
     """Table storing project objects
 
     :arg INTEGER projectid: the _internal_ project ID. **Primary key.** 
@@ -105,20 +284,6 @@ class Project(Base):
 
     researcher = relationship("Researcher", uselist=False)
 
-    @hybrid_property
-    def udf_dict(self):
-        udf_dict={}
-        for udfrow in self.udfs:
-            if udfrow.udfvalue:
-                if udfrow.udftype == "Numeric":
-                    udf_dict[udfrow.udfname]=float(udfrow.udfvalue)
-                elif udfrow.udftype == "Boolean":
-                    udf_dict[udfrow.udfname]=(udfrow.udfvalue=="True")
-                else:
-                    udf_dict[udfrow.udfname]=udfrow.udfvalue
-
-        return udf_dict
-
     def __repr__(self):
         return "<Project(id={}, name={})>".format(self.projectid, self.name)
 
@@ -147,7 +312,7 @@ class SampleUdfView(Base):
     def __repr__(self):
         return "<SampleUdf(id={}, key={}, value={})>".format(self.sampleid, self.udfname, self.udfvalue)
 
-class Sample(Base):
+class Sample(UdfDictMixin, Base):
     """
     Table mapping the samples
 
@@ -192,20 +357,6 @@ class Sample(Base):
             uselist=False
             )
 
-    @hybrid_property
-    def udf_dict(self):
-        udf_dict={}
-        for udfrow in self.udfs:
-            if udfrow.udfvalue:
-                if udfrow.udftype == "Numeric":
-                    udf_dict[udfrow.udfname]=float(udfrow.udfvalue)
-                elif udfrow.udftype == "Boolean":
-                    udf_dict[udfrow.udfname]=(udfrow.udfvalue=="True")
-                else:
-                    udf_dict[udfrow.udfname]=udfrow.udfvalue
-                
-        return udf_dict
-
     def __repr__(self):
         return "<Sample(id={}, name={})>".format(self.sampleid, self.name)
 
@@ -233,7 +384,7 @@ class ProcessType(Base):
     :arg TIMESTAMP lastmodifieddate: timestamp of the last modification 
     :arg INTEGER lastmodifiedby: ID of the last modifier 
     :arg STRING behaviourname: *unknown*
-    :arg STRING pmetadata: html string likely containing display data. The actual column name is metadata, but that causes namespace conflicts.
+    :arg STRING pmetadata: html string likely containing display data. The actual column name is metadata, but that causes namespace conflicts. Deferred, in the metadata group.
     :arg BOOLEAN canedit: is that type editable
     :arg STRING modulename: Java module tied to this type 
     :arg STRING expertname: Java class tied to this type
@@ -260,7 +411,7 @@ class ProcessType(Base):
     lastmodifieddate =  Column(TIMESTAMP)
     lastmodifiedby =    Column(Integer)
     behaviourname =     Column(String)
-    pmetadata =         Column('metadata', String)
+    pmetadata =         deferred(Column('metadata', String), group='metadata')
     canedit =           Column(Boolean)
     modulename =        Column(String)
     expertname =        Column(String)
@@ -268,7 +419,7 @@ class ProcessType(Base):
     def __repr__(self):
         return "<ProcessType(id={}, name={})>".format(self.typeid, self.typename)
 
-class Process(Base):
+class Process(UdfDictMixin, Base):
     """Table mapping process objects
 
     :arg INTEGER processid: the (short) process ID. **Primary key.** 
@@ -333,21 +484,7 @@ class Process(Base):
     def __repr__(self):
         return "<Process(id={}, type={})>".format(self.processid, self.typeid)
 
-    @hybrid_property
-    def udf_dict(self):
-        udf_dict={}
-        for udfrow in self.udfs:
-            if udfrow.udfvalue:
-                if udfrow.udftype == "Numeric":
-                    udf_dict[udfrow.udfname]=float(udfrow.udfvalue)
-                elif udfrow.udftype == "Boolean":
-                    udf_dict[udfrow.udfname]=(udfrow.udfvalue=="True")
-                else:
-                    udf_dict[udfrow.udfname]=udfrow.udfvalue
-                
-        return udf_dict
-
-class Artifact(Base):
+class Artifact(UdfDictMixin, Base):
     """Table mapping artifact objects
 
     :arg INTEGER artifactid: the (short) artifact ID. **Primary key.** 
@@ -418,31 +555,21 @@ class Artifact(Base):
     containerplacement = relationship('ContainerPlacement', uselist=False, backref='artifact')
     routes = relationship("RoutingAction", backref='artifact')
 
-    @hybrid_property
-    def udf_dict(self):
-        udf_dict={}
-        for udfrow in self.udfs:
-            if udfrow.udfvalue:
-                if udfrow.udftype == "Numeric":
-                    udf_dict[udfrow.udfname]=float(udfrow.udfvalue)
-                elif udfrow.udftype == "Boolean":
-                    udf_dict[udfrow.udfname]=(udfrow.udfvalue=="True")
-                else:
-                    udf_dict[udfrow.udfname]=udfrow.udfvalue
-                
-        return udf_dict
-
     @hybrid_property
     def qc_flag(self):
-        latest_state=sorted(self.states, key=lambda x:x.lastmodifieddate)[-1]
-        if latest_state.qcflag==0:
+        if not self.states:
             return 'UNKNOWN'
-        elif latest_state.qcflag==1:
-            return 'PASSED'
-        elif latest_state.qcflag==2:
-            return 'FAILED'
-        else:
-            return 'ERROR'
+        #the states without date are the oldest ones, the ties are resolved by stateid like on the sql side
+        latest_state=max(self.states, key=lambda x:(x.lastmodifieddate is not None, x.lastmodifieddate, x.stateid))
+        return QC_FLAGS.get(latest_state.qcflag, 'ERROR')
+
+    @qc_flag.expression
+    def qc_flag(cls):
+        #qcflag of the latest state, artifacts without states being UNKNOWN
+        latest=select([ArtifactState.qcflag]).where(ArtifactState.artifactid==cls.artifactid)\
+                .order_by(ArtifactState.lastmodifieddate.desc().nullslast(), ArtifactState.stateid.desc())\
+                .limit(1).correlate(cls).scalar_subquery()
+        return case(QC_FLAGS, value=func.coalesce(latest, 0), else_='ERROR')
 
 
     def __repr__(self):
@@ -540,26 +667,12 @@ class ContainerPlacement(Base):
     def get_x_position(self):
         """Get the X position of the placement according to Container type"""
         ctype=self.container.type
-        start=0
-        if ctype.isxalpha:
-            start=65
-        start+=ctype.xindexstartsat
-        value=start+self.wellxposition
-        if ctype.isxalpha:
-            return chr(value)
-        return value
+        return well_label(ctype.isxalpha, ctype.xindexstartsat, self.wellxposition)
 
     def get_y_position(self):
         """Get the Y position of the placement according to Container type"""
         ctype=self.container.type
-        start=0
-        if ctype.isyalpha:
-            start=65
-        start+=ctype.yindexstartsat
-        value=start+self.wellyposition
-        if ctype.isyalpha:
-            return chr(value)
-        return value
+        return well_label(ctype.isyalpha, ctype.yindexstartsat, self.wellyposition)
 
     @hybrid_property
     def api_string(self):
@@ -569,7 +682,7 @@ class ContainerPlacement(Base):
         return "<ContainerPlacement(id={}, pos={}:{}, cont={}, art={})>".format(self.placementid, self.wellxposition, self.wellyposition, self.containerid, self.processartifactid)
 
 
-class Container(Base):
+class Container(UdfDictMixin, Base):
     """Table mapping containers
 
     :arg INTEGER containerid: The (short) container id. Primary Key.
@@ -591,6 +704,7 @@ class Container(Base):
     The following attributes are *not* found in the table, but are available through mapping
 
     :arg EntityUdfView udfs: EntityUdfView row associated with the Container row.
+    :arg dict udf_dict: A dictionnary of udfs with correct types (Strings, Floats and Booleans).
     :arg ContainerType type: ContainerType row associated with the Container row.
 
     """
@@ -837,6 +951,8 @@ class Researcher(Base):
     :arg LARGEBINARY avatar: base64 encoding of the avatar image
     :arg STRING avatarcontenttype: mime type of the avatar image
 
+    The requested* columns are deferred in the account_request group, avatar and avatarcontenttype in the avatar group.
+
     """
     __tablename__ = 'researcher'
     researcherid =      Column(Integer, primary_key=True)
@@ -858,13 +974,13 @@ class Researcher(Base):
     labid =             Column(Integer, ForeignKey('lab.labid')) 
     supervisorid =      Column(Integer) 
     isapproved =        Column(Boolean) 
-    requestedsupervisorfirstname =  Column(String) 
-    requestedsupervisorlastname =   Column(String) 
-    requestedusername = Column(String) 
-    requestedpassword = Column(String) 
-    requestedlabname =  Column(String) 
-    avatar =            Column(LargeBinary) 
-    avatarcontenttype = Column(String) 
+    requestedsupervisorfirstname =  deferred(Column(String), group='account_request')
+    requestedsupervisorlastname =   deferred(Column(String), group='account_request')
+    requestedusername = deferred(Column(String), group='account_request')
+    requestedpassword = deferred(Column(String), group='account_request')
+    requestedlabname =  deferred(Column(String), group='account_request')
+    avatar =            deferred(Column(LargeBinary), group='avatar')
+    avatarcontenttype = deferred(Column(String), group='avatar')
 
     lab=relationship("Lab",uselist=False)
 
@@ -881,7 +997,7 @@ class EscalationEvent(Base):
     :arg TIMESTAMP escalationdate: timestamp of the review request
     :arg TIMESTAMP reviewdate: timestamp of the review completion
     :arg STRING escalationcomment: comment of the review request
-    :arg STRING reviewcomment: comment of the review completion
+    :arg STRING reviewcomment: comment of the review completion. Both comments are deferred, in the comments group.
     :arg INTEGER datastoreid: id of the associated datastore
     :arg BOOLEAN isglobal: *unknown*
     :arg INTEGER ownerid: Researcher ID of the container creator
@@ -897,8 +1013,8 @@ class EscalationEvent(Base):
     reviewerid =        Column(Integer)
     escalationdate  =   Column(TIMESTAMP)
     reviewdate  =       Column(TIMESTAMP)
-    escalationcomment = Column(String)
-    reviewcomment =     Column(String)
+    escalationcomment = deferred(Column(String), group='comments')
+    reviewcomment =     deferred(Column(String), group='comments')
     datastoreid =       Column(Integer)
     isglobal =          Column(Boolean)
     ownerid =           Column(Integer)
@@ -987,7 +1103,7 @@ class ArtifactState(Base):
     """Table mapping artifac states and QC
 
     :arg INTEGER stateid: the internal state id. Primary key.
-    :arg INTEGER qcflag: 0: UNKNOWN, 1: PASSED, 2: FAILED
+    :arg INTEGER qcflag: 0: UNKNOWN, 1: PASSED, 2: FAILED (see QC_FLAGS)
     :arg INTEGER ownerid: Researcher ID of the container creator
     :arg INTEGER datastoreid: id of the associated datastore
     :arg BOOLEAN isglobal: *unknown*
@@ -1090,7 +1206,7 @@ class Principals(Base):
     def __repr__(self):
         return "<Principals(principalid={}, username={}, researcherid={})>".format(self.principalid, self.username, self.researcherid)
 
-class Lab(Base):
+class Lab(UdfDictMixin, Base):
     """Table mapping Lab entities
 
     :arg INTEGER labid: internal lab id. Primary key.
@@ -1125,20 +1241,6 @@ class Lab(Base):
     udfs = relationship("EntityUdfView", foreign_keys=labid, remote_side=EntityUdfView.attachtoid, uselist=True,
             primaryjoin="and_(Lab.labid==EntityUdfView.attachtoid, EntityUdfView.attachtoclassid==17)")
 
-    @hybrid_property
-    def udf_dict(self):
-        udf_dict={}
-        for udfrow in self.udfs:
-            if udfrow.udfvalue:
-                if udfrow.udftype == "Numeric":
-                    udf_dict[udfrow.udfname]=float(udfrow.udfvalue)
-                elif udfrow.udftype == "Boolean":
-                    udf_dict[udfrow.udfname]=(udfrow.udfvalue=="True")
-                else:
-                    udf_dict[udfrow.udfname]=udfrow.udfvalue
-
-        return udf_dict
-
     def __repr__(self):
         return "<Lab(labid={}, name={})>".format(self.labid, self.name)
 
@@ -1147,7 +1249,7 @@ class ReagentType(Base):
 
     :arg INTEGER reagenttypeid: internal reagent type id
     :arg STRING name: name of the reagent type
-    :arg STRING meta_data: *unknown*
+    :arg STRING meta_data: *unknown*. Deferred, in the metadata group.
     :arg STRING specialtype: *unknown*
     :arg INTEGER ownerid: principal ID of the owner
     :arg INTEGER datastoreid: *unknown*
@@ -1162,7 +1264,7 @@ class ReagentType(Base):
     __tablename__ = 'reagenttype'
     reagenttypeid =     Column(Integer, primary_key=True)
     name =              Column(String)
-    meta_data =         Column('metadata', String)
+    meta_data =         deferred(Column('metadata', String), group='metadata')
     specialtype =       Column(String)
     ownerid =           Column(Integer)
     datastoreid =       Column(Integer)
@@ -1210,3 +1312,40 @@ class RoutingAction(Base):
 
     def __repr__(self):
         return "<RoutingAction(routingactionid={}, actiontype={})>".format(self.routingactionid, self.actiontype)
+
+
+#Udf views of the entities that have udfs.
+#entity class : (view class, view id column, entity id column, attachtoclassid in the view or None)
+UDF_VIEWS={
+    Project:    (EntityUdfView, 'attachtoid', 'projectid', 83),
+    Container:  (EntityUdfView, 'attachtoid', 'containerid', 27),
+    Lab:        (EntityUdfView, 'attachtoid', 'labid', 17),
+    Sample:     (SampleUdfView, 'sampleid', 'sampleid', None),
+    Artifact:   (ArtifactUdfView, 'artifactid', 'artifactid', None),
+    Process:    (ProcessUdfView, 'processid', 'processid', None),
+    }
+"""Maps the entities to the view storing their udfs"""
+
+#Large or rarely used columns are deferred : they are not selected with their rows, but loaded on first access,
+#together with the other columns of their group. queries.undefer_options loads them with the rows instead.
+#group name : deferred columns
+DEFERRED_GROUPS={
+    'avatar':           (Researcher.avatar, Researcher.avatarcontenttype),
+    'account_request':  (Researcher.requestedsupervisorfirstname, Researcher.requestedsupervisorlastname,
+                         Researcher.requestedusername, Researcher.requestedpassword, Researcher.requestedlabname),
+    'metadata':         (ProcessType.pmetadata, ReagentType.meta_data),
+    'comments':         (EscalationEvent.escalationcomment, EscalationEvent.reviewcomment),
+    }
+"""Groups of deferred columns"""
+
+
+def _reset_udf_dict(target, *args):
+    #target is None when the instance was garbage collected before being expired
+    if target is not None:
+        target._reset_udf_dict()
+
+for udf_entity in UDF_VIEWS:
+    event.listen(udf_entity, 'expire', _reset_udf_dict)
+    event.listen(udf_entity, 'refresh', _reset_udf_dict)
+    event.listen(udf_entity.udfs, 'append', _reset_udf_dict)
+    event.listen(udf_entity.udfs, 'remove', _reset_udf_dict)
@@ -1,39 +1,393 @@
-import yaml
 import os
+import re
+import datetime
+import threading
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 from genologics_sql.tables import Base
 
+CONF=None
+"""The configuration currently used. Loaded on first use by get_configuration, or set by configure."""
+
 def get_configuration():
-    """Reads the genosqlrc.yaml file and tries to load the database configuration from it
+    """Returns the database configuration, loading it on first use. It is taken, by order of precedence, from :
+
+    * the last call to configure()
+    * the GENOSQL_DSN environment variable, holding a SQLAlchemy database URI
+    * the yaml file pointed to by the GENOSQL_CONFIG environment variable
+    * the ~/.genosqlrc.yaml file
+    * the .genosqlrc.yaml file of the working directory
+
+    :returns: dictionnary of properties"""
+    global CONF
+    if CONF is None:
+        CONF=_load_configuration()
+    return CONF
+
+def _load_configuration():
+    """Reads the configuration from the environment or the genosqlrc.yaml file
     :returns: dictionnary of properties"""
-    for fn in [os.path.expanduser('~/.genosqlrc.yaml'), '.genosqlrc.yaml']:
+    if os.environ.get('GENOSQL_DSN'):
+        return {'dsn': os.environ['GENOSQL_DSN']}
+    if os.environ.get('GENOSQL_CONFIG'):
+        candidates=[os.environ['GENOSQL_CONFIG']]
+    else:
+        candidates=[os.path.expanduser('~/.genosqlrc.yaml'), '.genosqlrc.yaml']
+    for fn in candidates:
         if os.path.exists(fn):
+            import yaml
             with open(fn) as f :
-                return yaml.load(f)
+                return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
     raise Exception("Cannot find a valid configuration file. Please read the README.md.")
 
-def get_engine():
-    """generates a SQLAlchemy engine for PostGres with the CONF currently used
-    :returns: the SQLAlchemy engine"""
-    uri=None
+def configure(conf=None, **kwargs):
+    """Sets the configuration programmatically, instead of reading it from a file.
+    The process-wide engine is discarded, so that the next sessions use the new configuration::
+
+        configure(username='lims', url='localhost', db='clarity')
+        configure(dsn='postgresql://lims@localhost/clarity', pool_size=10)
+
+    Calling it without arguments goes back to loading the configuration from the environment or files.
+
+    :param conf: dictionnary of properties, with the same keys as the genosqlrc.yaml file
+    :param kwargs: properties, added to (or overriding) conf
+    """
+    global CONF
+    dispose_engine()
+    if conf is None and not kwargs:
+        CONF=None
+        return
+    new_conf=dict(conf or {})
+    new_conf.update(kwargs)
+    CONF=new_conf
+
+
+POOL_OPTIONS=('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping')
+"""Configuration keys passed as-is to create_engine"""
+
+_ENGINE=None
+_SESSION_FACTORY=None
+_SCOPED_SESSION=None
+_READONLY_SESSION_FACTORY=None
+_REFERENCE_CACHE=None
+_RESULT_CACHE=None
+_ASYNC_ENGINE=None
+_ASYNC_SESSION_FACTORY=None
+_LOCK=threading.Lock()
+
+def _database_uri(conf):
+    """returns the database URI of the configuration <conf>"""
     try:
-        uri="postgresql://{user}:{passw}@{url}/{db}".format(user=CONF['username'], passw=CONF.get('password', ''), url=CONF['url'], db=CONF['db'])
+        return conf.get('dsn') or "postgresql://{user}:{passw}@{url}/{db}".format(user=conf['username'], passw=conf.get('password', ''), url=conf['url'], db=conf['db'])
     except KeyError as e:
-        raise Exception("The configuration file seems to be missing a required parameter. Please read the README.md. Missing key : {}".format(e.message))
-    return create_engine(uri)
+        raise Exception("The configuration file seems to be missing a required parameter. Please read the README.md. Missing key : {}".format(e.args[0]))
+
+def create_new_engine():
+    """generates a new SQLAlchemy engine for PostGres with the configuration currently used.
+    The pool is configured with the pool_size, max_overflow, pool_timeout, pool_recycle and pool_pre_ping keys,
+    and each connection gets the statement_timeout (in milliseconds) key if defined.
+    :returns: the SQLAlchemy engine"""
+    conf=get_configuration()
+    uri=_database_uri(conf)
+    options=dict((key, conf[key]) for key in POOL_OPTIONS if conf.get(key) is not None)
+    if conf.get('statement_timeout'):
+        options['connect_args']={'options':'-c statement_timeout={}'.format(int(conf['statement_timeout']))}
+    return create_engine(uri, **options)
+
+def get_engine():
+    """returns the process-wide SQLAlchemy engine, creating it on first use.
+    All the sessions share its connection pool.
+    If the profile configuration key is true, its statements are recorded by genologics_sql.profiling.default_profiler().
+    :returns: the SQLAlchemy engine"""
+    global _ENGINE
+    if _ENGINE is None:
+        with _LOCK:
+            if _ENGINE is None:
+                engine=create_new_engine()
+                if get_configuration().get('profile'):
+                    from genologics_sql.profiling import default_profiler
+                    default_profiler().attach(engine)
+                Base.metadata.bind = engine
+                _ENGINE=engine
+    return _ENGINE
+
+def dispose_engine():
+    """closes all the pooled connections and forgets the process-wide engine. 
+    Should be called in child processes after a fork, or to apply a new configuration."""
+    global _ENGINE, _SESSION_FACTORY, _SCOPED_SESSION, _READONLY_SESSION_FACTORY, _REFERENCE_CACHE, _RESULT_CACHE, _ASYNC_ENGINE, _ASYNC_SESSION_FACTORY
+    with _LOCK:
+        if _SCOPED_SESSION is not None:
+            _SCOPED_SESSION.remove()
+        if _ENGINE is not None:
+            _ENGINE.dispose()
+        _ENGINE=None
+        _SESSION_FACTORY=None
+        _SCOPED_SESSION=None
+        _READONLY_SESSION_FACTORY=None
+        _REFERENCE_CACHE=None
+        _RESULT_CACHE=None
+        #the connections of the async engine can only be closed from the event loop, see dispose_async_engine
+        _ASYNC_ENGINE=None
+        _ASYNC_SESSION_FACTORY=None
+
+def get_reference_cache():
+    """returns the process-wide cache of the reference tables, if the reference_cache configuration key 
+    (its ttl in seconds) is set. It is installed on the session factories of this module.
+    :returns: the genologics_sql.refcache.ReferenceCache, or None"""
+    global _REFERENCE_CACHE
+    ttl=get_configuration().get('reference_cache')
+    if ttl and _REFERENCE_CACHE is None:
+        engine=get_engine()
+        with _LOCK:
+            if _REFERENCE_CACHE is None:
+                from genologics_sql.refcache import ReferenceCache
+                _REFERENCE_CACHE=ReferenceCache(engine, ttl=float(ttl))
+    return _REFERENCE_CACHE
+
+def get_result_cache():
+    """returns the process-wide persistent cache of query results, if the result_cache configuration key 
+    (the path of its file) is set. Its entries expire after result_cache_ttl seconds (default one day) 
+    and its size is bounded by result_cache_size bytes (default 256MB).
+    :returns: the genologics_sql.resultcache.ResultCache, or None"""
+    global _RESULT_CACHE
+    conf=get_configuration()
+    if conf.get('result_cache') and _RESULT_CACHE is None:
+        with _LOCK:
+            if _RESULT_CACHE is None:
+                from genologics_sql.resultcache import ResultCache
+                _RESULT_CACHE=ResultCache(conf['result_cache'], ttl=conf.get('result_cache_ttl', 24*3600),
+                        max_size=conf.get('result_cache_size', 256*1024*1024))
+    return _RESULT_CACHE
+
+def get_session_factory():
+    """returns the process-wide session factory, bound to the process-wide engine.
+    If the prepared_statements configuration key is true, the queries of genologics_sql.queries
+    use server-side prepared statements in the sessions it creates.
+    If the reference_cache configuration key is set, the sessions use the cache of get_reference_cache.
+    :returns: the SQLAlchemy sessionmaker"""
+    global _SESSION_FACTORY
+    if _SESSION_FACTORY is None:
+        engine=get_engine()
+        cache=get_reference_cache()
+        with _LOCK:
+            if _SESSION_FACTORY is None:
+                factory=sessionmaker(bind=engine,
+                        info={'prepared_statements':bool(get_configuration().get('prepared_statements'))})
+                if cache is not None:
+                    cache.install(factory)
+                _SESSION_FACTORY=factory
+    return _SESSION_FACTORY
 
 def get_session():
-    """Generates a SQLAlchemy session based on the CONF
+    """Generates a SQLAlchemy session based on the configuration. 
+    The session uses the shared connection pool, and should be closed when done.
     :returns: the SQLAlchemy session
     """
-    engine=get_engine()
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
-    return session
+    return get_session_factory()()
+
+def get_scoped_session():
+    """returns the thread-local session registry. Calling it returns the session of the current thread,
+    and calling its remove() method closes that session, typically at the end of a request.
+    :returns: the SQLAlchemy scoped_session
+    """
+    global _SCOPED_SESSION
+    if _SCOPED_SESSION is None:
+        factory=get_session_factory()
+        with _LOCK:
+            if _SCOPED_SESSION is None:
+                _SCOPED_SESSION=scoped_session(factory)
+    return _SCOPED_SESSION
+
+@contextmanager
+def session_scope():
+    """Provides a session that is always closed, giving its connection back to the pool::
+
+        with session_scope() as session:
+            session.query(Project).all()
+    """
+    session=get_session()
+    try:
+        yield session
+    finally:
+        session.close()
+
+READONLY_TRANSACTION="SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY DEFERRABLE"
+"""First statement of the transactions of the read only sessions"""
+
+_SNAPSHOT_ID=re.compile(r"^[0-9A-Fa-f]+(-[0-9A-Fa-f]+)+$")
+
+def _begin_readonly(session, transaction, connection):
+    snapshot=session.info.get('snapshot')
+    #SET TRANSACTION SNAPSHOT does not take parameters, hence the validation
+    if snapshot and not _SNAPSHOT_ID.match(snapshot):
+        raise ValueError("Invalid snapshot id : {}".format(snapshot))
+    connection.execute(text(READONLY_TRANSACTION))
+    if snapshot:
+        connection.execute(text("SET TRANSACTION SNAPSHOT '{}'".format(snapshot)))
+
+def _refuse_flush(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        raise Exception("Read only sessions cannot write to the database.")
+
+def readonly_sessionmaker(engine, **kwargs):
+    """creates a factory of read only sessions. Their transactions are REPEATABLE READ READ ONLY DEFERRABLE, 
+    so that all the queries of a transaction see the same data, without taking any lock.
+    They do not autoflush, refuse to flush changes, and do not expire the loaded objects on commit.
+    A session created with info={'snapshot':snapshot_id} reads the snapshot exported by another session (see export_snapshot).
+
+    :param engine: the SQLAlchemy engine
+    :param kwargs: other arguments of sessionmaker
+    :returns: the SQLAlchemy sessionmaker
+    """
+    factory=sessionmaker(bind=engine, autoflush=False, expire_on_commit=False, **kwargs)
+    event.listen(factory, 'after_begin', _begin_readonly)
+    event.listen(factory, 'before_flush', _refuse_flush)
+    return factory
+
+def get_readonly_session_factory():
+    """returns the process-wide factory of read only sessions, bound to the process-wide engine.
+    :returns: the SQLAlchemy sessionmaker"""
+    global _READONLY_SESSION_FACTORY
+    if _READONLY_SESSION_FACTORY is None:
+        engine=get_engine()
+        cache=get_reference_cache()
+        with _LOCK:
+            if _READONLY_SESSION_FACTORY is None:
+                factory=readonly_sessionmaker(engine,
+                        info={'prepared_statements':bool(get_configuration().get('prepared_statements'))})
+                if cache is not None:
+                    cache.install(factory)
+                _READONLY_SESSION_FACTORY=factory
+    return _READONLY_SESSION_FACTORY
+
+def get_readonly_session(snapshot=None):
+    """Generates a read only SQLAlchemy session based on the configuration, for reports needing consistent data.
+    The session should be closed when done, or rolled back to read fresh data.
+
+    :param snapshot: if defined, the snapshot id exported by another session, so that both sessions read the same data
+    :returns: the SQLAlchemy session
+    """
+    factory=get_readonly_session_factory()
+    if snapshot:
+        return factory(info={'snapshot':snapshot})
+    return factory()
+
+def export_snapshot(session):
+    """exports the snapshot of the current transaction of a read only session.
+    Other read only sessions can import it as long as this transaction is open::
+
+        with readonly_session_scope() as session:
+            snapshot=export_snapshot(session)
+            other=get_readonly_session(snapshot)
+
+    :param session: the read only session
+    :returns: the snapshot id
+    """
+    return session.execute(text("select pg_export_snapshot()")).scalar()
+
+@contextmanager
+def readonly_session_scope(snapshot=None):
+    """Provides a read only session that is always closed, see get_readonly_session"""
+    session=get_readonly_session(snapshot)
+    try:
+        yield session
+    finally:
+        session.close()
+
+def create_new_async_engine():
+    """generates a new asyncio SQLAlchemy engine, using the asyncpg driver, with the configuration currently used.
+    The pool and statement_timeout keys are used as in create_new_engine.
+    Requires SQLAlchemy 1.4 or later and asyncpg.
+    :returns: the SQLAlchemy AsyncEngine"""
+    from sqlalchemy.engine.url import make_url
+    from sqlalchemy.ext.asyncio import create_async_engine
+    conf=get_configuration()
+    uri=make_url(_database_uri(conf)).set(drivername='postgresql+asyncpg')
+    options=dict((key, conf[key]) for key in POOL_OPTIONS if conf.get(key) is not None)
+    if conf.get('statement_timeout'):
+        options['connect_args']={'server_settings':{'statement_timeout':str(int(conf['statement_timeout']))}}
+    return create_async_engine(uri, **options)
+
+def get_async_engine():
+    """returns the process-wide asyncio SQLAlchemy engine, creating it on first use.
+    :returns: the SQLAlchemy AsyncEngine"""
+    global _ASYNC_ENGINE
+    if _ASYNC_ENGINE is None:
+        with _LOCK:
+            if _ASYNC_ENGINE is None:
+                _ASYNC_ENGINE=create_new_async_engine()
+    return _ASYNC_ENGINE
+
+def dispose_async_engine():
+    """closes all the pooled connections of the process-wide asyncio engine, and forgets it.
+    :returns: the awaitable closing the connections"""
+    global _ASYNC_ENGINE, _ASYNC_SESSION_FACTORY
+    with _LOCK:
+        engine=_ASYNC_ENGINE
+        _ASYNC_ENGINE=None
+        _ASYNC_SESSION_FACTORY=None
+    if engine is None:
+        import asyncio
+        return asyncio.sleep(0)
+    return engine.dispose()
+
+def get_async_session():
+    """Generates an asyncio SQLAlchemy session based on the configuration. 
+    The session uses the shared asyncio connection pool, and should be closed when done::
+
+        async with get_async_session() as session:
+            projectids=await aio.get_last_modified_projectids(session, "1 day")
+
+    The objects are not expired on commit, as their attributes cannot be lazy loaded
+    outside of the functions of genologics_sql.aio.
+    :returns: the SQLAlchemy AsyncSession
+    """
+    global _ASYNC_SESSION_FACTORY
+    if _ASYNC_SESSION_FACTORY is None:
+        engine=get_async_engine()
+        with _LOCK:
+            if _ASYNC_SESSION_FACTORY is None:
+                from sqlalchemy.ext.asyncio import AsyncSession
+                _ASYNC_SESSION_FACTORY=sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False,
+                        info={'prepared_statements':bool(get_configuration().get('prepared_statements'))})
+    return _ASYNC_SESSION_FACTORY()
+
+class Checkpoint(object):
+    """Stores a sync watermark (a timestamp) in a local file, so that incremental queries
+    only read the rows changed since the last successful run.
+
+    The watermark is stored in the ISO 8601 format, with its timezone if it has one.
+
+    :arg STRING path: path of the checkpoint file
+    """
+
+    def __init__(self, path):
+        self.path=os.path.expanduser(path)
+
+    def load(self):
+        """reads the watermark from the checkpoint file
+        :returns: the datetime watermark, or None if there is no checkpoint yet"""
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            value=f.read().strip()
+        if not value:
+            return None
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise Exception("Cannot parse the watermark {} stored in {}".format(value, self.path))
 
+    def save(self, watermark):
+        """atomically writes the watermark to the checkpoint file. Does nothing if watermark is None.
+        :param watermark: the datetime returned by the incremental query"""
+        if watermark is None:
+            return
+        tmp="{}.tmp".format(self.path)
+        with open(tmp, 'w') as f:
+            f.write(watermark.isoformat())
+        os.replace(tmp, self.path)
 
-CONF=get_configuration()
@@ -18,7 +18,7 @@ try:
         install_requires = [x.strip() for x in f.readlines()]
 except IOError:
         install_requires = [
-          "SQLAlchemy",
+          "SQLAlchemy<2.0",
           "pyyaml",
           "psycopg2"]
 
@@ -0,0 +1,115 @@
+"""Fixtures shared by the tests. They run against an in-memory SQLite database created from the mapped tables.
+
+The tests marked postgres need a live Clarity database, which they only read from.
+They are skipped unless the GENOSQL_TEST_DSN environment variable holds its SQLAlchemy URI.
+"""
+import datetime
+import os
+
+import pytest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import genologics_sql.utils
+from genologics_sql.tables import *
+from genologics_sql.lineage import LineageGraph
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'postgres: needs the live Clarity database of GENOSQL_TEST_DSN')
+
+def pytest_collection_modifyitems(config, items):
+    if os.environ.get('GENOSQL_TEST_DSN'):
+        return
+    skip=pytest.mark.skip(reason="needs a live Clarity database, set GENOSQL_TEST_DSN")
+    for item in items:
+        if 'postgres' in item.keywords:
+            item.add_marker(skip)
+
+@pytest.fixture(autouse=True)
+def postgres_configuration(request):
+    """configures genologics_sql.utils with GENOSQL_TEST_DSN for the tests marked postgres"""
+    if request.node.get_closest_marker('postgres') is None:
+        yield
+        return
+    genologics_sql.utils.configure(dsn=os.environ['GENOSQL_TEST_DSN'])
+    yield
+    genologics_sql.utils.configure()
+
+@pytest.fixture
+def engine():
+    #a single connection, shared by the threads of the parallel tests, holds the in-memory database
+    engine=create_engine('sqlite://', connect_args={'check_same_thread':False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def session_factory(engine):
+    return sessionmaker(bind=engine)
+
+@pytest.fixture
+def session(session_factory):
+    session=session_factory()
+    yield session
+    session.close()
+
+@pytest.fixture
+def statements(engine):
+    """list of the statements run by the engine from the start of the test"""
+    recorded=[]
+    def record(conn, cursor, statement, *args):
+        recorded.append(statement)
+    event.listen(engine, 'before_cursor_execute', record)
+    yield recorded
+    event.remove(engine, 'before_cursor_execute', record)
+
+@pytest.fixture
+def project_tree(session_factory):
+    """project 1, its researcher, samples 0 to 2, and artifacts 0 to 2 (one per sample).
+    Artifact 1 is placed in B:1 of plate 1, artifact 2 has a FAILED state, artifacts 0 and 1 have udfs."""
+    session=session_factory()
+    session.add(Researcher(researcherid=1, firstname="first", avatar=b"0"*1000, avatarcontenttype="image/png"))
+    session.add(Project(projectid=1, name="P1", luid="P1", researcherid=1))
+    session.add_all([Sample(processid=processid, sampleid=processid, name="S{}".format(processid), projectid=1) for processid in range(3)])
+    session.add_all([Artifact(artifactid=artifactid, luid="2-{}".format(artifactid), name="A{}".format(artifactid)) for artifactid in range(3)])
+    session.add(ContainerType(typeid=1, name="96 well plate", numxpositions=12, numypositions=8, isxalpha=False, isyalpha=True,
+            xindexstartsat=1, yindexstartsat=0))
+    session.add(Container(containerid=1, name="plate", typeid=1))
+    session.add(ContainerPlacement(placementid=1, containerid=1, processartifactid=1, wellxposition=0, wellyposition=1))
+    session.add(ArtifactState(stateid=1, artifactid=2, qcflag=2, lastmodifieddate=datetime.datetime(2020, 1, 1)))
+    session.add_all([ArtifactUdfView(artifactid=0, udtname="", udfname="Concentration", udftype="Numeric", udfvalue="1.5", udfunitlabel=""),
+            ArtifactUdfView(artifactid=1, udtname="", udfname="Comment", udftype="String", udfvalue="ok", udfunitlabel="")])
+    session.commit()
+    for artifactid in range(3):
+        session.execute(artifact_sample_map.insert().values(artifactid=artifactid, processid=artifactid))
+    session.commit()
+    session.close()
+
+@pytest.fixture
+def processes(session_factory):
+    """process types 0 to 2, and processes 0 to 11 of type processid % 3"""
+    session=session_factory()
+    session.add_all([ProcessType(typeid=typeid, displayname="type {}".format(typeid), lastmodifieddate=datetime.datetime(2020, 1, 1))
+            for typeid in range(3)])
+    session.add_all([Process(processid=processid, typeid=processid % 3) for processid in range(12)])
+    session.commit()
+    session.close()
+
+@pytest.fixture
+def lineage_edges():
+    """(input artifactid, output artifactid, processid, process typeid) edges of two samples pooled together"""
+    #sample 1 -(prep 10)-> library 2 -(pool 11)-> pool 4 -(seq 12)-> lane 5
+    #sample 3 -(prep 10)-> library 6 -(pool 11)-> pool 4
+    return [(1, 2, 10, 100), (3, 6, 10, 100), (2, 4, 11, 200), (6, 4, 11, 200), (4, 5, 12, 300)]
+
+@pytest.fixture
+def lineage_samples():
+    """(artifactid, sample processid) links of the artifacts of lineage_edges"""
+    return [(1, 1), (2, 1), (3, 3), (6, 3), (4, 1), (4, 3), (5, 1), (5, 3)]
+
+@pytest.fixture
+def lineage_graph(lineage_edges, lineage_samples):
+    return LineageGraph.from_edges(lineage_edges, lineage_samples)
@@ -0,0 +1,50 @@
+import asyncio
+import datetime
+
+import pytest
+
+from genologics_sql import aio
+from genologics_sql.tables import Base, Project, Artifact
+from genologics_sql.queries import _modified_after
+
+def _run(coroutine_function, *args):
+    """creates an aiosqlite database with the tables, and runs coroutine_function(session, *args) in a session to it"""
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+    async def run():
+        engine=create_async_engine('sqlite+aiosqlite://')
+        try:
+            async with engine.begin() as connection:
+                await connection.run_sync(Base.metadata.create_all)
+            async with AsyncSession(engine) as session:
+                return await coroutine_function(session, *args)
+        finally:
+            await engine.dispose()
+    return asyncio.run(run())
+
+def _fill(session):
+    session.add_all([Project(projectid=1, name="P1", luid="P1", lastmodifieddate=datetime.datetime(2020, 1, 1)),
+            Project(projectid=2, name="P2", luid="P2", lastmodifieddate=datetime.datetime(2021, 1, 1)),
+            Artifact(artifactid=1, luid="2-1", name="A1")])
+    session.commit()
+
+def test_interval_is_bound_as_text():
+    assert("cast(cast(:interval as text) as interval)" in _modified_after("pj.lastmodifieddate"))
+
+def test_aio_modified_since():
+    async def modified(session):
+        await session.run_sync(_fill)
+        return await aio.get_last_modified_projects(session, since=datetime.datetime(2020, 6, 1), columns=['projectid', 'name'])
+    assert([(project.projectid, project.name) for project in _run(modified)] == [(2, "P2")])
+
+def test_aio_rows():
+    async def rows(session):
+        await session.run_sync(_fill)
+        return await aio.get_rows(session, Project, [1, 2, 3], ['name'])
+    assert(dict((projectid, row.name) for projectid, row in _run(rows).items()) == {1:"P1", 2:"P2"})
+
+def test_aio_run_sync():
+    async def run(session):
+        await aio.run_sync(session, _fill)
+        return await aio.run_sync(session, lambda session:session.query(Artifact).get(1).name)
+    assert(_run(run) == "A1")
@@ -0,0 +1,94 @@
+import datetime
+
+import pytest
+
+from sqlalchemy import text
+
+import genologics_sql.utils
+from genologics_sql.tables import Project, Artifact, Process, ProcessIOTracker
+from genologics_sql.queries import PROJECT_CHANGE_SOURCES, get_last_modified_projects, get_last_modified_projectids, get_last_modified_projectids_by_source, \
+        get_projectids_modified_since
+
+#SQLite returns the dates of textual queries as strings, the watermarks are given in its storage format
+SINCE="2020-06-01 00:00:00.000000"
+
+@pytest.fixture
+def changes(project_tree, session):
+    """changes after SINCE in every source but containers and process_udfs, all in project 1.
+    Project 2 is modified after SINCE, project 3 before."""
+    #the udf storage tables of Clarity are not mapped
+    session.execute(text("create table entityudfstorage (attachtoid integer, attachtoclassid integer, lastmodifieddate timestamp)"))
+    session.execute(text("create table processudfstorage (processid integer, lastmodifieddate timestamp)"))
+    session.execute(text("create table artifactudfstorage (artifactid integer, lastmodifieddate timestamp)"))
+    session.add_all([Project(projectid=2, name="P2", luid="P2", lastmodifieddate=datetime.datetime(2021, 1, 1)),
+            Project(projectid=3, name="P3", luid="P3", lastmodifieddate=datetime.datetime(2020, 1, 1)),
+            Process(processid=10, lastmodifieddate=datetime.datetime(2021, 4, 1)),
+            ProcessIOTracker(trackerid=1, inputartifactid=0, processid=10)])
+    session.query(Artifact).filter(Artifact.artifactid==1).update({'lastmodifieddate':datetime.datetime(2021, 5, 1)})
+    for statement in ("insert into entityudfstorage values (1, 83, '2021-02-01 00:00:00.000000')",
+            "insert into entityudfstorage values (3, 27, '2021-02-01 00:00:00.000000')",
+            "insert into processudfstorage values (0, '2021-03-01 00:00:00.000000')",
+            "insert into processudfstorage values (10, '2020-01-01 00:00:00.000000')",
+            "insert into artifactudfstorage values (2, '2021-06-01 00:00:00.000000')"):
+        session.execute(text(statement))
+    session.commit()
+
+def test_change_feed_by_source(changes, session):
+    by_source=get_last_modified_projectids_by_source(session, since=SINCE)
+    assert(list(by_source) == list(PROJECT_CHANGE_SOURCES))
+    assert(dict(by_source) == {'project':{"P2"}, 'project_udfs':{"P1"}, 'sample_udfs':{"P1"}, 'artifacts':{"P1"},
+            'artifact_udfs':{"P1"}, 'containers':set(), 'processes':{"P1"}, 'process_udfs':set()})
+    assert(get_last_modified_projectids(session, since=SINCE) == {"P1", "P2"})
+    assert(get_last_modified_projectids(session, since=SINCE, sources=['project', 'containers']) == {"P2"})
+
+def test_projectids_modified_since(changes, session):
+    projectids, watermark=get_projectids_modified_since(session, SINCE)
+    assert(projectids == {"P1", "P2"})
+    assert(watermark == "2021-06-01 00:00:00.000000")
+    #nothing changed after the new watermark
+    assert(get_projectids_modified_since(session, watermark) == (set(), watermark))
+    projectids, watermark=get_projectids_modified_since(session, SINCE, sources=['project'])
+    assert((projectids, watermark) == ({"P2"}, "2021-01-01 00:00:00.000000"))
+
+@pytest.mark.postgres
+def test_projectids_modified_since_overlap():
+    session=genologics_sql.utils.get_session()
+    try:
+        projectids, watermark=get_projectids_modified_since(session, None, "30 days")
+        if watermark is not None:
+            #the projects of the latest change are read again
+            overlapping, new_watermark=get_projectids_modified_since(session, watermark, overlap=datetime.timedelta(minutes=1))
+            assert(overlapping and new_watermark >= watermark)
+    finally:
+        session.close()
+
+@pytest.mark.postgres
+def test_change_feed_interval():
+    session=genologics_sql.utils.get_session()
+    try:
+        projectids=get_last_modified_projectids(session, "7 days")
+        by_source=get_last_modified_projectids_by_source(session, "7 days")
+        #the single query returns the union of the sources
+        assert(projectids == set().union(*by_source.values()))
+        assert(get_last_modified_projectids(session, "7 days", sources=['project']) == by_source['project'])
+    finally:
+        session.close()
+
+def test_last_modified_projects_since(changes, session):
+    assert([project.luid for project in get_last_modified_projects(session, since=SINCE)] == ["P2"])
+    assert(get_last_modified_projects(session, since="2021-06-01 00:00:00.000000") == [])
+
+@pytest.mark.postgres
+def test_projectids_modified_since_interval():
+    session=genologics_sql.utils.get_session()
+    try:
+        #without watermark, the last interval is read and the watermark is the latest modification seen
+        projectids, watermark=get_projectids_modified_since(session, None, "30 days")
+        if projectids:
+            assert(isinstance(watermark, datetime.datetime))
+            #the database may have changed since
+            assert(get_projectids_modified_since(session, watermark)[1] >= watermark)
+        else:
+            assert(watermark is None)
+    finally:
+        session.close()
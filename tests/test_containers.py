@@ -0,0 +1,20 @@
+from genologics_sql.tables import Container, ContainerPlacement
+from genologics_sql.queries import get_container_layouts
+
+def test_container_layouts(project_tree, session):
+    session.add(Container(containerid=2, name="empty plate", typeid=1))
+    #a placement outside of the grid, and one without position
+    session.add(ContainerPlacement(placementid=2, containerid=1, processartifactid=2, wellxposition=12, wellyposition=0))
+    session.add(ContainerPlacement(placementid=3, containerid=1, processartifactid=0, wellxposition=None, wellyposition=None))
+    session.commit()
+    layouts=get_container_layouts(session, [1, 2, 3])
+    assert(sorted(layouts) == [1, 2])
+    plate=layouts[1]
+    assert((plate.name, plate.typename) == ("plate", "96 well plate"))
+    assert(plate.rows == ["A", "B", "C", "D", "E", "F", "G", "H"])
+    assert(plate.columns == list(range(1, 13)))
+    assert(plate.grid[1][0] == 1)
+    assert(sum(1 for row in plate.grid for artifactid in row if artifactid is not None) == 1)
+    assert(plate.wells == {"B:1":1, "A:13":2})
+    assert(plate.unplaced == [0])
+    assert(layouts[2].wells == {} and layouts[2].unplaced == [])
@@ -1,6 +1,10 @@
+import pytest
+
 import genologics_sql.utils
 from genologics_sql.tables import *
 
+pytestmark=pytest.mark.postgres
+
 def test_connection():
     session=genologics_sql.utils.get_session()
     assert(session is not None)
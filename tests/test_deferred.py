@@ -0,0 +1,21 @@
+from sqlalchemy.orm import joinedload
+
+from genologics_sql.tables import Project
+from genologics_sql.queries import undefer_options
+
+def test_deferred_columns(project_tree, session_factory, statements):
+    session=session_factory()
+    project=session.query(Project).options(joinedload(Project.researcher)).first()
+    assert("avatar" not in statements[-1])
+    del statements[:]
+    #the avatar group is loaded on first access
+    assert(project.researcher.avatar == b"0"*1000 and project.researcher.avatarcontenttype == "image/png")
+    assert(len(statements) == 1)
+    session.close()
+
+    del statements[:]
+    session=session_factory()
+    project=session.query(Project).options(*undefer_options(['avatar'], joinedload(Project.researcher))).first()
+    assert(project.researcher.avatarcontenttype == "image/png")
+    assert(len(statements) == 1)
+    session.close()
@@ -0,0 +1,28 @@
+import tempfile
+
+import pytest
+
+from genologics_sql.export import export_projects
+
+def test_export_projects(project_tree, session):
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    written=export_projects(session, [1], tempfile.mkdtemp(), batch_size=2)
+    assert(dict((kind, rows) for kind, (path, rows) in written.items()) == {'projects':1, 'samples':3, 'artifacts':3, 'artifact_samples':3})
+    artifacts=pyarrow.parquet.read_table(written['artifacts'][0]).to_pydict()
+    assert(artifacts['qc_flag'] == ['UNKNOWN', 'UNKNOWN', 'FAILED'])
+    assert(artifacts['well'] == [None, 'B:1', None])
+    assert(artifacts['udf.Concentration'] == [1.5, None, None])
+    assert(artifacts['udf.Comment'] == [None, 'ok', None])
+
+def test_export_mixed_udf_types(project_tree, session):
+    pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+    from genologics_sql.tables import ArtifactUdfView
+    session.add(ArtifactUdfView(artifactid=2, udtname="", udfname="Concentration", udftype="String", udfvalue="1.50", udfunitlabel=""))
+    session.commit()
+    written=export_projects(session, [1], tempfile.mkdtemp(), kinds=['artifacts'], batch_size=2)
+    artifacts=pyarrow.parquet.read_table(written['artifacts'][0])
+    #the udf is stored with several types, its raw values are exported as strings
+    assert(str(artifacts.schema.field('udf.Concentration').type) == 'string')
+    assert(artifacts.to_pydict()['udf.Concentration'] == ['1.5', None, '1.50'])
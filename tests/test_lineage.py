@@ -0,0 +1,76 @@
+import pytest
+
+from sqlalchemy import text
+
+import genologics_sql.lineage
+import genologics_sql.utils
+from genologics_sql.lineage import LineageGraph, LineageStep, get_ancestors, get_descendants, _lineage_statement
+
+def test_ancestors(lineage_graph):
+    steps=lineage_graph.ancestors(5)
+    assert(steps[0] == LineageStep(4, 12, 1))
+    assert(set(step.artifactid for step in steps) == set([1, 2, 3, 4, 6]))
+    assert(max(step.depth for step in steps) == 3)
+    assert(lineage_graph.ancestors(5, max_depth=1) == [LineageStep(4, 12, 1)])
+    assert(set(step.artifactid for step in lineage_graph.ancestors(5, sample=1)) == set([1, 2, 4]))
+
+def test_descendants(lineage_graph):
+    assert(lineage_graph.descendants(1) == [LineageStep(2, 10, 1), LineageStep(4, 11, 2), LineageStep(5, 12, 3)])
+    assert(lineage_graph.descendants(5) == [])
+    assert(lineage_graph.descendants(99) == [])
+
+def test_processes_of_type(lineage_graph):
+    assert(lineage_graph.processes(5, [100]) == [10])
+    assert(lineage_graph.processes(1, [200, 300], ancestors=False) == [11, 12])
+
+def test_duplicate_edges(lineage_edges, lineage_samples):
+    graph=LineageGraph.from_edges(lineage_edges+lineage_edges[:2], lineage_samples)
+    assert(len(graph) == len(lineage_edges))
+
+def test_incremental_edges(lineage_graph, monkeypatch):
+    monkeypatch.setattr(genologics_sql.lineage, "REINDEX_FRACTION", 1)
+    indexed=lineage_graph._indexed
+    lineage_graph._add([(5, 7, 13, 400)], [(7, 1)])
+    #the new edge is traversable before the indexes are built again
+    assert(lineage_graph._indexed == indexed)
+    assert(lineage_graph.descendants(4) == [LineageStep(5, 12, 1), LineageStep(7, 13, 2)])
+    assert(lineage_graph.ancestors(7, max_depth=1) == [LineageStep(5, 13, 1)])
+    lineage_graph._index()
+    assert(lineage_graph.descendants(4) == [LineageStep(5, 12, 1), LineageStep(7, 13, 2)])
+
+def test_lineage_statements():
+    #one statement per direction and filters, built once
+    assert(_lineage_statement(True, False, False) is _lineage_statement(True, False, False))
+    assert(_lineage_statement(True, False, False) is not _lineage_statement(False, False, False))
+    sql=_lineage_statement(False, True, True).text
+    assert("pio.inputartifactid = any(:artifactids)" in sql)
+    assert(":ptypes" in sql and ":sample" in sql)
+    assert(":ptypes" not in _lineage_statement(False, False, False).text)
+
+@pytest.mark.postgres
+def test_lineage_queries():
+    session=genologics_sql.utils.get_session()
+    try:
+        row=session.execute(text("select om.outputartifactid from outputmapping om \
+                inner join processiotracker pio on pio.trackerid=om.trackerid limit 1")).first()
+        if row is None:
+            pytest.skip("the database has no process outputs")
+        artifactid=row[0]
+        steps=get_ancestors(session, artifactid, max_depth=3)
+        assert(steps)
+        assert([step.depth for step in steps] == sorted(step.depth for step in steps))
+        assert(max(step.depth for step in steps) <= 3)
+        #the recursive query agrees with itself in both directions
+        for step in steps:
+            if step.depth == 1:
+                assert(artifactid in [child.artifactid for child in get_descendants(session, step.artifactid, max_depth=1)])
+        assert(get_ancestors(session, artifactid, max_depth=1) == [step for step in steps if step.depth == 1])
+    finally:
+        session.close()
+
+def test_max_depth(lineage_graph, session):
+    assert(lineage_graph.ancestors(5, max_depth=0) == [])
+    assert(get_ancestors(session, 5, max_depth=0) == [])
+    for traverse in (lineage_graph.descendants, lambda artifactids, max_depth:get_descendants(session, artifactids, max_depth)):
+        with pytest.raises(ValueError):
+            traverse(1, max_depth=-1)
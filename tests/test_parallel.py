@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+from sqlalchemy import event, text
+
+from genologics_sql.tables import Project
+from genologics_sql.parallel import TaskTimeout, run_per_project, _refuse_after_deadline
+
+@pytest.fixture
+def projects(session_factory):
+    session=session_factory()
+    session.add_all([Project(projectid=projectid, name="P{}".format(projectid)) for projectid in range(10)])
+    session.commit()
+    session.close()
+
+def _name(session, projectid):
+    if projectid == 3:
+        raise KeyError(projectid)
+    return session.query(Project).get(projectid).name
+
+def test_run_per_project(projects, session_factory):
+    result=run_per_project(range(10), _name, workers=3, session_factory=session_factory)
+    assert(len(result.results) == 9)
+    assert(result.results[5] == 'P5')
+    assert(list(result.errors) == [3])
+    assert(result.completed == 10)
+
+def test_overall_timeout(projects, session_factory):
+    result=run_per_project(range(10), _name, workers=2, timeout=0, session_factory=session_factory)
+    assert(sorted(result.skipped) == list(range(10)))
+
+#counts up to a billion, for much longer than the task_timeout of the tests
+SLOW_QUERY="with recursive c(x) as (select 1 union all select x+1 from c where x < 1000000000) select count(*) from c"
+
+TASK_TIMEOUT=1.0
+
+def _slow(session, projectid):
+    if projectid == 1:
+        #the running statement is interrupted
+        session.execute(text(SLOW_QUERY))
+    elif projectid == 2:
+        #the task started before the function was called, its deadline is passed after the sleep
+        time.sleep(TASK_TIMEOUT+0.1)
+        with pytest.raises(TaskTimeout):
+            session.query(Project).get(projectid)
+        raise TaskTimeout()
+    return _name(session, projectid)
+
+def test_task_timeout(projects, session_factory):
+    #the workers of the tests share a single connection, which the watchdog interrupts
+    result=run_per_project([0, 1, 2, 4], _slow, workers=1, task_timeout=TASK_TIMEOUT, session_factory=session_factory)
+    assert(sorted(result.timeouts) == [1, 2])
+    assert(result.results == {0:'P0', 4:'P4'})
+    assert(result.errors == {})
+    #the deadlines and the listener are removed with the workers
+    assert(not event.contains(session_factory.kw['bind'], 'before_cursor_execute', _refuse_after_deadline))
+
+def _commit(session, projectid):
+    name=_name(session, projectid)
+    if projectid % 2:
+        session.commit()
+    else:
+        session.close()
+    return name+session.query(Project).get(projectid).name
+
+def test_task_timeout_commit(projects, session_factory):
+    result=run_per_project(range(10), _commit, workers=2, task_timeout=60, session_factory=session_factory)
+    assert(sorted(result.results) == [0, 1, 2, 4, 5, 6, 7, 8, 9])
+    assert(result.results[5] == 'P5P5')
+    assert(list(result.errors) == [3])
@@ -0,0 +1,49 @@
+import pytest
+
+from sqlalchemy import inspect
+
+from genologics_sql.tables import Researcher
+from genologics_sql.queries import LOADING_PROFILES, get_project_tree, loading_options, undefer_options
+
+#profile : (loaded relationships of the project, of its samples, of their artifacts)
+LOADED={
+    'plate_layout': (set(['samples']), set(['artifacts']), set(['containerplacement'])),
+    'sample_sheet': (set(['samples', 'researcher', 'udfs']), set(['artifacts', 'udfs']), set(['containerplacement', 'reagentlabels'])),
+    'qc_summary':   (set(['samples']), set(['artifacts', 'udfs']), set(['udfs', 'states'])),
+    }
+
+def _loaded(obj, names):
+    """returns the subset of the attributes <names> that are loaded on obj"""
+    return set(names)-inspect(obj).unloaded
+
+@pytest.mark.parametrize('profile', sorted(LOADING_PROFILES))
+def test_loading_profiles(project_tree, session, statements, profile):
+    project=get_project_tree(session, "P1", profile)
+    queries=len(statements)
+    project_loaded, sample_loaded, artifact_loaded=LOADED[profile]
+    assert(_loaded(project, ['samples', 'researcher', 'udfs']) == project_loaded)
+    assert(len(project.samples) == 3)
+    for sample in project.samples:
+        assert(_loaded(sample, ['artifacts', 'udfs']) == sample_loaded)
+        for artifact in sample.artifacts:
+            assert(_loaded(artifact, ['containerplacement', 'reagentlabels', 'udfs', 'states']) == artifact_loaded)
+            if 'containerplacement' in artifact_loaded and artifact.containerplacement is not None:
+                assert(_loaded(artifact.containerplacement, ['container']) == set(['container']))
+                assert(_loaded(artifact.containerplacement.container, ['type']) == set(['type']))
+    #walking the loaded tree did not query the database
+    assert(len(statements) == queries)
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        loading_options('unknown')
+
+def test_undefer_options(project_tree, session):
+    researcher=session.query(Researcher).first()
+    assert(set(['avatar', 'avatarcontenttype', 'requestedusername']) <= inspect(researcher).unloaded)
+    session.expunge_all()
+    researcher=session.query(Researcher).options(*undefer_options(['avatar'])).first()
+    unloaded=inspect(researcher).unloaded
+    assert('avatar' not in unloaded and 'avatarcontenttype' not in unloaded)
+    assert('requestedusername' in unloaded)
+    with pytest.raises(ValueError):
+        undefer_options(['unknown'])
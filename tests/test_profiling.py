@@ -0,0 +1,44 @@
+import datetime
+
+from genologics_sql.tables import Project
+from genologics_sql.queries import iter_last_modified_projects
+from genologics_sql.profiling import QueryProfiler, statement_shape, _percentile
+
+def test_statement_shape():
+    assert(statement_shape("select *\n  from sample where processid IN (1, 2, 3)") == "select * from sample where processid IN (...)")
+    assert(statement_shape("select * from sample where processid=12") == statement_shape("select * from sample where processid=7"))
+
+def test_percentile():
+    durations=list(range(1, 101))
+    assert([_percentile(durations, percent) for percent in (50, 95, 99, 100)] == [50, 95, 99, 100])
+    assert(_percentile(list(range(1, 11)), 50) == 5)
+    assert(_percentile(list(range(1, 11)), 0) == 1)
+    assert(_percentile([7], 99) == 7)
+    assert(_percentile([], 50) == 0.0)
+
+def test_lazy_load_n_plus_one(engine, session):
+    session.add_all([Project(projectid=projectid) for projectid in range(5)])
+    session.commit()
+    profiler=QueryProfiler(n_plus_one=3)
+    profiler.attach(engine)
+    for project in session.query(Project):
+        project.samples
+    profiler.detach()
+    stats=profiler.stats()
+    assert(stats[0].origin == 'lazy:Project.samples' or stats[1].origin == 'lazy:Project.samples')
+    assert(sum(stat.count for stat in stats) == 6)
+    assert([origin for origin, count in profiler.n_plus_one_patterns.values()] == ['lazy:Project.samples'])
+    assert('genologics_sql_query_seconds_count{origin="lazy:Project.samples"} 5' in profiler.prometheus())
+
+def test_streaming_origin(engine, session):
+    session.add_all([Project(projectid=projectid, luid="P{}".format(projectid), lastmodifieddate=datetime.datetime(2021, 1, 1))
+            for projectid in range(5)])
+    session.commit()
+    profiler=QueryProfiler()
+    profiler.attach(engine)
+    projects=iter_last_modified_projects(session, since=datetime.datetime(2020, 1, 1), batch_size=2)
+    #the statement runs here, once iter_last_modified_projects has returned
+    assert(len(list(projects)) == 5)
+    assert(len(list(iter_last_modified_projects(session, since=datetime.datetime(2020, 1, 1), columns=['luid']))) == 5)
+    profiler.detach()
+    assert(set(stat.origin for stat in profiler.stats()) == set(['queries.iter_last_modified_projects']))
@@ -0,0 +1,32 @@
+import datetime
+
+from genologics_sql.tables import Artifact, ArtifactState
+
+def test_qc_flag(project_tree, session):
+    #artifact 0 has no state, artifact 1 was failed then passed, artifact 2 failed, artifact 3 has an unknown flag
+    session.add(Artifact(artifactid=3, luid="2-3", name="A3"))
+    session.add_all([ArtifactState(stateid=2, artifactid=1, qcflag=2, lastmodifieddate=datetime.datetime(2020, 1, 1)),
+            ArtifactState(stateid=3, artifactid=1, qcflag=1, lastmodifieddate=datetime.datetime(2020, 1, 2)),
+            ArtifactState(stateid=4, artifactid=3, qcflag=7, lastmodifieddate=datetime.datetime(2020, 1, 1))])
+    session.commit()
+    expected={0:'UNKNOWN', 1:'PASSED', 2:'FAILED', 3:'ERROR'}
+    #python side
+    assert(dict((artifact.artifactid, artifact.qc_flag) for artifact in session.query(Artifact)) == expected)
+    #sql side
+    assert(dict(session.query(Artifact.artifactid, Artifact.qc_flag)) == expected)
+    assert(sorted(artifactid for artifactid, in session.query(Artifact.artifactid).filter(Artifact.qc_flag == 'PASSED')) == [1])
+
+def test_qc_flag_ties(project_tree, session):
+    #states with the same date are ordered by stateid, states without date are the oldest, on both sides
+    session.add_all([Artifact(artifactid=3, luid="2-3", name="A3"), Artifact(artifactid=4, luid="2-4", name="A4")])
+    session.add_all([ArtifactState(stateid=6, artifactid=1, qcflag=1, lastmodifieddate=datetime.datetime(2020, 1, 1)),
+            ArtifactState(stateid=5, artifactid=1, qcflag=2, lastmodifieddate=datetime.datetime(2020, 1, 1)),
+            ArtifactState(stateid=7, artifactid=3, qcflag=2, lastmodifieddate=None),
+            ArtifactState(stateid=8, artifactid=3, qcflag=1, lastmodifieddate=datetime.datetime(2020, 1, 1)),
+            ArtifactState(stateid=9, artifactid=4, qcflag=1, lastmodifieddate=None),
+            ArtifactState(stateid=10, artifactid=4, qcflag=2, lastmodifieddate=None)])
+    session.commit()
+    expected={1:'PASSED', 3:'PASSED', 4:'FAILED'}
+    artifacts=session.query(Artifact).filter(Artifact.artifactid.in_([1, 3, 4]))
+    assert(dict((artifact.artifactid, artifact.qc_flag) for artifact in artifacts) == expected)
+    assert(dict(session.query(Artifact.artifactid, Artifact.qc_flag).filter(Artifact.artifactid.in_([1, 3, 4]))) == expected)
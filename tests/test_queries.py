@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+from sqlalchemy import text
+
+import genologics_sql.utils
+from genologics_sql.tables import Project
+from genologics_sql.queries import _statement, get_last_modified_projects, get_last_modified_projectids, iter_last_modified_projects, \
+        get_last_modified_processes, iter_last_modified_processes
+
+def test_statement_cache(session):
+    query="select pj.luid from project pj where pj.name = :name;"
+    statement=_statement(session, query)
+    assert(_statement(session, query) is statement)
+    assert(set(statement._bindparams) == set(['name']))
+
+def test_bound_parameters(session, statements):
+    session.add(Project(projectid=1, name="P1", luid="P1", lastmodifieddate=datetime.datetime(2021, 1, 1)))
+    session.commit()
+    del statements[:]
+    assert([project.luid for project in get_last_modified_projects(session, since=datetime.datetime(2020, 6, 1))] == ["P1"])
+    assert(get_last_modified_projects(session, since=datetime.datetime(2021, 6, 1)) == [])
+    #the values are bound, so that the database always receives the same statement
+    assert(len(statements) == 2 and statements[0] == statements[1])
+    assert("2020" not in statements[0])
+
+def test_streaming(session):
+    session.add_all([Project(projectid=projectid, name="P{}".format(projectid), luid="P{}".format(projectid),
+            lastmodifieddate=datetime.datetime(2021, 1, projectid)) for projectid in range(1, 6)])
+    session.commit()
+    since=datetime.datetime(2020, 6, 1)
+    projects=iter_last_modified_projects(session, since=since, batch_size=2)
+    #the results are read on iteration only
+    assert(not isinstance(projects, list))
+    assert(sorted(project.luid for project in projects) == sorted(project.luid for project in get_last_modified_projects(session, since=since)))
+    records=list(iter_last_modified_projects(session, since=since, batch_size=2, columns=['luid', 'name']))
+    assert(sorted(records) == [("P{}".format(i), "P{}".format(i)) for i in range(1, 6)])
+    assert(records[0].name == records[0].luid)
+
+@pytest.mark.postgres
+def test_streaming_processes():
+    session=genologics_sql.utils.get_session()
+    try:
+        typeids=[row[0] for row in session.execute(text("select typeid from processtype"))]
+        expected=sorted(process.processid for process in get_last_modified_processes(session, typeids, "7 days"))
+        assert(sorted(process.processid for process in iter_last_modified_processes(session, typeids, "7 days", batch_size=10)) == expected)
+    finally:
+        session.close()
+
+@pytest.mark.postgres
+def test_prepared_statements():
+    session=genologics_sql.utils.get_session()
+    prepared=genologics_sql.utils.get_session_factory()(info={'prepared_statements':True})
+    try:
+        expected=get_last_modified_projectids(session, "7 days")
+        assert(get_last_modified_projectids(prepared, "7 days") == expected)
+        #the statement is prepared once per connection
+        names=set(prepared.connection().info['genologics_sql_prepared'])
+        assert(len(names) == 1)
+        assert(get_last_modified_projectids(prepared, "7 days") == expected)
+        assert(prepared.connection().info['genologics_sql_prepared'] == names)
+    finally:
+        prepared.close()
+        session.close()
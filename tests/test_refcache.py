@@ -0,0 +1,64 @@
+import datetime
+
+from sqlalchemy import text
+
+from genologics_sql.tables import Process, ProcessType, Researcher
+from genologics_sql.refcache import ReferenceCache
+
+def test_reference_cache(engine, session_factory, processes, statements):
+    cache=ReferenceCache(engine, ttl=600)
+    cache.install(session_factory)
+    cache.revalidate()
+    session=session_factory()
+    session.query(Process).first()
+    del statements[:]
+    assert([process.type.displayname for process in session.query(Process)][:3] == ['type 0', 'type 1', 'type 2'])
+    #only the process query, the types being served by the cache
+    assert(len(statements) == 1)
+    assert(cache.version == 1)
+
+    session.query(ProcessType).get(1).displayname='renamed'
+    session.query(ProcessType).get(1).lastmodifieddate=datetime.datetime(2021, 1, 1)
+    session.commit()
+    #the session reads the rows it wrote from the database
+    assert(session.query(Process).get(1).type.displayname == 'renamed')
+    assert(cache.revalidate(force=True))
+    assert(cache.version == 2)
+    session.close()
+    #the next sessions get the reloaded table
+    session=session_factory()
+    assert(session.query(Process).get(1).type.displayname == 'renamed')
+    assert(cache.version == 2)
+    session.close()
+
+def test_rows_survive_commit(engine, session_factory, processes, statements):
+    cache=ReferenceCache(engine, ttl=600)
+    cache.install(session_factory)
+    cache.revalidate()
+    session=session_factory()
+    process=session.query(Process).get(1)
+    assert(process.type.displayname == 'type 1')
+    session.commit()
+    session.rollback()
+    del statements[:]
+    #the process is refreshed, its expired type is refreshed from the cache
+    assert(process.type.displayname == 'type 1')
+    assert(process.type.displayname == 'type 1')
+    assert(len(statements) == 1)
+    assert('processtype' not in statements[0].lower().split('from')[1])
+    session.close()
+
+def test_pending_changes_are_kept(engine, session_factory, project_tree):
+    cache=ReferenceCache(engine, ttl=0)
+    cache.install(session_factory)
+    session=session_factory()
+    researcher=session.query(Researcher).get(1)
+    session.commit()
+    researcher.firstname="new"
+    #autoflush begins a new transaction, which must not merge the cached row over the change
+    session.query(Process).all()
+    session.commit()
+    assert(researcher.firstname == "new")
+    session.close()
+    with engine.connect() as connection:
+        assert(connection.execute(text("select firstname from researcher where researcherid=1")).scalar() == "new")
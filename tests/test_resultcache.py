@@ -0,0 +1,67 @@
+import datetime
+import decimal
+import json
+import os
+import tempfile
+
+import pytest
+
+from sqlalchemy.orm import joinedload
+
+from genologics_sql.queries import PROJECT_CHANGE_SOURCES
+from genologics_sql.tables import Process
+from genologics_sql.resultcache import PROJECTS_WATERMARK_QUERY, ResultCache, cache_key, _dumps, _loads
+
+def _processes(session, typeids):
+    return session.query(Process).options(joinedload(Process.type)).filter(Process.typeid.in_(typeids)).order_by(Process.processid).all()
+
+def test_result_cache(processes, session_factory, statements):
+    path=os.path.join(tempfile.mkdtemp(), 'cache.sqlite')
+    cache=ResultCache(path, max_size=10**6)
+    #the order of lists can change the result, not the one of sets
+    assert(cache_key(_processes, [1, 2]) != cache_key(_processes, [2, 1]))
+    assert(cache_key(_processes, frozenset(["a", "b"])) == cache_key(_processes, frozenset(["b", "a"])))
+    assert(cache_key(_processes, {"a":1, "b":2}) == cache_key(_processes, {"b":2, "a":1}))
+    session=session_factory()
+    assert([p.processid for p in cache.call(session, _processes, ('open', 1), [1, 2])] == [1, 2, 4, 5, 7, 8, 10, 11])
+    session.close()
+    #served from the file, by another cache on the same path
+    other=ResultCache(path)
+    session=session_factory()
+    del statements[:]
+    processes=other.call(session, _processes, ('open', 1), [1, 2])
+    assert((other.hits, other.misses) == (1, 0))
+    assert(processes[0] in session and processes[0].typeid == 1)
+    #the loaded relationships are stored with the objects
+    assert(processes[0].type.displayname == 'type 1' and processes[0].type in session)
+    assert(statements == [])
+    other.call(session, _processes, ('open', 1), [2, 1])
+    assert(other.misses == 1)
+    #a new watermark invalidates the entry
+    other.call(session, _processes, ('open', 2), [1, 2])
+    assert(other.misses == 2)
+    session.close()
+
+    cache.max_size=0
+    cache.put('key', 'value')
+    assert(cache.get('key') == (False, None))
+    cache.max_size=10**6
+    cache.put('key', 'value', ttl=-1)
+    assert(cache.get('key') == (False, None))
+    cache.invalidate(_processes)
+    assert(cache.get(cache_key(_processes, [1, 2]), ('open', 2)) == (False, None))
+
+def test_watermark_query():
+    #each source only reads the rows of the projects
+    assert(PROJECTS_WATERMARK_QUERY.count("any(:projectids)") == len(PROJECT_CHANGE_SOURCES))
+    assert(":since" not in PROJECTS_WATERMARK_QUERY and "group by" not in PROJECTS_WATERMARK_QUERY)
+
+def test_stored_values():
+    value=[1, 2.5, "a", None, (True, b"bytes"), {1:datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)},
+            datetime.date(2020, 1, 2), decimal.Decimal("1.10")]
+    data=_dumps(value)
+    #plain JSON, no code is run to read it
+    assert(json.loads(data)['entities'] == [])
+    assert(_loads(data) == value)
+    with pytest.raises(TypeError):
+        _dumps(object())
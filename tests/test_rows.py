@@ -0,0 +1,20 @@
+from genologics_sql.tables import Project, Sample, ProcessType
+from genologics_sql.queries import get_rows, get_related_rows, row_record
+
+def test_rows(project_tree, processes, session):
+    samples=get_related_rows(session, Project.samples, [1, 2], ['processid', Sample.name])
+    assert(samples[2] == [])
+    assert(sorted(samples[1]) == [(0, "S0"), (1, "S1"), (2, "S2")])
+    assert(samples[1][0].name.startswith("S"))
+    #mapped attributes named differently from their column
+    session.add(ProcessType(typeid=3, displayname="type", pmetadata="metadata"))
+    session.commit()
+    session.expunge_all()
+    assert(get_rows(session, ProcessType, [3], ['pmetadata'])[3].pmetadata == "metadata")
+    assert(len(session.identity_map) == 0)
+    assert(row_record(Project, ['name']) is row_record(Project, [Project.name]))
+    try:
+        row_record(Project, ['samples'])
+        assert(False)
+    except ValueError:
+        pass
@@ -0,0 +1,88 @@
+from genologics_sql.tables import Project, Container, Artifact, ArtifactUdfView, EntityUdfView
+from genologics_sql.queries import get_udf_columns, load_udf_dicts
+
+def test_udf_columns(project_tree, session):
+    udfs=get_udf_columns(session, Artifact, ["Concentration", "Comment"])
+    assert(udfs['artifactid'] == [0, 1])
+    assert(udfs['Concentration'] == [1.5, None])
+    assert(udfs['Comment'] == [None, "ok"])
+
+def test_udf_columns_mixed_types(project_tree, session):
+    session.add(ArtifactUdfView(artifactid=2, udtname="", udfname="Concentration", udftype="String", udfvalue="high", udfunitlabel=""))
+    session.commit()
+    #the udf is stored with several types, its raw values are returned
+    udfs=get_udf_columns(session, Artifact, ["Concentration"])
+    assert(udfs['artifactid'] == [0, 2])
+    assert(udfs['Concentration'] == ["1.5", "high"])
+    #a single type is converted
+    udfs=get_udf_columns(session, Artifact, ["Concentration"], ids=[0])
+    assert(udfs['Concentration'] == [1.5])
+
+def test_load_udf_dicts_returns_copies(project_tree, session):
+    artifact=session.query(Artifact).get(0)
+    udf_dicts=load_udf_dicts(session, Artifact, [artifact, 1])
+    assert(udf_dicts == {0:{"Concentration":1.5}, 1:{"Comment":"ok"}})
+    udf_dicts[0]["Concentration"]=2.0
+    assert(artifact.udf_dict == {"Concentration":1.5})
+
+def test_udf_dict_returns_copies(project_tree, session):
+    artifact=session.query(Artifact).get(0)
+    artifact.udf_dict["Concentration"]=2.0
+    artifact.udf_dict.clear()
+    assert(artifact.udf_dict == {"Concentration":1.5})
+    assert(artifact.udf_dict is not artifact.udf_dict)
+
+def test_udf_dict_invalidation(project_tree, session):
+    artifact=session.query(Artifact).get(0)
+    assert(artifact.udf_dict == {"Concentration":1.5})
+    #expire
+    session.query(ArtifactUdfView).filter(ArtifactUdfView.artifactid==0).update({'udfvalue':"2.5"})
+    session.commit()
+    assert(artifact.udf_dict == {"Concentration":2.5})
+    #refresh, without expiring the instance
+    artifact._set_udf_dict({"Concentration":3.5})
+    session.query(Artifact).populate_existing().filter(Artifact.artifactid==0).one()
+    assert(artifact.udf_dict == {"Concentration":2.5})
+    #append
+    comment=ArtifactUdfView(artifactid=0, udtname="", udfname="Comment", udftype="String", udfvalue="new", udfunitlabel="")
+    artifact.udfs.append(comment)
+    assert(artifact.udf_dict == {"Concentration":2.5, "Comment":"new"})
+    #remove
+    artifact.udfs.remove(comment)
+    assert(artifact.udf_dict == {"Concentration":2.5})
+
+def test_udf_comparator(project_tree, session):
+    session.add_all([ArtifactUdfView(artifactid=2, udtname="", udfname="Concentration", udftype="String", udfvalue="high", udfunitlabel=""),
+            ArtifactUdfView(artifactid=2, udtname="", udfname="Passed", udftype="Boolean", udfvalue="True", udfunitlabel=""),
+            ArtifactUdfView(artifactid=1, udtname="", udfname="Passed", udftype="Boolean", udfvalue="False", udfunitlabel=""),
+            ArtifactUdfView(artifactid=0, udtname="", udfname="Passed", udftype="Boolean", udfvalue="", udfunitlabel="")])
+    session.commit()
+    def matching(condition):
+        return sorted(artifact.artifactid for artifact in session.query(Artifact).filter(condition))
+    #class side, through udf and udf_dict
+    assert(matching(Artifact.udf("Concentration") > 1) == [0])
+    assert(matching(Artifact.udf_dict["Concentration"] <= 1.5) == [0])
+    assert(matching(Artifact.udf("Concentration") == "high") == [2])
+    assert(matching(Artifact.udf("Concentration").in_([1.5, 2])) == [0])
+    assert(matching(Artifact.udf("Concentration").in_(["high", "low"])) == [2])
+    assert(matching(Artifact.udf("Comment") != "ko") == [1])
+    assert(matching(Artifact.udf("Comment").like("o%")) == [1])
+    assert(matching(Artifact.udf("Passed") == True) == [2])
+    assert(matching(Artifact.udf("Passed") == False) == [1])
+    assert(matching(Artifact.udf("Passed").has_value()) == [1, 2])
+    assert(matching(Artifact.udf("Missing") != 1) == [])
+    #instance side, the matching artifacts have the same udf values in udf_dict
+    artifacts=session.query(Artifact).order_by(Artifact.artifactid).all()
+    assert([artifact.artifactid for artifact in artifacts if artifact.udf_dict.get("Passed") is True] == matching(Artifact.udf("Passed") == True))
+    assert([artifact.artifactid for artifact in artifacts if "Passed" in artifact.udf_dict] == matching(Artifact.udf("Passed").has_value()))
+    assert([artifact.artifactid for artifact in artifacts if artifact.udf_dict.get("Concentration") == 1.5] == matching(Artifact.udf("Concentration") == 1.5))
+
+def test_udf_comparator_attachtoclassid(project_tree, session):
+    #a project and a container with the same id share the entity udf view
+    session.add_all([EntityUdfView(attachtoid=1, attachtoclassid=83, udtname="", udfname="Platform", udftype="String", udfvalue="NovaSeq", udfunitlabel=""),
+            EntityUdfView(attachtoid=1, attachtoclassid=27, udtname="", udfname="Platform", udftype="String", udfvalue="MiSeq", udfunitlabel="")])
+    session.commit()
+    assert(session.query(Project).filter(Project.udf("Platform") == "NovaSeq").count() == 1)
+    assert(session.query(Project).filter(Project.udf("Platform") == "MiSeq").count() == 0)
+    assert(session.query(Container).filter(Container.udf_dict["Platform"] == "MiSeq").count() == 1)
+    assert(session.query(Project).get(1).udf_dict == {"Platform":"NovaSeq"})
@@ -0,0 +1,102 @@
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+from sqlalchemy import text
+
+import genologics_sql.utils
+from genologics_sql.tables import Project
+
+#Importing the package must stay fast, and must not need a configuration file
+IMPORT_TIME_BUDGET=1.5
+
+ROOT=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _clean_env():
+    env=dict((key, value) for key, value in os.environ.items() if not key.startswith('GENOSQL_'))
+    env['HOME']=tempfile.mkdtemp()
+    env['PYTHONPATH']=ROOT
+    return env
+
+def test_import_time():
+    code="import time; start=time.time(); import genologics_sql.utils; print(time.time()-start)"
+    output=subprocess.check_output([sys.executable, '-c', code], env=_clean_env(), cwd=tempfile.mkdtemp())
+    assert(float(output.strip()) < IMPORT_TIME_BUDGET)
+
+def test_dsn_from_environment():
+    code="import genologics_sql.utils; print(genologics_sql.utils.get_configuration()['dsn'])"
+    env=_clean_env()
+    env['GENOSQL_DSN']='postgresql://user@localhost/clarity'
+    output=subprocess.check_output([sys.executable, '-c', code], env=env, cwd=tempfile.mkdtemp())
+    assert(output.decode().strip() == 'postgresql://user@localhost/clarity')
+
+def test_configure():
+    previous=genologics_sql.utils.CONF
+    try:
+        genologics_sql.utils.configure(username='user', url='localhost', db='clarity', pool_size=2)
+        conf=genologics_sql.utils.get_configuration()
+        assert(conf['db'] == 'clarity')
+        assert(conf['pool_size'] == 2)
+    finally:
+        genologics_sql.utils.configure(previous)
+
+def test_checkpoint():
+    checkpoint=genologics_sql.utils.Checkpoint(os.path.join(tempfile.mkdtemp(), "sync"))
+    assert(checkpoint.load() is None)
+    checkpoint.save(None)
+    assert(not os.path.exists(checkpoint.path))
+    for watermark in (datetime.datetime(2020, 1, 2, 3, 4, 5, 6), datetime.datetime(2020, 1, 2, 3, 4, 5),
+            datetime.datetime(2020, 1, 2, 3, 4, 5, 6, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))):
+        checkpoint.save(watermark)
+        assert(checkpoint.load() == watermark)
+        assert(checkpoint.load().tzinfo == watermark.tzinfo)
+    assert(os.listdir(os.path.dirname(checkpoint.path)) == ["sync"])
+    with open(checkpoint.path, 'w') as f:
+        f.write("yesterday")
+    try:
+        checkpoint.load()
+        assert(False)
+    except Exception as e:
+        assert("yesterday" in str(e))
+
+def test_session_scope():
+    previous=genologics_sql.utils.CONF
+    try:
+        genologics_sql.utils.configure(dsn='sqlite://')
+        with genologics_sql.utils.session_scope() as session:
+            assert(session.execute(text("select 1")).scalar() == 1)
+            assert(session.in_transaction())
+        assert(not session.in_transaction())
+    finally:
+        genologics_sql.utils.configure(previous)
+
+def test_readonly_snapshot_id(engine):
+    #the snapshot id is formatted in the SET TRANSACTION statement, so it is validated first
+    session=genologics_sql.utils.readonly_sessionmaker(engine)(info={'snapshot':"'; drop table project; --"})
+    try:
+        session.execute(text("select 1"))
+        assert(False)
+    except ValueError:
+        pass
+    finally:
+        session.close()
+
+@pytest.mark.postgres
+def test_readonly_session():
+    with genologics_sql.utils.readonly_session_scope() as session:
+        assert(session.execute(text("show transaction_read_only")).scalar() == "on")
+        assert(session.execute(text("show transaction_isolation")).scalar() == "repeatable read")
+        count=session.execute(text("select count(*) from project")).scalar()
+        snapshot=genologics_sql.utils.export_snapshot(session)
+        with genologics_sql.utils.readonly_session_scope(snapshot) as other:
+            assert(other.execute(text("select count(*) from project")).scalar() == count)
+        session.add(Project(projectid=-1, name="readonly", luid="readonly"))
+        try:
+            session.flush()
+            assert(False)
+        except Exception as e:
+            assert("Read only" in str(e))